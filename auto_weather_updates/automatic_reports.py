@@ -1,13 +1,24 @@
 import logging
 import os
 import asyncio
-import shared.constants
+import datetime
+import time
+from typing import AsyncIterable, Iterable
 
 from telegram.ext import Application
+from shared.cache import ForecastCache
 from weather_api.transformer import WeatherTransformer
 from weather_api.weather_api_connector import WeatherAPIConnector
-from shared.utils import Moment
+import shared.constants
+from auto_weather_updates.dispatcher import DispatchReport, ReportDispatcher
+from auto_weather_updates.ledger import DeliveryLedger
+from auto_weather_updates.partitions import PartitionLeases
+from database.async_database import AsyncDatabaseConnector
 from database.database import DatabaseConnector
+from shared.metrics import REGISTRY, start_exporters
+from shared.prewarm import ForecastPrewarmer
+from shared.telegram_limiter import rate_limiter_from_env
+from shared.telegram_request import InstrumentedRequest
 
 # Enable logging
 logging.basicConfig(
@@ -19,47 +30,204 @@ logging.getLogger("httpx").setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def default_run_id() -> str:
+    """Workers started the same day join the same run."""
+    return shared.constants.DISPATCH_RUN_ID or f'forecast-{datetime.date.today().isoformat()}'
+
+
 class AutomaticReports:
-    def __init__(self, application: Application, url: str):
+    def __init__(self, application: Application, url: str, **dispatcher_options):
+        """
+        :param dispatcher_options: Overrides of the ReportDispatcher settings (eg: max_sends, global_rate)
+        """
         self.connector = WeatherAPIConnector(url=url)
-        self.transformer = WeatherTransformer(connector=self.connector)
+        self.transformer = WeatherTransformer(connector=self.connector, cache=ForecastCache())
         self.application = application
+        self.dispatcher_options = dispatcher_options
+
+    async def send_reports(
+            self,
+            users: Iterable | AsyncIterable | None = None,
+            run_id: str | None = None,
+    ) -> DispatchReport:
+        """
+        Sends weather reports to users who have agreed to receive automated updates.
+
+        :param users: Users to send the reports to instead of the subscribers read from the database
+        :param run_id: Run to resume, defaults to the run of the day
+        """
+        db_connector = AsyncDatabaseConnector.from_env()
+        try:
+            if users is not None:
+                dispatcher = ReportDispatcher(self.application.bot, self.transformer, **self.dispatcher_options)
+                report = await dispatcher.run(users)
+                logger.info(f"Automatic reports run finished: {report.summary()}")
+                return report
+
+            await db_connector.ensure_schema()
+            return await self.send_subscriber_reports(db_connector, run_id or default_run_id())
+        finally:
+            await self.close(db_connector)
+
+    async def send_subscriber_reports(
+            self,
+            db_connector: AsyncDatabaseConnector,
+            run_id: str,
+            **filters,
+    ) -> DispatchReport:
+        """
+        Send the reports of the subscribers matching the filters (eg: tz_id), leaving the connectors open.
 
-    async def send_reports(self) -> None:
-        """Sends weather reports to users who have agreed to receive automated updates."""
-        db_connector = DatabaseConnector(
-            db_name=shared.constants.DB_NAME,
-            user=shared.constants.DB_USER,
-            password=shared.constants.DB_PASSWORD,
-            host=shared.constants.HOST,
-            port=shared.constants.PORT,
+        The deliveries are tracked in the delivery ledger of the run, so running it again with the same run_id (eg:
+        after a crash) only sends to the users not delivered yet.
+        """
+        ledger = await self._start_ledger(db_connector, run_id)
+        await self.prewarm(db_connector, **filters)
+        dispatcher = ReportDispatcher(self.application.bot, self.transformer, **self.dispatcher_options)
+
+        # Streamed from a server-side cursor, the dispatch starts with the first batch
+        users = db_connector.iter_users(
+            validate=False,
+            undelivered_in=run_id,
+            with_last_forecast=True,
+            located_only=True,
+            agreement=True,
+            subscription=True,
+            active=True,
+            **filters,
         )
+        report = await dispatcher.run(users, ledger)
+        await asyncio.to_thread(ledger.finish_run)
+        logger.info(f"Automatic reports run {run_id} finished: {report.summary()}")
+        return report
+
+    async def send_reports_partitioned(
+            self,
+            run_id: str | None = None,
+            partition_count: int | None = None,
+            worker_id: str | None = None,
+    ) -> DispatchReport:
+        """
+        Send the reports of the partitions this worker manages to claim, see PartitionLeases.
 
-        users = db_connector.read_users(agreement=True, subscription=True, active=True)
+        Every worker of the run calls this. It returns once every partition of the run is completed, so partitions of
+        workers that die are taken over by the ones still running.
+        """
+        db_connector = AsyncDatabaseConnector.from_env()
+        leases = PartitionLeases(db_connector.db_connector, run_id or default_run_id(), partition_count, worker_id)
+        total = DispatchReport()
+        try:
+            await db_connector.ensure_schema()
+            await asyncio.to_thread(leases.create_run)
+            ledger = await self._start_ledger(db_connector, leases.run_id)
 
-        for user in users:
-            weather_update = self.transformer.transform(user.latitude, user.longitude, Moment.FORECAST)
+            while True:
+                partition_index = await asyncio.to_thread(leases.claim)
+                if partition_index is None:
+                    if not await asyncio.to_thread(leases.pending):
+                        break
+                    # The remaining partitions are held by other workers, check again in case one of them dies
+                    await asyncio.sleep(leases.lease_seconds / 3)
+                    continue
 
-            try:
-                await self.application.bot.send_message(
-                    chat_id=user.chat_id,
-                    text=f"{weather_update}"
+                logger.info(f"Worker {leases.worker_id} claimed partition {partition_index} of run {leases.run_id}")
+                # A partition taken over from a dead worker skips the users it already delivered
+                partition = (partition_index, leases.partition_count)
+                users = db_connector.iter_users(
+                    validate=False,
+                    partition=partition,
+                    undelivered_in=leases.run_id,
+                    with_last_forecast=True,
+                    located_only=True,
+                    agreement=True,
+                    subscription=True,
+                    active=True,
                 )
-                logger.info(f"Sent weather update to user {user.chat_id}")
-            except Exception as e:
-                logger.error(f"Failed to send weather update to user {user.chat_id}: {e}")
+                dispatcher = ReportDispatcher(self.application.bot, self.transformer, **self.dispatcher_options)
+                task = asyncio.create_task(self._send_partition(db_connector, dispatcher, users, ledger, partition))
+                keep_alive = asyncio.create_task(leases.keep_alive(partition_index, task))
+                try:
+                    report = await task
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        # This worker itself is being cancelled, not just the partition
+                        raise
+                    continue
+                finally:
+                    keep_alive.cancel()
+
+                await asyncio.to_thread(leases.complete, partition_index)
+                logger.info(f"Partition {partition_index} of run {leases.run_id} finished: {report.summary()}")
+                total.add(report)
+
+            await asyncio.to_thread(ledger.finish_run)
+            total.finished_at = time.monotonic()
+            logger.info(f"Worker {leases.worker_id} finished run {leases.run_id}: {total.summary()}")
+            return total
+        finally:
+            await self.close(db_connector)
+
+    async def _send_partition(
+            self,
+            db_connector: AsyncDatabaseConnector,
+            dispatcher: ReportDispatcher,
+            users: AsyncIterable,
+            ledger: DeliveryLedger,
+            partition: tuple[int, int],
+    ) -> DispatchReport:
+        # Prewarming under the lease too, a slow WeatherAPI must not let the lease expire unnoticed
+        await self.prewarm(db_connector, partition=partition)
+        return await dispatcher.run(users, ledger)
+
+    async def prewarm(self, db_connector: AsyncDatabaseConnector, **filters) -> int:
+        """
+        Fetch the forecasts of the subscriber cells with bulk requests ahead of the dispatch, which then mostly renders
+        and sends. Cells refreshed recently (eg: by the scheduler) are skipped, see ForecastPrewarmer.
+        """
+        try:
+            return await ForecastPrewarmer(self.transformer, db_connector).prewarm(
+                agreement=True, subscription=True, active=True, **filters
+            )
+        except Exception as e:
+            logger.error(f"Failed to prewarm the forecasts, the dispatch fetches them instead: {e}")
+            return 0
+
+    @staticmethod
+    async def _start_ledger(db_connector: AsyncDatabaseConnector, run_id: str) -> DeliveryLedger:
+        ledger = DeliveryLedger(db_connector.db_connector, run_id)
+        progress = await asyncio.to_thread(ledger.start_run)
+        if progress:
+            logger.info(f"Resuming run {run_id}, delivery statuses so far: {progress}")
+        return ledger
+
+    async def close(self, db_connector: AsyncDatabaseConnector) -> None:
+        logger.info(f"Forecast cache stats: {self.transformer.cache.stats()}")
+        if REGISTRY.enabled:
+            logger.info(f"Metrics summary:\n{REGISTRY.summary()}")
+        await self.connector.aclose()
+        db_connector.close()
 
 
 def main() -> None:
     """Run the automatic reports sender."""
     tel_token = os.environ.get("TEL_API_KEY", None)
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(tel_token).build()
+    application = (
+        Application.builder()
+        .token(tel_token)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(rate_limiter_from_env(DatabaseConnector.from_env()))
+        .build()
+    )
+    start_exporters()
 
     automatic_reports = AutomaticReports(application, 'http://api.weatherapi.com/v1')
 
     # Send weather reports immediately when the script runs
-    asyncio.run(automatic_reports.send_reports())
+    if shared.constants.DISPATCH_PARTITIONS:
+        asyncio.run(automatic_reports.send_reports_partitioned())
+    else:
+        asyncio.run(automatic_reports.send_reports())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+import shared.constants
+from auto_weather_updates.fingerprint import ChangeDetector, ForecastFingerprint
+from auto_weather_updates.ledger import FAILED, SENT, SKIPPED, DeliveryLedger
+from shared.metrics import REGISTRY
+from shared.rate_limiter import KeyedTokenBucket, TokenBucket
+from shared.telegram_limiter import BULK
+from shared.utils import Moment, location_cell, retry_after_seconds
+from weather_api.transformer import WeatherTransformer
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a queue for the workers reading it
+_DONE = object()
+
+
+@dataclass
+class DispatchReport:
+    """
+    Counters of a report run, logged at the end of the run.
+    """
+    users: int = 0
+    fetches: int = 0
+    sent: int = 0
+    failed: int = 0
+    skipped: int = 0
+    retries: int = 0
+    flood_waits: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        """Messages sent per second."""
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def add(self, other: 'DispatchReport') -> None:
+        """Add the counters of another run, eg: of each partition handled by a worker."""
+        self.users += other.users
+        self.fetches += other.fetches
+        self.sent += other.sent
+        self.failed += other.failed
+        self.skipped += other.skipped
+        self.retries += other.retries
+        self.flood_waits += other.flood_waits
+
+    def summary(self) -> str:
+        return (
+            f"{self.fetches} forecast fetches for {self.users} users, {self.sent}/{self.users} sent, {self.failed} failed, "
+            f"{self.skipped} unchanged, {self.retries} retries, {self.flood_waits} flood waits in {self.elapsed:.1f}s ({self.throughput:.1f} msg/s)"
+        )
+
+
+async def _supervised(awaitable, workers: list[asyncio.Task]):
+    """
+    Await while the workers run, raising the error of the first worker that crashed instead of waiting forever on a
+    queue nobody reads anymore.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while not task.done():
+            running = [worker for worker in workers if not worker.done()]
+            await asyncio.wait([task, *running], return_when=asyncio.FIRST_COMPLETED)
+            for worker in workers:
+                if worker.done() and not worker.cancelled() and worker.exception() is not None:
+                    raise worker.exception()
+        return task.result()
+    finally:
+        task.cancel()
+
+
+async def _aiter(users: Iterable | AsyncIterable) -> AsyncIterator:
+    """Iterate sync and async iterables the same way."""
+    if isinstance(users, AsyncIterable):
+        async for user in users:
+            yield user
+    else:
+        for user in users:
+            yield user
+
+
+class ReportDispatcher:
+    """
+    Pipelined sender for the automated reports.
+
+    Users are read into a bounded queue and grouped into location cells, `max_fetches` workers render the forecast of
+    each cell once and `max_sends` workers send the rendered message to every chat of the cell. Sends go through the
+    bulk lane of the rate limiter of the bot, shared with the bot replies, or through a global and a per-chat token
+    bucket of the dispatcher when the bot has none. Flood waits pause the limiter and the message is retried.
+
+    With `changes_only` a user is skipped when the forecast matches the last one delivered to them (the last_forecast
+    of SubscriberRow), see ChangeDetector. The fingerprint of every delivered forecast goes to the ledger.
+    """
+
+    def __init__(
+            self,
+            bot: Bot,
+            transformer: WeatherTransformer,
+            max_fetches: Optional[int] = None,
+            max_sends: Optional[int] = None,
+            max_retries: Optional[int] = None,
+            global_rate: Optional[float] = None,
+            chat_rate: Optional[float] = None,
+            cell_mode: Optional[str] = None,
+            cell_precision: Optional[int] = None,
+            changes_only: Optional[bool] = None,
+            change_detector: Optional[ChangeDetector] = None,
+    ):
+        """
+        :param changes_only: Skip the users whose forecast did not change (defaults to NOTIFY_CHANGES_ONLY)
+        :param change_detector: Thresholds of a meaningful change, defaults to the NOTIFY_* settings
+        """
+        self.bot = bot
+        self.transformer = transformer
+        self.max_fetches = max_fetches or shared.constants.DISPATCH_MAX_FETCHES
+        self.max_sends = max_sends or shared.constants.DISPATCH_MAX_SENDS
+        self.max_retries = max_retries if max_retries is not None else shared.constants.DISPATCH_MAX_RETRIES
+        self.cell_mode = cell_mode or shared.constants.CACHE_CELL_MODE
+        self.cell_precision = cell_precision if cell_precision is not None else shared.constants.CACHE_CELL_PRECISION
+        self.changes_only = changes_only if changes_only is not None else shared.constants.NOTIFY_CHANGES_ONLY
+        self.change_detector = change_detector or ChangeDetector()
+        if getattr(bot, 'rate_limiter', None) is not None:
+            # The limiter shared with the bot paces every send and pauses on flood waits, buckets of the dispatcher
+            # would only throttle the bulk lane a second time
+            self.global_limiter = self.chat_limiter = None
+            self._send_options = {'rate_limit_args': BULK}
+        else:
+            self.global_limiter = TokenBucket(global_rate or shared.constants.TELEGRAM_GLOBAL_RATE)
+            self.chat_limiter = KeyedTokenBucket(chat_rate or shared.constants.TELEGRAM_CHAT_RATE)
+            # ExtBot refuses rate_limit_args without a limiter
+            self._send_options = {}
+
+    async def run(self, users: Iterable | AsyncIterable, ledger: Optional[DeliveryLedger] = None) -> DispatchReport:
+        """
+        Send the forecast to every user, returns the counters of the run.
+
+        :param users: Iterable or async iterable of objects with chat_id, latitude and longitude, consumed lazily, and
+            optionally last_forecast
+        :param ledger: Ledger recording the delivery status of every user
+        """
+        report = DispatchReport()
+        # Rendered message and its fingerprint per location cell, shared by every user of the cell during this run
+        renders: dict[str, asyncio.Future] = {}
+        fetch_queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_fetches * 2)
+        send_queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_sends * 2)
+
+        fetchers = [asyncio.create_task(self._fetch_worker(fetch_queue, send_queue, renders, report, ledger)) for _ in range(self.max_fetches)]
+        senders = [asyncio.create_task(self._send_worker(send_queue, report, ledger)) for _ in range(self.max_sends)]
+
+        workers = fetchers + senders
+
+        async def put(queue: asyncio.Queue, item) -> None:
+            if queue.full():
+                await _supervised(queue.put(item), workers)
+            else:
+                queue.put_nowait(item)
+
+        try:
+            async for user in _aiter(users):
+                report.users += 1
+                await put(fetch_queue, user)
+            for _ in fetchers:
+                await put(fetch_queue, _DONE)
+            await _supervised(asyncio.gather(*fetchers), workers)
+
+            for _ in senders:
+                await put(send_queue, _DONE)
+            await _supervised(asyncio.gather(*senders), workers)
+        finally:
+            for task in fetchers + senders:
+                task.cancel()
+            if ledger is not None:
+                await ledger.flush()
+            report.finished_at = time.monotonic()
+
+        return report
+
+    async def _fetch_worker(
+            self,
+            fetch_queue: asyncio.Queue,
+            send_queue: asyncio.Queue,
+            renders: dict[str, asyncio.Future],
+            report: DispatchReport,
+            ledger: Optional[DeliveryLedger],
+    ) -> None:
+        while (user := await fetch_queue.get()) is not _DONE:
+            cell = render = None
+            try:
+                cell = location_cell(user.latitude, user.longitude, self.cell_mode, self.cell_precision)
+                render = renders.get(cell)
+                if render is None:
+                    # First user of the cell in this run, the next ones wait for this fetch instead of making their own
+                    render = renders[cell] = asyncio.ensure_future(self._render(user.latitude, user.longitude))
+                    report.fetches += 1
+                    REGISTRY.inc('report_forecast_fetches_total')
+                weather_update, fingerprint = await render
+            except Exception as e:
+                if render is not None and renders.get(cell) is render:
+                    # The users already waiting on the fetch fail with it, the next user of the cell fetches again
+                    del renders[cell]
+                report.failed += 1
+                logger.error(f"Failed to get weather update for user {user.chat_id}: {e}")
+                if ledger is not None:
+                    await ledger.record(user.chat_id, FAILED, f"Forecast: {e}")
+                continue
+            if self.changes_only and not self.change_detector.changed(
+                    ForecastFingerprint.from_database(getattr(user, 'last_forecast', None)), fingerprint
+            ):
+                report.skipped += 1
+                REGISTRY.inc('report_messages_total', status='skipped')
+                if ledger is not None:
+                    await ledger.record(user.chat_id, SKIPPED)
+                continue
+            await send_queue.put((user.chat_id, weather_update, fingerprint))
+
+    async def _render(self, latitude: float, longitude: float) -> tuple[str, ForecastFingerprint]:
+        """Forecast message of the location and the fingerprint of the forecast."""
+        with REGISTRY.timer('weather_transform', moment=Moment.FORECAST.value):
+            report = await self.transformer.get_data_async(latitude, longitude, Moment.FORECAST)
+            return self.transformer.render(report, Moment.FORECAST), ForecastFingerprint.from_report(report)
+
+    async def _send_worker(self, send_queue: asyncio.Queue, report: DispatchReport, ledger: Optional[DeliveryLedger]) -> None:
+        while (item := await send_queue.get()) is not _DONE:
+            chat_id, text, fingerprint = item
+            error = await self._send(chat_id, text, report)
+            if error is None:
+                report.sent += 1
+                REGISTRY.inc('report_messages_total', status='sent')
+            else:
+                report.failed += 1
+                REGISTRY.inc('report_messages_total', status='failed')
+            if ledger is not None:
+                if error is None:
+                    await ledger.record(chat_id, SENT, fingerprint=fingerprint.to_database())
+                else:
+                    await ledger.record(chat_id, FAILED, error)
+
+    async def _send(self, chat_id, text: str, report: DispatchReport) -> Optional[str]:
+        """Send a single message, retrying flood waits and network errors. Returns the error, None when delivered."""
+        for attempt in range(self.max_retries + 1):
+            if self.global_limiter is not None:
+                await self.chat_limiter.acquire(chat_id)
+                await self.global_limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=f"{text}", **self._send_options)
+                logger.debug(f"Sent weather update to user {chat_id}")
+                return None
+            except RetryAfter as e:
+                report.flood_waits += 1
+                REGISTRY.inc('telegram_flood_waits_total')
+                wait = retry_after_seconds(e.retry_after)
+                logger.warning(f"Flood wait of {wait}s from Telegram while sending to user {chat_id}")
+                if self.global_limiter is not None:
+                    self.global_limiter.pause(wait)
+            except BadRequest as e:
+                # BadRequest subclasses NetworkError but retrying it won't help (eg: chat not found)
+                logger.error(f"Failed to send weather update to user {chat_id}: {e}")
+                return str(e)
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Network error while sending to user {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except Exception as e:
+                logger.error(f"Failed to send weather update to user {chat_id}: {e}")
+                return str(e)
+            if attempt < self.max_retries:
+                report.retries += 1
+
+        logger.error(f"Failed to send weather update to user {chat_id}: retries exhausted")
+        return 'Retries exhausted'
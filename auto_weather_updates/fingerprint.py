@@ -0,0 +1,79 @@
+import datetime
+from typing import NamedTuple, Optional
+
+import shared.constants
+from shared.models import WeatherForecastItem, WeatherReport
+
+
+def _minutes(value: str) -> Optional[int]:
+    """Minutes since midnight of a WeatherAPI astro time (eg: '06:58 AM'), None when it's not a time."""
+    try:
+        time = datetime.datetime.strptime(value, '%I:%M %p')
+    except ValueError:
+        # 'No sunrise' / 'No sunset' near the poles
+        return None
+    return time.hour * 60 + time.minute
+
+
+class ForecastFingerprint(NamedTuple):
+    """
+    What a user was told by a forecast report, stored per user in users.last_forecast as a json array.
+    """
+    condition: str
+    maxtemp_c: float
+    mintemp_c: float
+    sunrise: str
+    sunset: str
+
+    @classmethod
+    def from_item(cls, item: WeatherForecastItem) -> 'ForecastFingerprint':
+        return cls(item.day.condition.text, item.day.maxtemp_c, item.day.mintemp_c, item.astro.sunrise, item.astro.sunset)
+
+    @classmethod
+    def from_report(cls, report: WeatherReport) -> 'ForecastFingerprint':
+        """Fingerprint of the day rendered for Moment.FORECAST, tomorrow."""
+        return cls.from_item(report.forecast.forecastday[1])
+
+    @classmethod
+    def from_database(cls, value: list | None) -> Optional['ForecastFingerprint']:
+        """Fingerprint of the users.last_forecast column, None when empty or written by another version."""
+        if not value or len(value) != len(cls._fields):
+            return None
+        return cls(*value)
+
+    def to_database(self) -> list:
+        return list(self)
+
+
+class ChangeDetector:
+    """
+    Decides whether a forecast differs enough from the last one delivered to the user to be sent again.
+    """
+
+    def __init__(self, temp_threshold: Optional[float] = None, sun_threshold: Optional[float] = None):
+        """
+        :param temp_threshold: Degrees the max or min temperature must move (defaults to NOTIFY_TEMP_THRESHOLD)
+        :param sun_threshold: Minutes the sunrise or sunset must move (defaults to NOTIFY_SUN_THRESHOLD)
+        """
+        self.temp_threshold = temp_threshold if temp_threshold is not None else shared.constants.NOTIFY_TEMP_THRESHOLD
+        self.sun_threshold = sun_threshold if sun_threshold is not None else shared.constants.NOTIFY_SUN_THRESHOLD
+
+    def _sun_moved(self, previous: str, current: str) -> bool:
+        previous_minutes, current_minutes = _minutes(previous), _minutes(current)
+        if previous_minutes is None or current_minutes is None:
+            return previous != current
+        # Shortest way around the clock, the time is local to the user
+        delta = abs(current_minutes - previous_minutes)
+        return min(delta, 24 * 60 - delta) >= self.sun_threshold
+
+    def changed(self, previous: Optional[ForecastFingerprint], current: ForecastFingerprint) -> bool:
+        """True when the user has no delivered forecast yet or the current one is meaningfully different."""
+        if previous is None:
+            return True
+        return (
+            previous.condition != current.condition
+            or abs(current.maxtemp_c - previous.maxtemp_c) >= self.temp_threshold
+            or abs(current.mintemp_c - previous.mintemp_c) >= self.temp_threshold
+            or self._sun_moved(previous.sunrise, current.sunrise)
+            or self._sun_moved(previous.sunset, current.sunset)
+        )
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Optional
+
+from psycopg2.extras import Json, execute_values
+
+import shared.constants
+from database.database import DatabaseConnector
+
+logger = logging.getLogger(__name__)
+
+SENT = 'sent'
+FAILED = 'failed'
+# Not sent because the forecast did not change since the last delivery, counts as delivered
+SKIPPED = 'skipped'
+
+
+class DeliveryLedger:
+    """
+    Per-run record of the delivery status of every chat.
+
+    Statuses are buffered and written every `flush_size` deliveries, each write is a checkpoint of the run. A run
+    restarted with the same run_id only reads the users not marked as sent or skipped (see
+    DatabaseConnector.iter_users undelivered_in), so delivered users are skipped and failed ones retried. Only the
+    deliveries since the last checkpoint can be sent twice after a crash.
+
+    The fingerprint of a delivered forecast is written to users.last_forecast by the same checkpoint.
+    """
+
+    def __init__(self, db_connector: DatabaseConnector, run_id: str, flush_size: Optional[int] = None):
+        self.db_connector = db_connector
+        self.run_id = run_id
+        self.flush_size = flush_size or shared.constants.LEDGER_FLUSH_SIZE
+        self._pending: list[tuple[str, str, str, Optional[str], Optional[list]]] = []
+        self._lock = asyncio.Lock()
+
+    def start_run(self) -> dict[str, int]:
+        """Register the run, returns its progress so far (empty for a new run)."""
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO report_runs (run_id) VALUES (%s)
+                ON CONFLICT (run_id) DO UPDATE SET finished_at = NULL
+            ''', (self.run_id,))
+        return self.progress()
+
+    def progress(self) -> dict[str, int]:
+        """Number of chats per status in the run."""
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                'SELECT status, count(*) FROM delivery_ledger WHERE run_id = %s GROUP BY status',
+                (self.run_id,),
+            )
+            return dict(cursor.fetchall())
+
+    def write(self, entries: list[tuple[str, str, str, Optional[str], Optional[list]]]) -> None:
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            execute_values(cursor, '''
+                INSERT INTO delivery_ledger (run_id, chat_id, status, error) VALUES %s
+                ON CONFLICT (run_id, chat_id) DO UPDATE
+                SET status = EXCLUDED.status, error = EXCLUDED.error,
+                    attempts = delivery_ledger.attempts + 1, updated_at = now()
+            ''', [entry[:4] for entry in entries])
+            fingerprints = [(chat_id, Json(fingerprint)) for _, chat_id, _, _, fingerprint in entries if fingerprint]
+            if fingerprints:
+                execute_values(cursor, '''
+                    UPDATE users SET last_forecast = v.last_forecast
+                    FROM (VALUES %s) AS v (chat_id, last_forecast)
+                    WHERE users.chat_id = v.chat_id
+                ''', fingerprints, template='(%s, %s::jsonb)')
+            cursor.execute('UPDATE report_runs SET checkpoint_at = now() WHERE run_id = %s', (self.run_id,))
+
+    def finish_run(self) -> None:
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('UPDATE report_runs SET finished_at = now() WHERE run_id = %s', (self.run_id,))
+
+    async def record(
+            self,
+            chat_id,
+            status: str,
+            error: Optional[str] = None,
+            fingerprint: Optional[list] = None,
+    ) -> None:
+        """
+        Buffer the status of the chat, writing a checkpoint once `flush_size` statuses are pending.
+
+        :param fingerprint: Fingerprint of the forecast delivered, see ForecastFingerprint.to_database
+        """
+        self._pending.append((self.run_id, str(chat_id), status, error, fingerprint))
+        if len(self._pending) >= self.flush_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+            # A chat can only appear once per statement with ON CONFLICT DO UPDATE, the last status wins
+            entries = list({entry[1]: entry for entry in self._pending}.values())
+            self._pending = []
+            try:
+                await asyncio.to_thread(self.write, entries)
+            except Exception as e:
+                # Keep them for the next checkpoint, the sends must not stop because of the ledger
+                logger.error(f"Failed to write the delivery ledger of run {self.run_id}: {e}")
+                self._pending = entries + self._pending
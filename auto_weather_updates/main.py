@@ -1,29 +1,126 @@
-from telegram import Bot
+"""
+Serverless entry point of the automatic reports, for functions-framework:
 
-from google_connector.sm import LazySecret
-from shared.utils import Moment
-from weather_api.transformer import WeatherTransformer
-from weather_api.weather_api_connector import WeatherAPIConnector
+    functions-framework --source auto_weather_updates/main.py --target send_forecasts
+
+Only the standard library is imported with the module. Telegram, pydantic, psycopg2 and httpx are imported by the
+first invocation, and everything it builds (bot token, bot, connectors, connection pool, event loop) is kept in the
+module for the next invocations of the same instance. See benchmarks/bench_cold_start.py for the import profile.
+"""
+import functools
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Built by the first invocation, reused while the instance stays warm
+_runtime = None
+# An event loop runs one coroutine at a time, concurrent invocations of an instance (eg: --concurrency above 1) queue
+_runtime_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def gcp_project() -> str:
+    """
+    Project of the secrets: GOOGLE_CLOUD_PROJECT when set, the project of the default credentials otherwise.
+
+    The current functions runtimes no longer set GOOGLE_CLOUD_PROJECT, google.auth finds the project of the instance
+    on the metadata server.
+    """
+    project = os.environ.get('GOOGLE_CLOUD_PROJECT')
+    if project:
+        return project
+
+    import google.auth
+
+    _, project = google.auth.default()
+    if not project:
+        raise RuntimeError(
+            "The Google Cloud project can't be found from the default credentials, set GOOGLE_CLOUD_PROJECT"
+        )
+    return project
+
+
+@functools.lru_cache(maxsize=None)
+def get_secret(secret_id: str, version: str | int = 'latest') -> str:
+    """
+    Read a secret from Secret Manager, once per instance.
+
+    The project is resolved by gcp_project.
+    """
+    from google.cloud import secretmanager
+
+    client = secretmanager.SecretManagerServiceClient()
+    name = f"projects/{gcp_project()}/secrets/{secret_id}/versions/{version}"
+    return client.access_secret_version(name=name).payload.data.decode()
+
+
+def telegram_token() -> str:
+    """TEL_API_KEY when set, skipping the Secret Manager round trip, the telegram-api-secret secret otherwise."""
+    return os.environ.get('TEL_API_KEY') or get_secret('telegram-api-secret', 1)
+
+
+class _Runtime:
+    """The objects of a warm instance, they all belong to `loop`."""
+
+    def __init__(self):
+        import asyncio
+
+        from telegram.ext import Application
+
+        from auto_weather_updates.automatic_reports import AutomaticReports
+        from database.async_database import AsyncDatabaseConnector
+        from database.database import DatabaseConnector
+        from shared.telegram_limiter import rate_limiter_from_env
+        from shared.telegram_request import InstrumentedRequest
+
+        # The bot and WeatherAPI http clients are bound to the loop that opened their connections, running every
+        # invocation on the same loop keeps them alive between invocations
+        self.loop = asyncio.new_event_loop()
+        application = (
+            Application.builder()
+            .token(telegram_token())
+            .request(InstrumentedRequest(connection_pool_size=256))
+            .rate_limiter(rate_limiter_from_env(DatabaseConnector.from_env()))
+            .build()
+        )
+        self.automatic_reports = AutomaticReports(application, 'http://api.weatherapi.com/v1')
+        self.db_connector = AsyncDatabaseConnector.from_env()
+
+    async def send_reports(self):
+        from auto_weather_updates.automatic_reports import default_run_id
+
+        # Cached on the connection pool, only the first invocation checks the migrations
+        await self.db_connector.ensure_schema()
+        return await self.automatic_reports.send_subscriber_reports(self.db_connector, default_run_id())
+
+
+def get_runtime() -> _Runtime:
+    """The runtime of the instance, built on first use. Hold _runtime_lock while using it."""
+    global _runtime
+    if _runtime is None:
+        _runtime = _Runtime()
+    return _runtime
+
+
+def send_forecasts(request=None) -> tuple[str, int]:
+    """
+    HTTP function sending the forecast to every subscriber (eg: triggered by Cloud Scheduler).
+
+    Invoking it again the same day resumes the run of the day, the users already delivered are skipped. Invocations
+    served concurrently by the same instance run one after the other on its event loop, the later ones only resume
+    what is left of the run.
+    """
+    with _runtime_lock:
+        runtime = get_runtime()
+        report = runtime.loop.run_until_complete(runtime.send_reports())
+    return report.summary(), 200
 
 
 def main():
-    # Prepare the bot and transformer
-    lazystring = LazySecret('')
-    tel_token = lazystring.get_secret('telegram-api-secret', 1)
-    bot = Bot(token=tel_token)
-
-    connector = WeatherAPIConnector(url='http://api.weatherapi.com/v1')
-    transformer = WeatherTransformer(connector=connector)
-
-    # TODO: get data from db to perform the auto updates
-    #  mainly chat_id is important here. Gather a list of all chat_ids to send the update to. Also the coordinates are crucial.
-    chat_ids: list = []
-    # Concatenate the latitude + the longitude and formatted correctly
-    coordinates = ""
-    for chat_id in chat_ids:
-        message = transformer.transform(coordinates=coordinates, moment=Moment.FORECAST)
-        bot.send_message(chat_id=chat_id, text=message)
-    return
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    print(send_forecasts()[0])
 
 
 if __name__ == "__main__":
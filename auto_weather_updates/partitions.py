@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import socket
+from typing import Optional
+
+import shared.constants
+from database.database import DatabaseConnector
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class PartitionLeases:
+    """
+    DB-backed leases over the partitions of a report run.
+
+    The subscribers are split into `partition_count` partitions by chat_id hash. A worker claims a free partition,
+    sends its reports while renewing the lease, then marks it completed. A partition whose lease expired (the worker
+    died or hung) can be claimed by any other worker, so adding workers shortens the run and a lost worker doesn't
+    leave users out.
+    """
+
+    def __init__(
+            self,
+            db_connector: DatabaseConnector,
+            run_id: str,
+            partition_count: Optional[int] = None,
+            worker_id: Optional[str] = None,
+            lease_seconds: Optional[float] = None,
+    ):
+        self.db_connector = db_connector
+        self.run_id = run_id
+        self.partition_count = partition_count or shared.constants.DISPATCH_PARTITIONS
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds or shared.constants.DISPATCH_LEASE_SECONDS
+
+    def create_run(self) -> None:
+        """Create the partitions of the run, a no-op when another worker already did."""
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO dispatch_leases (run_id, partition_index, partition_count)
+                SELECT %s, partition_index, %s FROM generate_series(0, %s - 1) AS partition_index
+                ON CONFLICT (run_id, partition_index) DO NOTHING
+            ''', (self.run_id, self.partition_count, self.partition_count))
+
+    def claim(self) -> Optional[int]:
+        """Claim a free or expired partition of the run, None when there is none to claim right now."""
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                UPDATE dispatch_leases
+                SET owner = %s, expires_at = now() + make_interval(secs => %s)
+                WHERE (run_id, partition_index) = (
+                    SELECT run_id, partition_index FROM dispatch_leases
+                    WHERE run_id = %s AND completed_at IS NULL AND (expires_at IS NULL OR expires_at < now())
+                    ORDER BY partition_index
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING partition_index
+            ''', (self.worker_id, self.lease_seconds, self.run_id))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def renew(self, partition_index: int) -> bool:
+        """Extend the lease, False when the partition was taken over by another worker."""
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                UPDATE dispatch_leases SET expires_at = now() + make_interval(secs => %s)
+                WHERE run_id = %s AND partition_index = %s AND owner = %s AND completed_at IS NULL
+            ''', (self.lease_seconds, self.run_id, partition_index, self.worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, partition_index: int) -> None:
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                UPDATE dispatch_leases SET completed_at = now()
+                WHERE run_id = %s AND partition_index = %s AND owner = %s
+            ''', (self.run_id, partition_index, self.worker_id))
+
+    def pending(self) -> int:
+        """Number of partitions of the run not completed yet, claimed or not."""
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                'SELECT count(*) FROM dispatch_leases WHERE run_id = %s AND completed_at IS NULL',
+                (self.run_id,),
+            )
+            return cursor.fetchone()[0]
+
+    async def keep_alive(self, partition_index: int, task: asyncio.Task) -> None:
+        """
+        Renew the lease until `task` finishes, cancels it if the lease is lost so two workers never keep sending the
+        same partition.
+        """
+        while not task.done():
+            await asyncio.sleep(self.lease_seconds / 3)
+            if task.done():
+                return
+            try:
+                renewed = await asyncio.to_thread(self.renew, partition_index)
+            except Exception as e:
+                # A short database hiccup shouldn't stop the sends, the lease is still valid for a while
+                logger.warning(f"Failed to renew the lease of partition {partition_index}: {e}")
+                continue
+            if not renewed:
+                logger.error(f"Lost the lease of partition {partition_index} of run {self.run_id}, stopping it")
+                task.cancel()
+                return
@@ -0,0 +1,218 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import os
+import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from telegram.ext import Application
+
+import shared.constants
+from auto_weather_updates.automatic_reports import AutomaticReports
+from database.async_database import AsyncDatabaseConnector
+from database.database import DatabaseConnector, batched
+from shared.metrics import REGISTRY, start_exporters
+from shared.telegram_limiter import rate_limiter_from_env
+from shared.telegram_request import InstrumentedRequest
+from shared.utils import Moment
+
+logger = logging.getLogger(__name__)
+
+UTC = datetime.timezone.utc
+
+# Subscribers eligible for the automatic reports
+ELIGIBLE = {'agreement': True, 'subscription': True, 'active': True}
+
+
+def scheduled_run_id(tz_id: str, local_date: datetime.date) -> str:
+    """Ledger run of the reports of a timezone for a local day."""
+    return f'forecast-{tz_id}-{local_date.isoformat()}'
+
+
+class ReportScheduler:
+    """
+    Long-running sender of the automatic reports at a local time of day in every timezone of the subscribers.
+
+    A heap holds the next delivery of each timezone as (UTC instant, tz_id, local date). The scheduler sleeps until the
+    earliest one, sends the reports of the subscribers in that timezone and pushes its delivery of the next day, so the
+    WeatherAPI and Telegram load is spread over the day instead of hitting every subscriber at once. Timezones due at
+    the same instant are sent one after another, each run staying within the Telegram rate limits on its own.
+
+    Each delivery is a ledger run (see scheduled_run_id), so a delivery missed by less than `catch_up` seconds when the
+    scheduler (re)starts is sent right away, and users it already delivered are skipped.
+
+    The forecasts of a timezone are prewarmed in the background `prewarm_lead` seconds before its delivery, so the run
+    itself only renders and sends.
+    """
+
+    def __init__(
+            self,
+            automatic_reports: AutomaticReports,
+            db_connector: AsyncDatabaseConnector,
+            delivery_time: datetime.time | None = None,
+            refresh_interval: float | None = None,
+            catch_up: float | None = None,
+            prewarm_lead: float | None = None,
+    ):
+        """
+        :param delivery_time: Local time of the reports (defaults to SCHEDULE_DELIVERY_TIME)
+        :param refresh_interval: Seconds between looks for new subscribers and timezones (defaults to SCHEDULE_REFRESH_INTERVAL)
+        :param catch_up: Seconds a missed delivery is still sent after its time (defaults to SCHEDULE_CATCH_UP)
+        :param prewarm_lead: Seconds before a delivery its forecasts are prewarmed (defaults to PREWARM_LEAD)
+        """
+        self.automatic_reports = automatic_reports
+        self.db_connector = db_connector
+        self.delivery_time = delivery_time or datetime.time.fromisoformat(shared.constants.SCHEDULE_DELIVERY_TIME)
+        self.refresh_interval = refresh_interval or shared.constants.SCHEDULE_REFRESH_INTERVAL
+        self.catch_up = datetime.timedelta(
+            seconds=catch_up if catch_up is not None else shared.constants.SCHEDULE_CATCH_UP
+        )
+        self.prewarm_lead = datetime.timedelta(
+            seconds=prewarm_lead if prewarm_lead is not None else shared.constants.PREWARM_LEAD
+        )
+        self._heap: list[tuple[datetime.datetime, str, datetime.date]] = []
+        self._scheduled: set[str] = set()
+        self._prewarming: dict[tuple[str, datetime.date], asyncio.Task] = {}
+
+    def delivery_at(self, tz_id: str, local_date: datetime.date) -> datetime.datetime:
+        """UTC instant of the delivery of the local day in the timezone."""
+        local = datetime.datetime.combine(local_date, self.delivery_time, tzinfo=ZoneInfo(tz_id))
+        return local.astimezone(UTC)
+
+    def schedule(self, tz_id: str, now: datetime.datetime) -> None:
+        """Add the timezone to the heap, with the first delivery not older than the catch-up window."""
+        # From yesterday's delivery, still within the window when eg: a 23:30 delivery is missed at 00:10
+        local_date = now.astimezone(ZoneInfo(tz_id)).date() - datetime.timedelta(days=1)
+        while self.delivery_at(tz_id, local_date) < now - self.catch_up:
+            local_date += datetime.timedelta(days=1)
+        heapq.heappush(self._heap, (self.delivery_at(tz_id, local_date), tz_id, local_date))
+        self._scheduled.add(tz_id)
+
+    async def resolve_timezones(self) -> int:
+        """
+        Fill the timezone of the subscribers who don't have one yet, from the WeatherAPI location of their coordinates.
+
+        Lookups go through the transformer cache, so users sharing a location cell cost a single request.
+
+        :return: the number of users updated
+        """
+        locations = await self.db_connector.read_unresolved_locations(**ELIGIBLE)
+        transformer = self.automatic_reports.transformer
+        semaphore = asyncio.Semaphore(shared.constants.DISPATCH_MAX_FETCHES)
+
+        async def resolve(latitude: float, longitude: float) -> tuple[float, float, str] | None:
+            async with semaphore:
+                try:
+                    report = await transformer.get_data_async(latitude, longitude, Moment.CURRENT)
+                except Exception as e:
+                    logger.warning(f"Failed to resolve the timezone of {latitude},{longitude}: {e}")
+                    return None
+            return latitude, longitude, report.location.tz_id
+
+        updated = 0
+        for batch in batched(locations, shared.constants.DB_BATCH_SIZE):
+            resolved = await asyncio.gather(*(resolve(latitude, longitude) for latitude, longitude in batch))
+            updated += await self.db_connector.set_timezones([timezone for timezone in resolved if timezone])
+        if updated:
+            logger.info(f"Resolved the timezone of {updated} users")
+        return updated
+
+    async def refresh(self) -> None:
+        """Resolve the new subscribers and schedule the timezones not scheduled yet."""
+        await self.resolve_timezones()
+        now = datetime.datetime.now(UTC)
+        for tz_id in await self.db_connector.read_timezones(**ELIGIBLE):
+            if tz_id in self._scheduled:
+                continue
+            try:
+                self.schedule(tz_id, now)
+            except (ZoneInfoNotFoundError, ValueError) as e:
+                logger.error(f"Unknown timezone {tz_id}, its users won't get automatic reports: {e}")
+                self._scheduled.add(tz_id)
+        REGISTRY.inc('scheduler_refreshes_total')
+
+    def start_prewarms(self, now: datetime.datetime) -> datetime.datetime | None:
+        """Start prewarming the deliveries due within the lead, returns when the next prewarm is due."""
+        next_prewarm = None
+        for delivery, tz_id, local_date in self._heap:
+            if (tz_id, local_date) in self._prewarming:
+                continue
+            if delivery - self.prewarm_lead <= now:
+                self._prewarming[(tz_id, local_date)] = asyncio.create_task(
+                    self.automatic_reports.prewarm(self.db_connector, tz_id=tz_id)
+                )
+            elif next_prewarm is None or delivery - self.prewarm_lead < next_prewarm:
+                next_prewarm = delivery - self.prewarm_lead
+        return next_prewarm
+
+    async def deliver(self, tz_id: str, local_date: datetime.date) -> None:
+        run_id = scheduled_run_id(tz_id, local_date)
+        prewarm = self._prewarming.pop((tz_id, local_date), None)
+        if prewarm is not None:
+            # Still fetching when the delivery is due, the run would fetch the same cells
+            await prewarm
+        try:
+            await self.automatic_reports.send_subscriber_reports(self.db_connector, run_id, tz_id=tz_id)
+        except Exception as e:
+            # The next day is still scheduled, restarting within the catch-up window resumes this one
+            logger.error(f"Scheduled run {run_id} failed: {e}")
+
+    async def run(self) -> None:
+        """Send the reports forever, one timezone at a time as they become due."""
+        await self.db_connector.ensure_schema()
+        next_refresh = 0.0
+        while True:
+            if time.monotonic() >= next_refresh:
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    # Keep sending the timezones already scheduled, the next refresh retries
+                    logger.error(f"Failed to refresh the report schedule: {e}")
+                next_refresh = time.monotonic() + self.refresh_interval
+
+            now = datetime.datetime.now(UTC)
+            next_prewarm = self.start_prewarms(now)
+            if self._heap and self._heap[0][0] <= now:
+                delivery, tz_id, local_date = heapq.heappop(self._heap)
+                lag = (now - delivery).total_seconds()
+                logger.info(f"Sending the reports of {tz_id} for {local_date}, {lag:.0f}s after their time")
+                await self.deliver(tz_id, local_date)
+                next_date = local_date + datetime.timedelta(days=1)
+                heapq.heappush(self._heap, (self.delivery_at(tz_id, next_date), tz_id, next_date))
+                continue
+
+            wait = next_refresh - time.monotonic()
+            if self._heap:
+                wait = min(wait, (self._heap[0][0] - now).total_seconds())
+            if next_prewarm is not None:
+                wait = min(wait, (next_prewarm - now).total_seconds())
+            await asyncio.sleep(max(wait, 0))
+
+
+def main() -> None:
+    """Run the scheduler until the process is stopped."""
+    tel_token = os.environ.get("TEL_API_KEY", None)
+    application = (
+        Application.builder()
+        .token(tel_token)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(rate_limiter_from_env(DatabaseConnector.from_env()))
+        .build()
+    )
+    start_exporters()
+
+    automatic_reports = AutomaticReports(application, 'http://api.weatherapi.com/v1')
+
+    async def run() -> None:
+        db_connector = AsyncDatabaseConnector.from_env()
+        try:
+            await ReportScheduler(automatic_reports, db_connector).run()
+        finally:
+            await automatic_reports.close(db_connector)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
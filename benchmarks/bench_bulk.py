@@ -0,0 +1,55 @@
+"""
+Requests and wall time to fetch the forecast of many locations, single requests vs WeatherAPI bulk requests.
+
+Runs against benchmarks.fakes.FakeWeatherAPI, --no-bulk makes it refuse bulk requests to measure the fallback.
+
+    python -m benchmarks.bench_bulk --locations 1000 --latency 0.1
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.fakes import FakeWeatherAPI
+from weather_api.weather_api_connector import WeatherAPIConnector
+
+
+async def singles(connector: WeatherAPIConnector, locations: list[str]) -> int:
+    semaphore = asyncio.Semaphore(connector.max_connections)
+
+    async def fetch(location: str) -> dict:
+        async with semaphore:
+            return await connector.get_forecast_async(location)
+
+    return len(await asyncio.gather(*(fetch(location) for location in locations)))
+
+
+async def bulk(connector: WeatherAPIConnector, locations: list[str]) -> int:
+    return len(await connector.get_forecasts_bulk_async(locations))
+
+
+async def run(args) -> None:
+    locations = [f'{random.uniform(-60, 60):.4f},{random.uniform(-180, 180):.4f}' for _ in range(args.locations)]
+
+    with FakeWeatherAPI(args.latency, bulk=not args.no_bulk) as weather:
+        for name, fetch in (('single', singles), ('bulk', bulk)):
+            connector = WeatherAPIConnector(url=weather.url)
+            requests_before = weather.requests
+            start = time.perf_counter()
+            fetched = await fetch(connector, locations)
+            elapsed = time.perf_counter() - start
+            await connector.aclose()
+            print(f'{name:8} {fetched} forecasts in {elapsed:6.2f}s with {weather.requests - requests_before} requests')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--locations', type=int, default=1_000)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds per WeatherAPI request')
+    parser.add_argument('--no-bulk', action='store_true', help='the API refuses bulk requests')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
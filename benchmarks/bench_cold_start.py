@@ -0,0 +1,86 @@
+"""
+Cold start of the serverless entry point: import time profile of auto_weather_updates.main and of the modules its
+first invocation imports.
+
+Every measure runs in a fresh interpreter with `python -X importtime`, like a new instance would. The entry point
+import is the part every cold start pays before the request is even routed, --budget-ms makes the benchmark fail when
+it gets over budget (eg: a heavy module imported at the top of main.py again).
+
+    python -m benchmarks.bench_cold_start --runs 5 --top 15 --budget-ms 50
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+ENTRY_POINT = 'auto_weather_updates.main'
+
+# Imported by the first invocation of the entry point
+RUNTIME_MODULES = (
+    'telegram.ext',
+    'shared.telegram_request',
+    'database.async_database',
+    'auto_weather_updates.automatic_reports',
+)
+
+
+def import_profile(module: str) -> dict[str, tuple[int, int]]:
+    """Import the module in a fresh interpreter, returns the (self, cumulative) microseconds of every module imported."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}:\n{result.stderr.strip().splitlines()[-1]}")
+
+    profile = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        profile[name.strip()] = (int(self_us), int(cumulative_us))
+    return profile
+
+
+def measure(module: str, runs: int) -> tuple[float, dict[str, tuple[int, int]]]:
+    """Median import time of the module in ms over the runs, and the profile of the last run."""
+    totals = []
+    for _ in range(runs):
+        profile = import_profile(module)
+        totals.append(profile[module][1] / 1000)
+    return statistics.median(totals), profile
+
+
+def print_top(profile: dict[str, tuple[int, int]], top: int) -> None:
+    for name, (self_us, cumulative_us) in sorted(profile.items(), key=lambda item: -item[1][1])[:top]:
+        print(f'    {cumulative_us / 1000:8.1f}ms cumulative {self_us / 1000:8.1f}ms self  {name.strip()}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per module, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules listed per profile')
+    parser.add_argument('--budget-ms', type=float, help='fail when the entry point import takes longer')
+    args = parser.parse_args()
+
+    entry_ms, profile = measure(ENTRY_POINT, args.runs)
+    print(f'{ENTRY_POINT}: {entry_ms:.1f}ms, {len(profile)} modules')
+    print_top(profile, args.top)
+
+    print('First invocation imports:')
+    for module in RUNTIME_MODULES:
+        try:
+            module_ms, profile = measure(module, args.runs)
+        except RuntimeError as e:
+            print(f'  {module}: {e}')
+            continue
+        print(f'  {module}: {module_ms:.1f}ms, {len(profile)} modules')
+        print_top(profile, args.top)
+
+    if args.budget_ms is not None and entry_ms > args.budget_ms:
+        sys.exit(f'{ENTRY_POINT} import takes {entry_ms:.1f}ms, over the {args.budget_ms:.1f}ms budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+End-to-end benchmark of the automatic reports run and the Telegram handlers, against local stand-ins.
+
+WeatherAPI and the Telegram Bot API are replaced by the fakes of benchmarks.fakes, so it runs offline. The users are
+synthetic and spread over --cells locations. By default they are handed to send_reports in memory. With --db they
+are seeded into the Postgres configured through the DB_* variables and read back like in production, then deleted.
+
+With --webhook the location updates are posted over HTTP to a local telegram_bot.webhook receiver instead of being
+handed to process_update directly.
+
+    python -m benchmarks.bench_e2e --users 5000 --cells 200 --weather-latency 0.05 --telegram-latency 0.02
+"""
+import argparse
+import asyncio
+import logging
+import random
+import resource
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+from auto_weather_updates.automatic_reports import AutomaticReports
+from benchmarks.fakes import FakeTelegramAPI, FakeWeatherAPI
+from shared.models import UserRow
+from telegram_bot.state import ConversationState, FileStateBackend
+from telegram_bot.telegram_bot import TelegramBot
+from telegram_bot.webhook import SECRET_TOKEN_HEADER, WebhookServer
+
+CHAT_ID_OFFSET = 900_000_000
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest recording the latency of every Bot API call, per method."""
+
+    def __init__(self, latencies: dict[str, list[float]], **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = latencies
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            self.latencies[url.rsplit('/', 1)[-1]].append(time.perf_counter() - start)
+
+
+def synthetic_users(count: int, cells: int) -> list[UserRow]:
+    centers = [(random.uniform(-60, 60), random.uniform(-180, 180)) for _ in range(cells)]
+    users = []
+    for index in range(count):
+        latitude, longitude = random.choice(centers)
+        users.append(UserRow(str(CHAT_ID_OFFSET + index), latitude, longitude, True, True, True))
+    return users
+
+
+def percentiles(samples: list[float]) -> str:
+    if len(samples) < 2:
+        return 'n/a'
+    cuts = statistics.quantiles(samples, n=100)
+    return f'p50 {cuts[49] * 1000:7.1f}ms  p95 {cuts[94] * 1000:7.1f}ms  p99 {cuts[98] * 1000:7.1f}ms'
+
+
+def location_update(update_id: int, user: UserRow) -> dict:
+    chat_id = int(user.chat_id)
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'},
+            'location': {'latitude': user.latitude, 'longitude': user.longitude},
+        },
+    }
+
+
+async def run_reports(application: Application, weather_url: str, users: list[UserRow], args) -> None:
+    automatic_reports = AutomaticReports(
+        application,
+        weather_url,
+        global_rate=args.global_rate,
+        chat_rate=args.chat_rate,
+    )
+    if args.db:
+        from database.database import DatabaseConnector
+
+        # A run of its own, the ledger of the day would skip the users delivered by a previous benchmark
+        run_id = f'benchmark-{time.time_ns()}'
+        db_connector = DatabaseConnector.from_env()
+        db_connector.ensure_schema()
+        db_connector.insert_users(users)
+        try:
+            report = await automatic_reports.send_reports(run_id=run_id)
+        finally:
+            with db_connector.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute('DELETE FROM users WHERE chat_id = ANY(%s)', ([user.chat_id for user in users],))
+                cursor.execute('DELETE FROM delivery_ledger WHERE run_id = %s', (run_id,))
+                cursor.execute('DELETE FROM report_runs WHERE run_id = %s', (run_id,))
+    else:
+        report = await automatic_reports.send_reports(users)
+
+    print(f'send_reports      {report.summary()}')
+
+
+async def run_handlers(application: Application, users: list[UserRow], args) -> None:
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def process(update_id: int, user: UserRow) -> None:
+        async with semaphore:
+            update = Update.de_json(location_update(update_id, user), application.bot)
+            start = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(process(index, random.choice(users)) for index in range(args.updates)))
+    elapsed = time.perf_counter() - start
+    print(f'handle_location   {args.updates} updates in {elapsed:.1f}s ({args.updates / elapsed:.1f} updates/s)')
+    print(f'                  {percentiles(latencies)}')
+
+
+async def run_webhook(application: Application, users: list[UserRow], args) -> None:
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    secret_token = 'benchmark'
+    server = WebhookServer(
+        application, host='127.0.0.1', port=0, path='/webhook', secret_token=secret_token, workers=args.workers
+    )
+
+    async with server, httpx.AsyncClient(headers={SECRET_TOKEN_HEADER: secret_token}) as client:
+        async def post(update_id: int, user: UserRow) -> None:
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(server.url, json=location_update(update_id, user))
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(index, random.choice(users)) for index in range(args.updates)))
+        acknowledged = time.perf_counter() - start
+        await server.join()
+        elapsed = time.perf_counter() - start
+
+    print(f'webhook           {args.updates} updates acknowledged in {acknowledged:.1f}s, processed in {elapsed:.1f}s '
+          f'({args.updates / elapsed:.1f} updates/s)')
+    print(f'                  ack {percentiles(latencies)}')
+
+
+async def run(args) -> None:
+    users = synthetic_users(args.users, args.cells)
+    latencies: dict[str, list[float]] = defaultdict(list)
+
+    with FakeWeatherAPI(args.weather_latency, args.weather_error_rate) as weather, \
+            FakeTelegramAPI(args.telegram_latency, args.telegram_error_rate) as telegram:
+        application = (
+            Application.builder()
+            .token('123456:benchmark')
+            .base_url(f'{telegram.url}/bot')
+            .request(TimedRequest(latencies, connection_pool_size=256))
+            .build()
+        )
+        # Postgres when the users are, a throwaway directory otherwise
+        state = None if args.db else ConversationState(FileStateBackend(tempfile.mkdtemp(prefix='bench-state-')))
+        TelegramBot(application, weather.url, state)
+        await application.initialize()
+        try:
+            await run_reports(application, weather.url, users, args)
+            if args.updates and args.webhook:
+                await run_webhook(application, users, args)
+            elif args.updates:
+                await run_handlers(application, users, args)
+        finally:
+            await application.shutdown()
+
+        print(f'sendMessage       {percentiles(latencies["sendMessage"])}')
+        print(f'WeatherAPI        {weather.requests} requests, {weather.errors} errors')
+        print(f'Telegram          {telegram.requests} requests, {telegram.errors} flood waits')
+
+    # ru_maxrss is in KB on Linux
+    print(f'peak RSS          {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2_000)
+    parser.add_argument('--cells', type=int, default=100, help='distinct user locations')
+    parser.add_argument('--updates', type=int, default=500, help='location messages sent to the bot handlers')
+    parser.add_argument('--concurrency', type=int, default=50, help='updates processed at the same time')
+    parser.add_argument('--weather-latency', type=float, default=0.05)
+    parser.add_argument('--weather-error-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    parser.add_argument('--global-rate', type=float, default=1_000, help='messages/s, Telegram allows 30')
+    parser.add_argument('--chat-rate', type=float, default=1)
+    parser.add_argument('--db', action='store_true', help='seed and read the users through Postgres')
+    parser.add_argument('--webhook', action='store_true', help='post the updates to the webhook receiver')
+    parser.add_argument('--workers', type=int, default=16, help='webhook worker tasks')
+    args = parser.parse_args()
+
+    # The bot logs every location it receives
+    logging.getLogger().setLevel(logging.ERROR)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
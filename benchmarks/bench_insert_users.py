@@ -0,0 +1,77 @@
+"""
+Throughput of the single-row insert path against the bulk upsert path.
+
+Needs a reachable Postgres configured through the DB_* environment variables. The rows it writes use chat_ids prefixed
+with 'bench-' and are deleted at the end.
+
+    python -m benchmarks.bench_insert_users --rows 100000 --single-rows 2000
+"""
+import argparse
+import random
+import time
+
+from database.database import DatabaseConnector
+from shared.models import UserData
+
+CHAT_ID_PREFIX = 'bench-'
+
+
+def synthetic_users(count: int, offset: int = 0) -> list[UserData]:
+    return [
+        UserData(
+            chat_id=f'{CHAT_ID_PREFIX}{offset + index}',
+            latitude=random.uniform(-90, 90),
+            longitude=random.uniform(-180, 180),
+            agreement=True,
+            subscription=True,
+            active=True,
+        )
+        for index in range(count)
+    ]
+
+
+def cleanup(db_connector: DatabaseConnector) -> None:
+    with db_connector.pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute("DELETE FROM users WHERE chat_id LIKE %s", (f'{CHAT_ID_PREFIX}%',))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000, help='rows written with insert_users')
+    parser.add_argument('--single-rows', type=int, default=2_000, help='rows written one by one with insert_user')
+    parser.add_argument('--batch-size', type=int, default=None)
+    args = parser.parse_args()
+
+    db_connector = DatabaseConnector.from_env()
+    db_connector.create_table()
+    cleanup(db_connector)
+
+    try:
+        users = synthetic_users(args.single_rows)
+        start = time.perf_counter()
+        for user in users:
+            db_connector.insert_user(user)
+        single_elapsed = time.perf_counter() - start
+
+        users = synthetic_users(args.rows, offset=args.single_rows)
+        start = time.perf_counter()
+        db_connector.insert_users(users, batch_size=args.batch_size)
+        bulk_elapsed = time.perf_counter() - start
+
+        # Second pass over the same chat_ids measures the update side of the upsert
+        start = time.perf_counter()
+        db_connector.insert_users(users, batch_size=args.batch_size)
+        upsert_elapsed = time.perf_counter() - start
+    finally:
+        cleanup(db_connector)
+
+    single_rate = args.single_rows / single_elapsed
+    bulk_rate = args.rows / bulk_elapsed
+    print(f'insert_user            {args.single_rows:>9} rows {single_elapsed:8.2f}s {single_rate:>12,.0f} rows/s')
+    print(f'insert_users (insert)  {args.rows:>9} rows {bulk_elapsed:8.2f}s {bulk_rate:>12,.0f} rows/s')
+    print(f'insert_users (update)  {args.rows:>9} rows {upsert_elapsed:8.2f}s {args.rows / upsert_elapsed:>12,.0f} rows/s')
+    print(f'speedup                {bulk_rate / single_rate:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+CPU and allocations per WeatherAPI response parse, driven by tests/fixtures/sample_weather_api_response.json.
+
+Compares the previous path (response.json() then WeatherReport(**data)) with WeatherTransformer.parse, which
+validates the raw bytes straight into the models.
+
+    python -m benchmarks.bench_parse --iterations 2000
+"""
+import argparse
+import json
+import pathlib
+import time
+import tracemalloc
+
+from shared.models import CurrentReport, WeatherReport
+from shared.utils import Moment
+from weather_api.transformer import WeatherTransformer
+
+FIXTURE = pathlib.Path(__file__).resolve().parent.parent / 'tests' / 'fixtures' / 'sample_weather_api_response.json'
+
+
+def measure(parse, raw: bytes, iterations: int) -> tuple[float, float]:
+    """Return the microseconds per parse and the peak bytes allocated by one parse."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse(raw)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    parse(raw)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed / iterations * 1_000_000, peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2_000)
+    args = parser.parse_args()
+
+    raw = FIXTURE.read_bytes()
+    # What current.json returns: the same location and current conditions, without the forecast
+    data = json.loads(raw)
+    raw_current = json.dumps({'location': data['location'], 'current': data['current']}).encode()
+
+    cases = [
+        ('json.loads + WeatherReport(**data)', lambda body: WeatherReport(**json.loads(body)), raw),
+        ('WeatherReport.model_validate_json', lambda body: WeatherTransformer.parse(body, Moment.FORECAST), raw),
+        ('json.loads + CurrentReport(**data)', lambda body: CurrentReport(**json.loads(body)), raw_current),
+        ('CurrentReport.model_validate_json', lambda body: WeatherTransformer.parse(body, Moment.CURRENT), raw_current),
+    ]
+    print(f'forecast.json payload {len(raw):,} B, current.json payload {len(raw_current):,} B')
+    for name, parse, body in cases:
+        micros, peak = measure(parse, body, args.iterations)
+        print(f'{name:<38} {micros:10.1f} us/parse {peak:>12,} B peak')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Per-row cost of building users out of database rows: validated UserData against the UserRow fast path.
+
+Runs offline on synthetic rows shaped like the ones psycopg2 returns for database.database.USER_COLUMNS.
+
+    python -m benchmarks.bench_user_rows --rows 200000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from database.database import row_factory
+
+
+def synthetic_rows(count: int) -> list[tuple]:
+    return [
+        (str(100_000_000 + index), random.uniform(-90, 90), random.uniform(-180, 180), True, True, True)
+        for index in range(count)
+    ]
+
+
+def measure(rows: list[tuple], validate: bool) -> tuple[float, float]:
+    """Return the nanoseconds and the bytes allocated per row."""
+    make_user = row_factory(validate)
+
+    start = time.perf_counter_ns()
+    users = [make_user(row) for row in rows]
+    elapsed = time.perf_counter_ns() - start
+    del users
+
+    tracemalloc.start()
+    users = [make_user(row) for row in rows]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+
+    return elapsed / len(rows), allocated / len(rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200_000)
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.rows)
+    validated_ns, validated_bytes = measure(rows, validate=True)
+    fast_ns, fast_bytes = measure(rows, validate=False)
+
+    print(f'UserData.from_database {validated_ns:10,.0f} ns/row {validated_bytes:8,.0f} B/row')
+    print(f'UserRow._make          {fast_ns:10,.0f} ns/row {fast_bytes:8,.0f} B/row')
+    print(f'speedup                {validated_ns / fast_ns:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Local stand-ins for WeatherAPI and the Telegram Bot API, so the benchmarks run offline.
+
+Both servers listen on 127.0.0.1 on a free port and run in a background thread, one thread per request so the
+configured latency doesn't serialize concurrent clients.
+"""
+import json
+import pathlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURE = pathlib.Path(__file__).resolve().parent.parent / 'tests' / 'fixtures' / 'sample_weather_api_response.json'
+
+
+class _FakeServer:
+    """Base class of the fakes, subclasses implement handle(method, path, query, body) -> (status, payload)."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        """
+        :param latency: Seconds to wait before answering each request
+        :param error_rate: Fraction of the requests answered with an error
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server: ThreadingHTTPServer | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            failed = random.random() < self.error_rate
+            self.errors += failed
+            return failed
+
+    def handle(self, method: str, path: str, query: dict, body: bytes) -> tuple[int, bytes]:
+        raise NotImplementedError()
+
+    def start(self) -> '_FakeServer':
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self, method: str) -> None:
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                parsed = urlparse(self.path)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, payload = fake.handle(method, parsed.path, parse_qs(parsed.query), body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeWeatherAPI(_FakeServer):
+    """
+    Serves the sample fixture for forecast.json and its current conditions for current.json.
+
+    Bulk requests (POST forecast.json?q=bulk) get the fixture for every location, unless `bulk` is False: the API key
+    has no access to them then, like on the WeatherAPI free plan.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, bulk: bool = True):
+        super().__init__(latency, error_rate)
+        self.bulk = bulk
+        self.bulk_requests = 0
+        self.forecast = FIXTURE.read_bytes()
+        data = json.loads(self.forecast)
+        self.forecast_data = data
+        self.current = json.dumps({'location': data['location'], 'current': data['current']}).encode()
+
+    def handle_bulk(self, body: bytes) -> tuple[int, bytes]:
+        if not self.bulk:
+            return 403, b'{"error": {"code": 2009, "message": "API key does not have access to the resource."}}'
+        with self._lock:
+            self.bulk_requests += 1
+        locations = json.loads(body)['locations']
+        return 200, json.dumps({'bulk': [
+            {'query': {'custom_id': location.get('custom_id'), 'q': location['q'], **self.forecast_data}}
+            for location in locations
+        ]}).encode()
+
+    def handle(self, method: str, path: str, query: dict, body: bytes) -> tuple[int, bytes]:
+        if self.should_fail():
+            return 500, b'{"error": {"code": 9999, "message": "Internal application error."}}'
+        if path.endswith('/current.json'):
+            return 200, self.current
+        if path.endswith('/forecast.json') and query.get('q') == ['bulk']:
+            return self.handle_bulk(body)
+        if path.endswith('/forecast.json'):
+            return 200, self.forecast
+        return 404, b'{"error": {"code": 1005, "message": "API request url is invalid."}}'
+
+
+class FakeTelegramAPI(_FakeServer):
+    """
+    Answers the Bot API methods the bot uses, point the Application to it with base_url=f'{fake.url}/bot'.
+
+    Failed requests get a 429 flood wait of `retry_after` seconds, like Telegram does when a bot sends too fast.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 1):
+        super().__init__(latency, error_rate)
+        self.retry_after = retry_after
+        self.sent_messages = 0
+        self._message_id = 0
+
+    @staticmethod
+    def _params(body: bytes) -> dict:
+        """python-telegram-bot posts the parameters url-encoded, each value being json."""
+        if not body:
+            return {}
+        if body.lstrip().startswith(b'{'):
+            return json.loads(body)
+        params = {}
+        for key, values in parse_qs(body.decode()).items():
+            try:
+                params[key] = json.loads(values[0])
+            except ValueError:
+                params[key] = values[0]
+        return params
+
+    def handle(self, method: str, path: str, query: dict, body: bytes) -> tuple[int, bytes]:
+        endpoint = path.rsplit('/', 1)[-1]
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif endpoint in ('sendMessage', 'answerCallbackQuery'):
+            if self.should_fail():
+                return 429, json.dumps({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                }).encode()
+            if endpoint == 'answerCallbackQuery':
+                result = True
+            else:
+                params = self._params(body)
+                with self._lock:
+                    self._message_id += 1
+                    self.sent_messages += 1
+                    message_id = self._message_id
+                result = {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                    'text': str(params.get('text', '')),
+                }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
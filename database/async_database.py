@@ -0,0 +1,96 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterable
+
+from database.database import DatabaseConnector
+from shared.models import SubscriberRow, UserData, UserRow
+
+
+class AsyncDatabaseConnector:
+    """
+    Awaitable version of DatabaseConnector for the asyncio code (Telegram handlers, automatic reports).
+
+    Queries run in a thread pool with as many threads as the connection pool has connections, so a slow query only
+    holds a thread and never the event loop.
+    """
+
+    def __init__(self, db_connector: DatabaseConnector, max_workers: int | None = None):
+        self.db_connector = db_connector
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or db_connector.pool.max_size,
+            thread_name_prefix='database',
+        )
+
+    @classmethod
+    def from_env(cls) -> 'AsyncDatabaseConnector':
+        """Connector for the database configured through the DB_* environment variables."""
+        return cls(DatabaseConnector.from_env())
+
+    @property
+    def pool(self):
+        return self.db_connector.pool
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def ensure_schema(self) -> int:
+        return await self._run(self.db_connector.ensure_schema)
+
+    async def insert_user(self, user: UserData) -> None:
+        await self._run(self.db_connector.insert_user, user)
+
+    async def insert_users(self, users: Iterable[UserData | UserRow], batch_size: int | None = None) -> int:
+        return await self._run(self.db_connector.insert_users, users, batch_size)
+
+    async def user_exists(self, chat_id) -> bool:
+        return await self._run(self.db_connector.user_exists, chat_id)
+
+    async def update_user(self, chat_id, **kwargs) -> None:
+        await self._run(self.db_connector.update_user, chat_id, **kwargs)
+
+    async def delete_user(self, chat_id) -> None:
+        await self._run(self.db_connector.delete_user, chat_id)
+
+    async def read_users(self, validate: bool = True, **kwargs) -> list[UserData | UserRow]:
+        return await self._run(self.db_connector.read_users, validate, **kwargs)
+
+    async def read_timezones(self, **kwargs) -> list[str]:
+        return await self._run(self.db_connector.read_timezones, **kwargs)
+
+    async def read_locations(self, partition: tuple[int, int] | None = None, **kwargs) -> list[tuple[float, float]]:
+        return await self._run(self.db_connector.read_locations, partition, **kwargs)
+
+    async def read_unresolved_locations(self, **kwargs) -> list[tuple[float, float]]:
+        return await self._run(self.db_connector.read_unresolved_locations, **kwargs)
+
+    async def set_timezones(self, timezones: Iterable[tuple[float, float, str]]) -> int:
+        return await self._run(self.db_connector.set_timezones, timezones)
+
+    async def iter_users(
+            self,
+            batch_size: int | None = None,
+            validate: bool = True,
+            partition: tuple[int, int] | None = None,
+            undelivered_in: str | None = None,
+            with_last_forecast: bool = False,
+            located_only: bool = False,
+            **kwargs,
+    ) -> AsyncIterator[UserData | UserRow | SubscriberRow]:
+        """
+        Lazy version of read_users, each batch of the server-side cursor is fetched in the thread pool.
+        """
+        batches = self.db_connector.iter_user_batches(
+            batch_size, validate, partition, undelivered_in, with_last_forecast, located_only, **kwargs
+        )
+        try:
+            while (batch := await self._run(next, batches, None)) is not None:
+                for user in batch:
+                    yield user
+        finally:
+            # Releases the cursor and its connection when the consumer stops early
+            await self._run(batches.close)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
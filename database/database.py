@@ -1,8 +1,47 @@
-import psycopg2
-import os
-from shared.models import UserData
+import csv
+import io
+import itertools
+import uuid
+from typing import Iterable, Iterator
 
-# TODO: Use environment variables to store the database credentials
+from psycopg2.extras import execute_values
+
+import shared.constants
+from database.pool import ConnectionPool
+from database.schema import ensure_schema
+from shared.metrics import REGISTRY
+from shared.models import SubscriberRow, UserData, UserRow
+
+
+# Columns read for a user, in the order expected by UserData.from_database
+USER_COLUMNS = ('chat_id', 'latitude', 'longitude', 'agreement', 'subscription', 'active')
+
+
+def row_factory(validate: bool, last_forecast: bool = False):
+    """
+    Return the function building a user out of a database row.
+
+    :param last_forecast: The rows end with the last_forecast column
+    """
+    if validate:
+        return UserData.from_database
+    return SubscriberRow._make if last_forecast else UserRow._make
+
+
+# Insert a user or update it when the chat_id is already subscribed
+UPSERT_SET_CLAUSE = ', '.join(f'{column} = EXCLUDED.{column}' for column in USER_COLUMNS if column != 'chat_id')
+# A new location can be in another timezone, it's resolved again by the scheduler
+UPSERT_SET_CLAUSE += (
+    ', tz_id = CASE WHEN (users.latitude, users.longitude) IS NOT DISTINCT FROM (EXCLUDED.latitude, EXCLUDED.longitude)'
+    ' THEN users.tz_id END'
+)
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    """Split an iterable into lists of `size` items, the last one can be shorter."""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
 
 
 def generate_where_clause(filter_items: dict) -> str:
@@ -17,8 +56,40 @@ def generate_where_clause(filter_items: dict) -> str:
         return ""
 
 
+def generate_undelivered_condition(run_id: str) -> tuple[str, tuple]:
+    """
+    Condition selecting the users not delivered yet in the report run, see auto_weather_updates.ledger.
+
+    Users skipped because their forecast did not change count as delivered.
+    """
+    return '''NOT EXISTS (
+        SELECT 1 FROM delivery_ledger
+        WHERE delivery_ledger.run_id = %s AND delivery_ledger.chat_id = users.chat_id
+            AND delivery_ledger.status IN ('sent', 'skipped')
+    )''', (run_id,)
+
+
+# Users without a location can't be sent a forecast
+LOCATED_CONDITION = "latitude IS NOT NULL AND longitude IS NOT NULL", ()
+
+
+def generate_partition_condition(partition: tuple[int, int]) -> tuple[str, tuple]:
+    """
+    Condition selecting the users of the partition (index, count), users are spread over the partitions by chat_id hash.
+
+    hashtext is shifted into the positive range instead of using abs(), which overflows on the smallest int4.
+    """
+    index, count = partition
+    return "mod(hashtext(chat_id)::bigint + 2147483648, %s) = %s", (count, index)
+
+
 class DatabaseConnector:
-    def __init__(self, db_name, user, password, host, port):
+    def __init__(self, db_name, user, password, host, port, pool: ConnectionPool | None = None):
+        """
+        No connection is opened here, every query checks one out of the pool when it runs.
+
+        :param pool: Pool to use, defaults to the process-wide pool for these connection parameters
+        """
         self.db_params = {
             'dbname': db_name,
             'user': user,
@@ -26,61 +97,267 @@ class DatabaseConnector:
             'host': host,
             'port': port
         }
-        self.conn = psycopg2.connect(**self.db_params)
-        self.cursor = self.conn.cursor()
-
-    def _close(self):
-        self.conn.close()
-
-    def _commit_and_close(self):
-        self.conn.commit()
-        self._close()
-
-    def table_exists(self):
-        query = f"SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = '{self.db_params['dbname']}')"
-        self.cursor.execute(query)
-        return self.cursor.fetchone()[0]
+        self.pool = pool or ConnectionPool.for_params(**self.db_params)
+
+    @classmethod
+    def from_env(cls) -> 'DatabaseConnector':
+        """Connector for the database configured through the DB_* environment variables."""
+        return cls(
+            db_name=shared.constants.DB_NAME,
+            user=shared.constants.DB_USER,
+            password=shared.constants.DB_PASSWORD,
+            host=shared.constants.HOST,
+            port=shared.constants.PORT,
+        )
+
+    def ensure_schema(self) -> int:
+        """
+        Create or migrate the tables and indexes, meant to run once at startup.
+
+        The result is cached on the pool, so calling it again is free.
+        """
+        return ensure_schema(self.pool)
+
+    def table_exists(self, table_name: str = 'users'):
+        query = "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = %s)"
+        with REGISTRY.timer('db_query', method='table_exists'), self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (table_name,))
+            return cursor.fetchone()[0]
 
     def create_table(self):
         """Create a table if it doesn't exist"""
-
-        self.conn = psycopg2.connect(**self.db_params)
-        self.cursor = self.conn.cursor()
-
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    chat_id VARCHAR(255), -- Adjust the size based on your needs
-                    latitude DOUBLE PRECISION,
-                    longitude DOUBLE PRECISION,
-                    agreement BOOLEAN,
-                    subscription BOOLEAN,
-                    active BOOLEAN
-            )
-        ''')
+        self.ensure_schema()
 
     def insert_user(self, user: UserData):
-        """Insert a new user into the 'users' table"""
+        """Insert a new user into the 'users' table, or update it if the chat_id already exists"""
+        try:
+            query = f'''
+                INSERT INTO users ({', '.join(USER_COLUMNS)})
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (chat_id) DO UPDATE SET {UPSERT_SET_CLAUSE}
+            '''
+            with REGISTRY.timer('db_query', method='insert_user'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, user.to_database())
+
+        except Exception as e:
+            raise ValueError(f"This is the error! {e}")
+
+    def insert_users(self, users: Iterable[UserData | UserRow], batch_size: int | None = None) -> int:
+        """
+        Insert or update many users at once, keyed on chat_id.
+
+        The users are streamed in batches of `batch_size` rows with COPY into a temporary table, then merged into
+        'users' with a single INSERT ... ON CONFLICT. When a chat_id appears more than once the last one wins.
+        Everything runs in one transaction.
+
+        :return: the number of rows read from `users`
+        """
+        batch_size = batch_size or shared.constants.DB_BATCH_SIZE
+        columns = ', '.join(USER_COLUMNS)
+        latest_rows = f'''
+            SELECT DISTINCT ON (chat_id) {columns} FROM users_import
+            ORDER BY chat_id, seq DESC
+        '''
+        total = 0
         try:
-            if not self.table_exists():
-                self.create_table()
-            self.cursor.execute(user.get_query_string())
+            with REGISTRY.timer('db_query', method='insert_users'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute('''
+                    CREATE TEMP TABLE users_import (
+                        seq BIGSERIAL,
+                        chat_id VARCHAR(255),
+                        latitude DOUBLE PRECISION,
+                        longitude DOUBLE PRECISION,
+                        agreement BOOLEAN,
+                        subscription BOOLEAN,
+                        active BOOLEAN
+                    ) ON COMMIT DROP
+                ''')
+                for batch in batched(users, batch_size):
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    for user in batch:
+                        # None is written as an empty unquoted field, which COPY reads as NULL
+                        writer.writerow(user.to_database())
+                    buffer.seek(0)
+                    cursor.copy_expert(f"COPY users_import ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+                    total += len(batch)
+
+                cursor.execute(f'''
+                    INSERT INTO users ({columns})
+                    SELECT {columns} FROM ({latest_rows}) s
+                    ON CONFLICT (chat_id) DO UPDATE SET {UPSERT_SET_CLAUSE}
+                ''')
+            return total
 
         except Exception as e:
             raise ValueError(f"This is the error! {e}")
 
-    def read_users(self, **kwargs):
+    def read_users(self, validate: bool = True, **kwargs) -> list[UserData | UserRow]:
+        """
+        Read the users matching the filters.
+
+        :param validate: Build pydantic UserData objects, False builds the lighter UserRow tuples
+        """
         try:
             where_clause = generate_where_clause(kwargs)
-            query = f"SELECT * FROM users {where_clause}"
-            self.cursor.execute(query, tuple(kwargs.values()))
-            users = self.cursor.fetchall()
+            query = f"SELECT {', '.join(USER_COLUMNS)} FROM users {where_clause}"
+            with REGISTRY.timer('db_query', method='read_users'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, tuple(kwargs.values()))
+                users = cursor.fetchall()
 
-            user_objects = [UserData.from_database(user) for user in users]
+            make_user = row_factory(validate)
+            user_objects = [make_user(user) for user in users]
             return user_objects
 
-            # for user_object in user_objects:
-            #     print(user_object)
+        except Exception as e:
+            raise ValueError(f"This is the error! {e}")
+
+    def iter_user_batches(
+            self,
+            batch_size: int | None = None,
+            validate: bool = True,
+            partition: tuple[int, int] | None = None,
+            undelivered_in: str | None = None,
+            with_last_forecast: bool = False,
+            located_only: bool = False,
+            **kwargs,
+    ) -> Iterator[list[UserData | UserRow | SubscriberRow]]:
+        """
+        Read the users matching the filters in batches, using a server-side cursor.
+
+        Only `batch_size` rows are held in memory at a time, so the caller can start working on the first batch while
+        the rest of the table is still on the server. The connection stays checked out until the generator is exhausted
+        or closed.
+
+        :param validate: Build pydantic UserData objects, False builds the lighter UserRow tuples
+        :param partition: Only read the users of this (index, count) partition, see generate_partition_condition
+        :param undelivered_in: Skip the users already delivered in this report run
+        :param with_last_forecast: Also read the fingerprint of the last forecast delivered (SubscriberRow)
+        :param located_only: Skip the users without latitude or longitude
+        """
+        make_user = row_factory(validate, with_last_forecast)
+        batch_size = batch_size or shared.constants.DB_BATCH_SIZE
+        where_clause = generate_where_clause(kwargs)
+        params = tuple(kwargs.values())
+        extra_conditions = []
+        if partition is not None:
+            extra_conditions.append(generate_partition_condition(partition))
+        if undelivered_in is not None:
+            extra_conditions.append(generate_undelivered_condition(undelivered_in))
+        if located_only:
+            extra_conditions.append(LOCATED_CONDITION)
+        for condition, condition_params in extra_conditions:
+            where_clause = f"{where_clause} AND {condition}" if where_clause else f"WHERE {condition}"
+            params += condition_params
+        columns = USER_COLUMNS + ('last_forecast',) if with_last_forecast else USER_COLUMNS
+        query = f"SELECT {', '.join(columns)} FROM users {where_clause}"
+
+        try:
+            with self.pool.connection() as conn:
+                # Named cursors are server-side cursors in psycopg2
+                with conn.cursor(name=f'read_users_{uuid.uuid4().hex}') as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(query, params)
+                    while True:
+                        with REGISTRY.timer('db_query', method='iter_user_batches'):
+                            rows = cursor.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield [make_user(row) for row in rows]
+        except Exception as e:
+            raise ValueError(f"This is the error! {e}")
+
+    def iter_users(
+            self,
+            batch_size: int | None = None,
+            validate: bool = True,
+            partition: tuple[int, int] | None = None,
+            undelivered_in: str | None = None,
+            with_last_forecast: bool = False,
+            located_only: bool = False,
+            **kwargs,
+    ) -> Iterator[UserData | UserRow | SubscriberRow]:
+        """Lazy version of read_users, see iter_user_batches."""
+        return itertools.chain.from_iterable(self.iter_user_batches(
+            batch_size, validate, partition, undelivered_in, with_last_forecast, located_only, **kwargs
+        ))
+
+    def read_timezones(self, **kwargs) -> list[str]:
+        """Distinct timezones of the users matching the filters, the users not resolved yet are left out."""
+        try:
+            where_clause = generate_where_clause(kwargs)
+            where_clause = f"{where_clause} AND tz_id IS NOT NULL" if where_clause else "WHERE tz_id IS NOT NULL"
+            query = f"SELECT DISTINCT tz_id FROM users {where_clause}"
+            with REGISTRY.timer('db_query', method='read_timezones'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, tuple(kwargs.values()))
+                return [row[0] for row in cursor.fetchall()]
+
+        except Exception as e:
+            raise ValueError(f"This is the error! {e}")
+
+    def read_locations(self, partition: tuple[int, int] | None = None, **kwargs) -> list[tuple[float, float]]:
+        """
+        Distinct (latitude, longitude) of the users matching the filters.
+
+        :param partition: Only read the users of this (index, count) partition, see generate_partition_condition
+        """
+        try:
+            where_clause = generate_where_clause(kwargs)
+            params = tuple(kwargs.values())
+            conditions = [LOCATED_CONDITION[0]]
+            if partition is not None:
+                condition, condition_params = generate_partition_condition(partition)
+                conditions.append(condition)
+                params += condition_params
+            for condition in conditions:
+                where_clause = f"{where_clause} AND {condition}" if where_clause else f"WHERE {condition}"
+            query = f"SELECT DISTINCT latitude, longitude FROM users {where_clause}"
+            with REGISTRY.timer('db_query', method='read_locations'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+
+        except Exception as e:
+            raise ValueError(f"This is the error! {e}")
+
+    def read_unresolved_locations(self, **kwargs) -> list[tuple[float, float]]:
+        """Distinct (latitude, longitude) of the users matching the filters whose timezone is not known yet."""
+        try:
+            where_clause = generate_where_clause(kwargs)
+            condition = "tz_id IS NULL AND latitude IS NOT NULL AND longitude IS NOT NULL"
+            where_clause = f"{where_clause} AND {condition}" if where_clause else f"WHERE {condition}"
+            query = f"SELECT DISTINCT latitude, longitude FROM users {where_clause}"
+            with REGISTRY.timer('db_query', method='read_unresolved_locations'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, tuple(kwargs.values()))
+                return cursor.fetchall()
+
+        except Exception as e:
+            raise ValueError(f"This is the error! {e}")
+
+    def set_timezones(self, timezones: Iterable[tuple[float, float, str]]) -> int:
+        """
+        Set the timezone of the users at each (latitude, longitude, tz_id) location, in a single statement.
+
+        :return: the number of users updated
+        """
+        try:
+            query = '''
+                UPDATE users SET tz_id = v.tz_id
+                FROM (VALUES %s) AS v (latitude, longitude, tz_id)
+                WHERE users.latitude = v.latitude AND users.longitude = v.longitude AND users.tz_id IS NULL
+            '''
+            rows = list(timezones)
+            if not rows:
+                return 0
+            with REGISTRY.timer('db_query', method='set_timezones'), self.pool.connection() as conn, conn.cursor() as cursor:
+                # One page, rowcount only covers the last statement
+                execute_values(
+                    cursor,
+                    query,
+                    rows,
+                    template='(%s::double precision, %s::double precision, %s)',
+                    page_size=len(rows),
+                )
+                return cursor.rowcount
 
         except Exception as e:
             raise ValueError(f"This is the error! {e}")
@@ -91,8 +368,8 @@ class DatabaseConnector:
                 DELETE FROM users
                 WHERE chat_id = %s
             '''
-            self.cursor.execute(query, (chat_id,))
-            self._commit_and_close()
+            with REGISTRY.timer('db_query', method='delete_user'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (chat_id,))
 
         except Exception as e:
             raise ValueError(f"This is the error! {e}")
@@ -107,8 +384,8 @@ class DatabaseConnector:
             '''
 
             values = tuple(kwargs.values()) + (chat_id,)
-            self.cursor.execute(query, values)
-            self._commit_and_close()
+            with REGISTRY.timer('db_query', method='update_user'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, values)
 
         except Exception as e:
             raise ValueError(f"This is the error! {e}")
@@ -116,45 +393,37 @@ class DatabaseConnector:
     def user_exists(self, chat_id):
         """Check if a user exists in the 'users' table by chat_id"""
         try:
-            if not self.table_exists():
-                self.create_table()
-
             query = '''
                 SELECT EXISTS (
                     SELECT 1 FROM users
                     WHERE chat_id = %s
                 )
             '''
-            self.cursor.execute(query, (chat_id,))
-            return self.cursor.fetchone()[0]
+            with REGISTRY.timer('db_query', method='user_exists'), self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (chat_id,))
+                return cursor.fetchone()[0]
 
         except Exception as e:
             raise ValueError(f"This is the error! {e}")
 
 
-#
-db_connector_testing = DatabaseConnector(
-    db_name=os.environ.get('DB_NAME', None),
-    user=os.environ.get('DB_USER', None),
-    password=os.environ.get('DB_PASSWORD', None),
-    host=os.environ.get('DB_HOST', 'localhost'),
-    port=os.environ.get('DB_PORT', '5432'),
-)
+if __name__ == '__main__':
+    db_connector_testing = DatabaseConnector.from_env()
 
-# Test to modify user information Use chat_id and then just items to modify db_connector_testing.update_user(
-# chat_id='0123456789', latitude=99.000000, longitude=00.999999, agreement=True, subscription=True, active=True)
-# db_connector_testing.update_user(chat_id='0123456789', agreement=False, subscription=False, active=False)
+    # Test to modify user information Use chat_id and then just items to modify db_connector_testing.update_user(
+    # chat_id='0123456789', latitude=99.000000, longitude=00.999999, agreement=True, subscription=True, active=True)
+    # db_connector_testing.update_user(chat_id='0123456789', agreement=False, subscription=False, active=False)
 
-# Test to delete user, use only chat_id
-# db_connector_testing.delete_user('9876543210')
+    # Test to delete user, use only chat_id
+    # db_connector_testing.delete_user('9876543210')
 
-# Test users print, you can use an empty dic or put the filters inside
-filters = {}
-# filters = {'active': False, 'subscription': False, 'chat_id': '0123456789'}
-db_connector_testing.read_users(**filters)
+    # Test users print, you can use an empty dic or put the filters inside
+    filters = {}
+    # filters = {'active': False, 'subscription': False, 'chat_id': '0123456789'}
+    print(db_connector_testing.read_users(**filters))
 
-# Test for checking if user already exists
-# if db_connector_testing.user_exists('0123456789'):
-#     print("User already exists")
-# else:
-#     print("User does not exist")
+    # Test for checking if user already exists
+    # if db_connector_testing.user_exists('0123456789'):
+    #     print("User already exists")
+    # else:
+    #     print("User does not exist")
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+import shared.constants
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    Process-wide pool of psycopg2 connections.
+
+    Nothing is opened until the first checkout. Use ConnectionPool.for_params to get the pool shared by every
+    DatabaseConnector of the process pointing to the same database.
+    """
+    _pools: dict[tuple, 'ConnectionPool'] = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(
+            self,
+            min_size: Optional[int] = None,
+            max_size: Optional[int] = None,
+            health_check_interval: Optional[float] = None,
+            **db_params,
+    ):
+        """
+        :param min_size: Connections kept open once the pool is created (defaults to DB_POOL_MIN)
+        :param max_size: Max connections open at the same time, checkouts wait when reached (defaults to DB_POOL_MAX)
+        :param health_check_interval: Connections idle for longer than these seconds are pinged before being handed out
+        :param db_params: psycopg2.connect parameters
+        """
+        self.min_size = min_size if min_size is not None else shared.constants.DB_POOL_MIN
+        self.max_size = max_size or shared.constants.DB_POOL_MAX
+        self.health_check_interval = health_check_interval if health_check_interval is not None else shared.constants.DB_HEALTH_CHECK_INTERVAL
+        self.db_params = db_params
+
+        self._pool: Optional[ThreadedConnectionPool] = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._last_used: dict[int, float] = {}
+        # Set by database.schema.ensure_schema once the migrations ran on this database
+        self.schema_version: Optional[int] = None
+
+    @classmethod
+    def for_params(cls, **db_params) -> 'ConnectionPool':
+        """Return the pool of the process for these connection parameters, creating it if needed."""
+        key = tuple(sorted(db_params.items()))
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls._pools[key] = cls(**db_params)
+            return pool
+
+    @classmethod
+    def close_all(cls) -> None:
+        with cls._pools_lock:
+            for pool in cls._pools.values():
+                pool.close()
+            cls._pools.clear()
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(self.min_size, self.max_size, **self.db_params)
+            return self._pool
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Discarding broken database connection: {e}")
+            return False
+
+    def _checkout(self):
+        pool = self._get_pool()
+        conn = pool.getconn()
+        while not self._is_healthy(conn):
+            pool.putconn(conn, close=True)
+            self._last_used.pop(id(conn), None)
+            conn = pool.getconn()
+        return conn
+
+    def _checkin(self, conn, broken: bool = False) -> None:
+        self._last_used[id(conn)] = time.monotonic()
+        self._get_pool().putconn(conn, close=broken or bool(conn.closed))
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """
+        Check out a connection, committed when the block succeeds and rolled back when it raises.
+
+        Waits for a free connection when `max_size` connections are already checked out.
+        """
+        with self._slots:
+            conn = self._checkout()
+            broken = False
+            try:
+                yield conn
+                conn.commit()
+            except psycopg2.OperationalError:
+                broken = True
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self._checkin(conn, broken)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            self._last_used.clear()
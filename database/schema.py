@@ -0,0 +1,137 @@
+import logging
+
+from database.pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Any number works as long as every process uses the same one, it serializes concurrent migrations
+MIGRATIONS_LOCK_ID = 7_391_245
+
+# (version, name, statements), applied in order and only once per database. Never edit an applied migration, add a
+# new one instead.
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (1, 'create users table', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                chat_id VARCHAR(255), -- Adjust the size based on your needs
+                latitude DOUBLE PRECISION,
+                longitude DOUBLE PRECISION,
+                agreement BOOLEAN,
+                subscription BOOLEAN,
+                active BOOLEAN
+        )
+        ''',
+    ]),
+    (2, 'unique chat_id', [
+        # Users could be inserted twice before this index existed, keep the most recent row
+        'DELETE FROM users a USING users b WHERE a.chat_id = b.chat_id AND a.id < b.id',
+        'CREATE UNIQUE INDEX IF NOT EXISTS users_chat_id_key ON users (chat_id)',
+    ]),
+    (3, 'eligible subscribers index', [
+        # Matches read_users(agreement=True, subscription=True, active=True), the automatic reports query
+        'CREATE INDEX IF NOT EXISTS users_eligible_idx ON users (id) WHERE agreement AND subscription AND active',
+    ]),
+    (4, 'dispatch partition leases', [
+        # One row per partition of a report run, claimed by the worker sending it, see auto_weather_updates.partitions
+        '''
+        CREATE TABLE IF NOT EXISTS dispatch_leases (
+                run_id TEXT NOT NULL,
+                partition_index INTEGER NOT NULL,
+                partition_count INTEGER NOT NULL,
+                owner TEXT,
+                expires_at TIMESTAMPTZ,
+                completed_at TIMESTAMPTZ,
+                PRIMARY KEY (run_id, partition_index)
+        )
+        ''',
+    ]),
+    (5, 'delivery ledger', [
+        # Status of every chat of a report run, so a restarted run skips the delivered ones
+        '''
+        CREATE TABLE IF NOT EXISTS report_runs (
+                run_id TEXT PRIMARY KEY,
+                started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                checkpoint_at TIMESTAMPTZ,
+                finished_at TIMESTAMPTZ
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS delivery_ledger (
+                run_id TEXT NOT NULL,
+                chat_id VARCHAR(255) NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                error TEXT,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (run_id, chat_id)
+        )
+        ''',
+    ]),
+    (6, 'user timezones', [
+        # Filled from the WeatherAPI location of the user, see auto_weather_updates.scheduler
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS tz_id TEXT',
+        'CREATE INDEX IF NOT EXISTS users_eligible_tz_idx ON users (tz_id) WHERE agreement AND subscription AND active',
+    ]),
+    (7, 'conversation state', [
+        # Flow state of the bot conversations, see telegram_bot.state
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_state (
+                chat_id VARCHAR(255) PRIMARY KEY,
+                state JSONB NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+    ]),
+    (8, 'last delivered forecast', [
+        # Fingerprint of the last forecast sent to the user, see auto_weather_updates.fingerprint
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS last_forecast JSONB',
+    ]),
+    (9, 'rate limit buckets', [
+        # Token buckets shared by every process sending with the bot token, see shared.telegram_limiter
+        '''
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                key TEXT PRIMARY KEY,
+                tokens DOUBLE PRECISION NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+                paused_until TIMESTAMPTZ
+        )
+        ''',
+    ]),
+]
+
+
+def ensure_schema(pool: ConnectionPool) -> int:
+    """
+    Apply the pending migrations to the database of the pool, once per pool.
+
+    Concurrent callers (eg: several workers starting together) wait on an advisory lock, so each migration runs once.
+
+    :return: the schema version of the database
+    """
+    if pool.schema_version is not None:
+        return pool.schema_version
+
+    with pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATIONS_LOCK_ID,))
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        ''')
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+        version = cursor.fetchone()[0]
+
+        for migration_version, name, statements in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logger.info(f"Applying database migration {migration_version}: {name}")
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (migration_version, name))
+            version = migration_version
+
+    pool.schema_version = version
+    return version
@@ -61,9 +61,10 @@ def delete_user(user_id):
     conn.commit()
     conn.close()
 
-# Uncomment the function calls you want to execute
-create_table()
-# insert_user('Fer','654321')
-#
-# # delete_user(6)
-# print(read_users())
\ No newline at end of file
+if __name__ == '__main__':
+    # Uncomment the function calls you want to execute
+    create_table()
+    # insert_user('Fer','654321')
+    #
+    # # delete_user(6)
+    # print(read_users())
@@ -0,0 +1,243 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import shared.constants
+from shared.forecast_store import ForecastStore
+from shared.metrics import REGISTRY
+from shared.models import CurrentReport, WeatherReport
+from shared.utils import Moment, location_cell
+
+# Model of the reports stored per kind, to load them back from the ForecastStore
+REPORT_MODELS = {'current': CurrentReport, 'forecast': WeatherReport}
+
+# Default of the store argument, None disables the store
+_STORE_FROM_ENV = object()
+
+
+class ForecastCache:
+    """
+    In-memory cache for weather reports, keyed on the location cell of the coordinates.
+
+    An entry is fresh for `current_ttl` seconds for Moment.CURRENT (and FULL) lookups and for `forecast_ttl` seconds
+    for Moment.FORECAST lookups, so a single API response serves both. Current-only reports are stored apart from the
+    forecasts and only serve Moment.CURRENT lookups. Once `max_entries` is reached the least recently used entry is
+    evicted.
+
+    With a ForecastStore the reports are also written to disk, and a lookup missing in memory is served from the store
+    when it holds a report fresh enough, fetched by this process before a restart or by another process. The store is
+    a file another process can hold locked, asyncio code uses the *_async methods, which only touch it from a thread.
+    """
+
+    def __init__(
+            self,
+            max_entries: Optional[int] = None,
+            current_ttl: Optional[float] = None,
+            forecast_ttl: Optional[float] = None,
+            cell_mode: Optional[str] = None,
+            cell_precision: Optional[int] = None,
+            stale_ttl: Optional[float] = None,
+            store: Optional[ForecastStore] = _STORE_FROM_ENV,
+    ):
+        """
+        :param stale_ttl: Seconds past the TTL an entry can still be served by get_stale (defaults to CACHE_STALE_TTL)
+        :param store: Second level on disk (defaults to the FORECAST_STORE_PATH one), None keeps the cache in memory
+        """
+        self.max_entries = max_entries or shared.constants.CACHE_MAX_ENTRIES
+        self.current_ttl = current_ttl if current_ttl is not None else shared.constants.CACHE_CURRENT_TTL
+        self.forecast_ttl = forecast_ttl if forecast_ttl is not None else shared.constants.CACHE_FORECAST_TTL
+        self.cell_mode = cell_mode or shared.constants.CACHE_CELL_MODE
+        self.cell_precision = cell_precision if cell_precision is not None else shared.constants.CACHE_CELL_PRECISION
+        self.stale_ttl = stale_ttl if stale_ttl is not None else shared.constants.CACHE_STALE_TTL
+        self.store = ForecastStore.from_env() if store is _STORE_FROM_ENV else store
+
+        self._entries: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cell(self, latitude: float, longitude: float) -> str:
+        """Return the cache key of the coordinates."""
+        return location_cell(latitude, longitude, self.cell_mode, self.cell_precision)
+
+    def ttl(self, moment: Moment | None) -> float:
+        """Return how old, in seconds, an entry can be to be served for the given moment."""
+        if moment == Moment.FORECAST:
+            return self.forecast_ttl
+        return self.current_ttl
+
+    @staticmethod
+    def kind(moment: Moment | None) -> str:
+        """Return the kind of report fetched for the moment, only CURRENT lookups can do with current conditions."""
+        return 'current' if moment == Moment.CURRENT else 'forecast'
+
+    def _keys(self, latitude: float, longitude: float, moment: Moment | None) -> list[tuple[str, str]]:
+        """Keys that can serve a lookup for the moment, forecast reports include the current conditions."""
+        cell = self.cell(latitude, longitude)
+        return [(cell, 'forecast'), (cell, 'current')] if moment == Moment.CURRENT else [(cell, 'forecast')]
+
+    def _outdated(self, keys: list[tuple[str, str]], max_age: float) -> list[tuple[str, str]]:
+        """Keys missing in memory or too old, the store may hold a newer report."""
+        now = time.time()
+        return [key for key in keys if (entry := self._entries.get(key)) is None or now - entry[0] > max_age]
+
+    def _load_outdated(self, keys: list[tuple[str, str]], max_age: float) -> None:
+        for key in self._outdated(keys, max_age):
+            self._load(key, self._entries.get(key))
+
+    def get(self, latitude: float, longitude: float, moment: Moment | None = None, max_age: Optional[float] = None) -> Any:
+        """
+        Return the cached report of the cell if it is fresh enough for the moment, None otherwise.
+
+        :param max_age: Seconds the report can be old, overriding the TTL of the moment
+        """
+        keys = self._keys(latitude, longitude, moment)
+        max_age = max_age if max_age is not None else self.ttl(moment)
+        if self.store is not None:
+            self._load_outdated(keys, max_age)
+        return self._lookup(keys, max_age)
+
+    async def get_async(
+            self,
+            latitude: float,
+            longitude: float,
+            moment: Moment | None = None,
+            max_age: Optional[float] = None,
+    ) -> Any:
+        """Awaitable version of get, the store is only read from a thread and only on a memory miss."""
+        keys = self._keys(latitude, longitude, moment)
+        max_age = max_age if max_age is not None else self.ttl(moment)
+        if self.store is not None and self._outdated(keys, max_age):
+            await asyncio.to_thread(self._load_outdated, keys, max_age)
+        return self._lookup(keys, max_age)
+
+    def _lookup(self, keys: list[tuple[str, str]], max_age: float) -> Any:
+        """The freshest report of the keys in memory, counted as a lookup."""
+        now = time.time()
+        with self._lock:
+            fresh = [
+                (entry[0], key) for key in keys
+                if (entry := self._entries.get(key)) is not None and now - entry[0] <= max_age
+            ]
+            if not fresh:
+                self.misses += 1
+                REGISTRY.inc('forecast_cache_lookups_total', result='miss')
+                return None
+            _, key = max(fresh)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            REGISTRY.inc('forecast_cache_lookups_total', result='hit')
+            return self._entries[key][1]
+
+    def _load(self, key: tuple[str, str], entry: Optional[tuple[float, Any]]) -> None:
+        """Copy the report of the store into memory when it's newer than the entry."""
+        row = self.store.get(*key)
+        if row is None or (entry is not None and row[0] <= entry[0]):
+            return
+        fetched_at, payload = row
+        try:
+            report = REPORT_MODELS[key[1]].model_validate_json(payload)
+        except ValueError:
+            # Written by another version of the models, a fetch will overwrite it
+            return
+        REGISTRY.inc('forecast_store_loads_total')
+        self._remember(key, fetched_at, report)
+
+    def _remember(self, key: tuple[str, str], fetched_at: float, report: Any) -> None:
+        with self._lock:
+            self._entries[key] = (fetched_at, report)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def age(self, latitude: float, longitude: float, moment: Moment | None = None) -> Optional[float]:
+        """
+        Seconds since the report of the cell was fetched, None when there is none. Not counted as a lookup.
+
+        Reads the store, from the asyncio code run it in a thread.
+        """
+        key = (self.cell(latitude, longitude), self.kind(moment))
+        entry = self._entries.get(key)
+        fetched_at = entry[0] if entry is not None else None
+        if self.store is not None:
+            stored_at = self.store.fetched_at(*key)
+            if stored_at is not None and (fetched_at is None or stored_at > fetched_at):
+                fetched_at = stored_at
+        return time.time() - fetched_at if fetched_at is not None else None
+
+    def get_stale(self, latitude: float, longitude: float, moment: Moment | None = None) -> Any:
+        """
+        Return the cached report of the cell up to `stale_ttl` seconds past its TTL, None otherwise.
+
+        Meant for when the API is unreachable, an outdated report beats no report.
+        """
+        report = self.get(latitude, longitude, moment, max_age=self.ttl(moment) + self.stale_ttl)
+        if report is not None:
+            REGISTRY.inc('forecast_cache_stale_served_total')
+        return report
+
+    async def get_stale_async(self, latitude: float, longitude: float, moment: Moment | None = None) -> Any:
+        """Awaitable version of get_stale."""
+        report = await self.get_async(latitude, longitude, moment, max_age=self.ttl(moment) + self.stale_ttl)
+        if report is not None:
+            REGISTRY.inc('forecast_cache_stale_served_total')
+        return report
+
+    def put(
+            self,
+            latitude: float,
+            longitude: float,
+            report: Any,
+            moment: Moment | None = None,
+            fetched_at: Optional[float] = None,
+    ) -> None:
+        """Store the report fetched for the moment in the cell of the coordinates."""
+        key = (self.cell(latitude, longitude), self.kind(moment))
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+        self._remember(key, fetched_at, report)
+        self._write(key, fetched_at, report)
+
+    async def put_async(
+            self,
+            latitude: float,
+            longitude: float,
+            report: Any,
+            moment: Moment | None = None,
+            fetched_at: Optional[float] = None,
+    ) -> None:
+        """Awaitable version of put, the report is in memory right away and written to the store from a thread."""
+        key = (self.cell(latitude, longitude), self.kind(moment))
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+        self._remember(key, fetched_at, report)
+        if self.store is not None:
+            await asyncio.to_thread(self._write, key, fetched_at, report)
+
+    def _write(self, key: tuple[str, str], fetched_at: float, report: Any) -> None:
+        if self.store is not None and hasattr(report, 'model_dump_json'):
+            self.store.put(*key, fetched_at, report.model_dump_json().encode())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """Return the counters of the cache, handy for logging."""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hit_rate, 3),
+        }
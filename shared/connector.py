@@ -1,16 +1,63 @@
 import abc
+import asyncio
 import http
 import json
+import time
 from typing import Optional
-import os
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+
+import shared.constants
+from shared.metrics import REGISTRY
+from shared.resilience import CircuitBreaker, RetryPolicy
+
+# Transport failures worth retrying, next to the ConnectionError raised for 429 and 5xx responses
+RETRYABLE_ERRORS = (ConnectionError, requests.ConnectionError, requests.Timeout, httpx.TransportError)
+
+
+class APIError(ValueError):
+    """The API refused the request (4xx), sending it again won't help."""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
 
 
 class APIConnector(abc.ABC):
     CREDENTIALS: dict = None
 
-    def __init__(self, url: str):
+    def __init__(
+            self,
+            url: str,
+            timeout: Optional[float] = None,
+            connect_timeout: Optional[float] = None,
+            max_connections: Optional[int] = None,
+            max_keepalive_connections: Optional[int] = None,
+            retry_policy: Optional[RetryPolicy] = None,
+            circuit_breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        :param url: Base url of the API, every endpoint is appended to it
+        :param timeout: Seconds to wait for a response before giving up (defaults to HTTP_TIMEOUT)
+        :param connect_timeout: Seconds to wait for the TCP/TLS handshake (defaults to HTTP_CONNECT_TIMEOUT)
+        :param max_connections: Max open connections to the API host (defaults to HTTP_MAX_CONNECTIONS)
+        :param max_keepalive_connections: Max idle connections kept alive for reuse (defaults to HTTP_MAX_KEEPALIVE_CONNECTIONS)
+        :param retry_policy: Retries of the failed requests (defaults to the HTTP_RETRY_* settings)
+        :param circuit_breaker: Breaker shared by the requests of the connector (defaults to the BREAKER_* settings)
+        """
         self.url = url
+        self.timeout = timeout if timeout is not None else shared.constants.HTTP_TIMEOUT
+        self.connect_timeout = connect_timeout if connect_timeout is not None else shared.constants.HTTP_CONNECT_TIMEOUT
+        self.max_connections = max_connections or shared.constants.HTTP_MAX_CONNECTIONS
+        self.max_keepalive_connections = max_keepalive_connections or shared.constants.HTTP_MAX_KEEPALIVE_CONNECTIONS
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(type(self).__name__)
+
+        self._session: Optional[requests.Session] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_client_loop: Optional[asyncio.AbstractEventLoop] = None
 
     @abc.abstractmethod
     def _get_auth_data(self):
@@ -22,7 +69,118 @@ class APIConnector(abc.ABC):
         """
         raise NotImplementedError()
 
-    def perform_request(self, method: http.HTTPMethod, endpoint: str, body: Optional[dict] = None, params: Optional[dict] = None):
+    @property
+    def session(self) -> requests.Session:
+        """
+        Keep-alive session used by the sync requests, created on first use.
+
+        All the requests go to the same host, so the adapter pool size is the per-host connection limit.
+        """
+        if self._session is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections, pool_block=True)
+            self._session = requests.Session()
+            self._session.mount(self.url, adapter)
+        return self._session
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """
+        Keep-alive client used by the async requests, created on first use.
+
+        httpx connections are bound to the event loop that opened them, so a new client is created when the connector
+        is reused from another loop (eg: consecutive asyncio.run calls).
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                ),
+            )
+            self._async_client_loop = loop
+        return self._async_client
+
+    def close(self) -> None:
+        """Close the sync session and release its connections."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    async def aclose(self) -> None:
+        """Close the async client and release its connections."""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_client_loop = None
+
+    def _build_request(self, method: http.HTTPMethod, endpoint: str, body: Optional[dict] = None, params: Optional[dict] = None) -> dict:
+        """
+        Build the arguments shared by the sync and async requests.
+
+        :return: dict with the method, url, headers, content and params of the request
+        """
+        headers = {}
+        content = None
+        if body is not None:
+            headers['Content-type'] = 'application/json'
+            content = json.dumps(body)
+
+        return {
+            'method': str(method),
+            'url': f'{self.url}/{endpoint}',
+            'headers': headers,
+            'content': content,
+            'params': {key: value for key, value in (params or {}).items() if value is not None},
+        }
+
+    @staticmethod
+    def _handle_response(response, raw: bool = False):
+        """
+        Check the status code of the response and return its json.
+
+        429 and 5xx raise ConnectionError, the request can be retried. Other statuses raise APIError, a ValueError.
+
+        :param response: requests or httpx response, both have the same status_code/text/content/json interface
+        :param raw: Return the undecoded body instead of the json
+        :return: Returns the response object's json (or its bytes when raw).
+        """
+        status_code = response.status_code
+        if status_code == http.HTTPStatus.OK:
+            return response.content if raw else response.json()
+
+        if status_code >= 500 or status_code == http.HTTPStatus.TOO_MANY_REQUESTS:
+            raise ConnectionError(f'Received {status_code} Error, check if app is down. [Message:{response.text}]')
+        elif status_code >= 400:
+            raise APIError(
+                f'Received {status_code} Error, check data to confirm its correct. [Message:{response.text}]', status_code
+            )
+        else:
+            raise APIError(
+                f'Received other status code than 200. [Status Code: {status_code} - Message:{response.text}]', status_code
+            )
+
+    def _should_retry(self, error: Exception, attempt: int, endpoint: str) -> bool:
+        """Record the failed attempt on the breaker, returns whether to try again."""
+        if not isinstance(error, RETRYABLE_ERRORS):
+            # The API answered (eg: 400 on a wrong location), it's healthy
+            self.circuit_breaker.record_success()
+            return False
+        self.circuit_breaker.record_failure()
+        if attempt + 1 >= self.retry_policy.max_attempts:
+            return False
+        REGISTRY.inc('api_retries_total', api=type(self).__name__, endpoint=endpoint)
+        return True
+
+    @staticmethod
+    def _as_connection_error(error: Exception) -> Exception:
+        """Transport errors of requests/httpx are raised as ConnectionError, so callers handle a single type."""
+        if isinstance(error, RETRYABLE_ERRORS) and not isinstance(error, ConnectionError):
+            return ConnectionError(f'Request failed: {error!r}')
+        return error
+
+    def perform_request(self, method: http.HTTPMethod, endpoint: str, body: Optional[dict] = None, params: Optional[dict] = None, raw: bool = False):
         """
         Function to perform an API request
 
@@ -35,30 +193,72 @@ class APIConnector(abc.ABC):
 
         Also if you override the function, please make sure you handle error responses correctly.
 
+        Timeouts, 429 and 5xx are retried following the retry policy, and the circuit breaker fails the request right
+        away (CircuitOpenError) while the API keeps failing. Transport errors are raised as ConnectionError.
+
         :param method: The HTTP method the request will have (POST, GET, PUT, etc)
         :param endpoint: The endpoint you need to reach within the API
         :param body: The request's body (Optional param)
         :param params: The request's header params (Optional param)
-        :return: Returns the response object's json.
+        :param raw: Return the undecoded body, to let the caller parse it straight into its models
+        :return: Returns the response object's json (or its bytes when raw).
         """
-        headers = {}
-        if body:
-            headers['Content-type'] = 'application/json'
+        request = self._build_request(method, endpoint, body, params)
 
-        response = requests.request(
-            method=method,
-            headers=headers,
-            url=f'{self.url}/{endpoint}',
-            data=json.dumps(body),
-            params=params
-        )
-
-        if response.status_code != http.HTTPStatus.OK:
-            raise ValueError(f'Received other status code than 200. [Status Code: {response.status_code} - Message:{response.text}]')
-
-        if response.status_code >= 500:
-            raise ConnectionError('Received 500 Error, check if app is down.')
-        elif response.status_code >= 400:
-            raise ValueError('Received 400 Error, check data to confirm its correct.')
-        else:
-            return response.json()
+        for attempt in range(self.retry_policy.max_attempts):
+            self.circuit_breaker.before_call()
+            try:
+                with REGISTRY.timer('api_request', api=type(self).__name__, endpoint=endpoint):
+                    response = self.session.request(
+                        method=request['method'],
+                        url=request['url'],
+                        headers=request['headers'],
+                        data=request['content'],
+                        params=request['params'],
+                        timeout=(self.connect_timeout, self.timeout),
+                    )
+
+                    result = self._handle_response(response, raw)
+            except Exception as e:
+                if not self._should_retry(e, attempt, endpoint):
+                    raise self._as_connection_error(e) from e
+                time.sleep(self.retry_policy.delay(attempt))
+                continue
+            self.circuit_breaker.record_success()
+            return result
+
+    async def perform_request_async(self, method: http.HTTPMethod, endpoint: str, body: Optional[dict] = None, params: Optional[dict] = None, raw: bool = False):
+        """
+        Awaitable version of perform_request, it does not block the event loop while waiting for the API.
+
+        Requests reuse the connections of the shared keep-alive pool of the connector.
+
+        :param method: The HTTP method the request will have (POST, GET, PUT, etc)
+        :param endpoint: The endpoint you need to reach within the API
+        :param body: The request's body (Optional param)
+        :param params: The request's header params (Optional param)
+        :param raw: Return the undecoded body, to let the caller parse it straight into its models
+        :return: Returns the response object's json (or its bytes when raw).
+        """
+        request = self._build_request(method, endpoint, body, params)
+
+        for attempt in range(self.retry_policy.max_attempts):
+            self.circuit_breaker.before_call()
+            try:
+                with REGISTRY.timer('api_request', api=type(self).__name__, endpoint=endpoint):
+                    response = await self.async_client.request(
+                        method=request['method'],
+                        url=request['url'],
+                        headers=request['headers'],
+                        content=request['content'],
+                        params=request['params'],
+                    )
+
+                    result = self._handle_response(response, raw)
+            except Exception as e:
+                if not self._should_retry(e, attempt, endpoint):
+                    raise self._as_connection_error(e) from e
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+                continue
+            self.circuit_breaker.record_success()
+            return result
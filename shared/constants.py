@@ -1,10 +1,114 @@
 import os
+import tempfile
 
 DB_NAME = os.environ.get('DB_NAME', None)
 DB_USER = os.environ.get('DB_USER', None)
 DB_PASSWORD = os.environ.get('DB_PASSWORD', None)
-HOST = os.environ.get('DB_HOST', None)
-PORT = os.environ.get('DB_PORT', None)
+HOST = os.environ.get('DB_HOST', 'localhost')
+PORT = os.environ.get('DB_PORT', '5432')
+# Connection pool shared by every DatabaseConnector of the process, see database.pool.ConnectionPool
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_HEALTH_CHECK_INTERVAL', 30))
+# Rows fetched per round trip when streaming users from the database
+DB_BATCH_SIZE = int(os.environ.get('DB_BATCH_SIZE', 1000))
+
+# HTTP client settings shared by every APIConnector
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 20))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', 10))
+# Retries of timeouts, 429 and 5xx, and the circuit breaker failing fast while the API is down, see shared.resilience
+HTTP_MAX_ATTEMPTS = int(os.environ.get('HTTP_MAX_ATTEMPTS', 3))
+HTTP_RETRY_BASE_DELAY = float(os.environ.get('HTTP_RETRY_BASE_DELAY', 0.2))
+HTTP_RETRY_MAX_DELAY = float(os.environ.get('HTTP_RETRY_MAX_DELAY', 2))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+# Reports shared on disk by the processes of the host, see shared.forecast_store. An empty path disables it
+FORECAST_STORE_PATH = os.environ.get(
+    'FORECAST_STORE_PATH', os.path.join(tempfile.gettempdir(), 'weather_bot_forecasts.sqlite3')
+)
+FORECAST_STORE_MAX_AGE = float(os.environ.get('FORECAST_STORE_MAX_AGE', 6 * 60 * 60))
+FORECAST_STORE_BUSY_TIMEOUT = float(os.environ.get('FORECAST_STORE_BUSY_TIMEOUT', 5))
+FORECAST_STORE_COMPACT_EVERY = int(os.environ.get('FORECAST_STORE_COMPACT_EVERY', 1000))
+
+# Locations per WeatherAPI bulk request, the API accepts up to 50
+WEATHER_BULK_SIZE = int(os.environ.get('WEATHER_BULK_SIZE', 50))
+
+# Forecast cache settings, see shared.cache.ForecastCache
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+CACHE_CURRENT_TTL = float(os.environ.get('CACHE_CURRENT_TTL', 10 * 60))
+CACHE_FORECAST_TTL = float(os.environ.get('CACHE_FORECAST_TTL', 3 * 60 * 60))
+CACHE_CELL_MODE = os.environ.get('CACHE_CELL_MODE', 'round')
+CACHE_CELL_PRECISION = int(os.environ.get('CACHE_CELL_PRECISION', 2))
+# Seconds past their TTL expired reports are still served while WeatherAPI is unreachable
+CACHE_STALE_TTL = float(os.environ.get('CACHE_STALE_TTL', 60 * 60))
+
+# Automatic reports dispatch settings, the rates follow the Telegram Bot API limits (30 msg/s, 1 msg/s per chat)
+DISPATCH_MAX_FETCHES = int(os.environ.get('DISPATCH_MAX_FETCHES', 20))
+DISPATCH_MAX_SENDS = int(os.environ.get('DISPATCH_MAX_SENDS', 30))
+DISPATCH_MAX_RETRIES = int(os.environ.get('DISPATCH_MAX_RETRIES', 3))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+# Global Telegram send rate shared by every process using the bot token, see shared.telegram_limiter.
+# RATE_LIMIT_BACKEND is 'postgres', 'sqlite' (processes of a single host, at RATE_LIMIT_PATH) or empty to only limit
+# each process on its own. Bulk sends leave RATE_LIMIT_INTERACTIVE_RESERVE tokens of the bucket to the bot replies
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'postgres')
+RATE_LIMIT_PATH = os.environ.get(
+    'RATE_LIMIT_PATH', os.path.join(tempfile.gettempdir(), 'weather_bot_rate_limit.sqlite3')
+)
+RATE_LIMIT_INTERACTIVE_RESERVE = float(os.environ.get('RATE_LIMIT_INTERACTIVE_RESERVE', 5))
+# Partitioned dispatch across workers, 0 partitions sends everything from a single process
+DISPATCH_PARTITIONS = int(os.environ.get('DISPATCH_PARTITIONS', 0))
+DISPATCH_LEASE_SECONDS = float(os.environ.get('DISPATCH_LEASE_SECONDS', 60))
+DISPATCH_RUN_ID = os.environ.get('DISPATCH_RUN_ID', None)
+# Delivery statuses written to the ledger per checkpoint
+LEDGER_FLUSH_SIZE = int(os.environ.get('LEDGER_FLUSH_SIZE', 100))
+
+# Change-only reports, see auto_weather_updates.fingerprint. With NOTIFY_CHANGES_ONLY a user is only sent the forecast
+# when it differs from the last one delivered: another condition, a max or min temperature NOTIFY_TEMP_THRESHOLD
+# degrees away, or a sunrise or sunset NOTIFY_SUN_THRESHOLD minutes away
+NOTIFY_CHANGES_ONLY = os.environ.get('NOTIFY_CHANGES_ONLY', '').lower() in ('1', 'true', 'yes')
+NOTIFY_TEMP_THRESHOLD = float(os.environ.get('NOTIFY_TEMP_THRESHOLD', 2))
+NOTIFY_SUN_THRESHOLD = float(os.environ.get('NOTIFY_SUN_THRESHOLD', 15))
+
+# Forecast prewarming, see shared.prewarm. Cached forecasts are refreshed PREWARM_REFRESH_AHEAD seconds
+# before they expire, the scheduler does so PREWARM_LEAD seconds before each delivery. The bot can also keep the
+# current weather of every subscriber cell warm every PREWARM_INTERVAL seconds, off by default since it fetches every
+# cell around the clock whether anyone asks or not
+PREWARM_REFRESH_AHEAD = float(os.environ.get('PREWARM_REFRESH_AHEAD', 3 * 60))
+PREWARM_INTERVAL = float(os.environ.get('PREWARM_INTERVAL', 0))
+PREWARM_LEAD = float(os.environ.get('PREWARM_LEAD', 15 * 60))
+
+# Continuous scheduler, see auto_weather_updates.scheduler. Reports are sent at SCHEDULE_DELIVERY_TIME local time
+SCHEDULE_DELIVERY_TIME = os.environ.get('SCHEDULE_DELIVERY_TIME', '08:00')
+SCHEDULE_REFRESH_INTERVAL = float(os.environ.get('SCHEDULE_REFRESH_INTERVAL', 15 * 60))
+SCHEDULE_CATCH_UP = float(os.environ.get('SCHEDULE_CATCH_UP', 60 * 60))
+
+# Telegram webhook, see telegram_bot.webhook. The bot polls for updates when WEBHOOK_URL is not set
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', None)
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+# Defaults to the path of WEBHOOK_URL, set it when a proxy rewrites the path
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', None)
+# Required with WEBHOOK_URL, Telegram sends it with every update so forged ones are rejected
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN', None)
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 16))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+WEBHOOK_REUSE_PORT = os.environ.get('WEBHOOK_REUSE_PORT', '').lower() in ('1', 'true', 'yes')
+
+# Conversation state of the bot, see telegram_bot.state. STATE_BACKEND is 'postgres' or 'file'
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'postgres')
+STATE_FILE_DIR = os.environ.get('STATE_FILE_DIR', '.conversation_state')
+STATE_CACHE_MAX_ENTRIES = int(os.environ.get('STATE_CACHE_MAX_ENTRIES', 10000))
+STATE_CACHE_TTL = float(os.environ.get('STATE_CACHE_TTL', 5 * 60))
+
+# Metrics, see shared.metrics. METRICS_PORT serves a Prometheus endpoint, METRICS_LOG_INTERVAL logs a summary
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', 0))
 
 
 # print(DB_NAME)
@@ -0,0 +1,164 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import shared.constants
+from shared.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class ForecastStore:
+    """
+    On-disk store of the weather reports, shared by every process of the host and kept across restarts.
+
+    A SQLite database in WAL mode: readers never block and never see a half written report, writers of different
+    processes queue on the database lock for up to `busy_timeout` seconds. Rows are keyed on (cell, kind) like the
+    ForecastCache entries and hold the fetch time and the report as json. A write never replaces a newer report. Every
+    `compact_every` writes, a background thread deletes the rows older than `max_age` and compacts the file.
+
+    Meant as the second level of ForecastCache. Errors are logged and the store acts as empty, a broken file never
+    fails a request.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            max_age: Optional[float] = None,
+            busy_timeout: Optional[float] = None,
+            compact_every: Optional[int] = None,
+    ):
+        """
+        :param path: SQLite file, created if needed
+        :param max_age: Seconds a report is kept (defaults to FORECAST_STORE_MAX_AGE)
+        :param busy_timeout: Seconds to wait for the lock held by another process (defaults to FORECAST_STORE_BUSY_TIMEOUT)
+        :param compact_every: Writes between two compactions (defaults to FORECAST_STORE_COMPACT_EVERY)
+        """
+        self.path = path
+        self.max_age = max_age if max_age is not None else shared.constants.FORECAST_STORE_MAX_AGE
+        self.busy_timeout = busy_timeout if busy_timeout is not None else shared.constants.FORECAST_STORE_BUSY_TIMEOUT
+        self.compact_every = compact_every or shared.constants.FORECAST_STORE_COMPACT_EVERY
+
+        # sqlite3 connections can't be shared between threads, each thread opens its own
+        self._local = threading.local()
+        self._writes = 0
+        self._compacting = False
+        self._lock = threading.Lock()
+        self._connect()
+
+    @classmethod
+    def from_env(cls) -> Optional['ForecastStore']:
+        """Store at FORECAST_STORE_PATH, None when it's empty or can't be opened."""
+        if not shared.constants.FORECAST_STORE_PATH:
+            return None
+        try:
+            return cls(shared.constants.FORECAST_STORE_PATH)
+        except sqlite3.Error as e:
+            logger.warning(f"Can't open the forecast store {shared.constants.FORECAST_STORE_PATH}, running without: {e}")
+            return None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit, every statement is its own short transaction
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}')
+            conn.execute('PRAGMA journal_mode = WAL')
+            # Durable enough for a cache, a crash can only lose the last writes
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS forecasts (
+                    cell TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    payload BLOB NOT NULL,
+                    PRIMARY KEY (cell, kind)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS forecasts_fetched_at_idx ON forecasts (fetched_at)')
+            self._local.conn = conn
+        return conn
+
+    def get(self, cell: str, kind: str) -> Optional[tuple[float, bytes]]:
+        """Return the (fetched_at, payload) of the cell, None when there is none."""
+        try:
+            return self._connect().execute(
+                'SELECT fetched_at, payload FROM forecasts WHERE cell = ? AND kind = ?', (cell, kind)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to read the forecast store: {e}")
+            return None
+
+    def fetched_at(self, cell: str, kind: str) -> Optional[float]:
+        try:
+            row = self._connect().execute(
+                'SELECT fetched_at FROM forecasts WHERE cell = ? AND kind = ?', (cell, kind)
+            ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to read the forecast store: {e}")
+            return None
+
+    def put(self, cell: str, kind: str, fetched_at: float, payload: bytes) -> None:
+        try:
+            self._connect().execute('''
+                INSERT INTO forecasts (cell, kind, fetched_at, payload) VALUES (?, ?, ?, ?)
+                ON CONFLICT (cell, kind) DO UPDATE SET fetched_at = excluded.fetched_at, payload = excluded.payload
+                WHERE excluded.fetched_at > forecasts.fetched_at
+            ''', (cell, kind, fetched_at, payload))
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to write the forecast store: {e}")
+            return
+        REGISTRY.inc('forecast_store_writes_total')
+
+        with self._lock:
+            self._writes += 1
+            compact = self._writes % self.compact_every == 0 and not self._compacting
+            if compact:
+                self._compacting = True
+        if compact:
+            # Vacuuming and truncating the WAL can take a while, the write that triggered it does not wait for it
+            threading.Thread(target=self._compact_in_background, name='forecast-store-compact', daemon=True).start()
+
+    def _compact_in_background(self) -> None:
+        try:
+            self.compact()
+        finally:
+            self.close()
+            with self._lock:
+                self._compacting = False
+
+    def expire(self) -> int:
+        """Delete the reports older than max_age, returns how many."""
+        cursor = self._connect().execute('DELETE FROM forecasts WHERE fetched_at < ?', (time.time() - self.max_age,))
+        return cursor.rowcount
+
+    def compact(self) -> None:
+        """Delete the expired reports, give their pages back to the file system and truncate the WAL."""
+        try:
+            expired = self.expire()
+            conn = self._connect()
+            conn.execute('PRAGMA incremental_vacuum')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to compact the forecast store: {e}")
+            return
+        logger.debug(f"Compacted the forecast store, {expired} expired reports deleted")
+
+    def close(self) -> None:
+        """Close the connection of the calling thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def __len__(self) -> int:
+        return self._connect().execute('SELECT count(*) FROM forecasts').fetchone()[0]
+
+    def size(self) -> int:
+        """Bytes used on disk, WAL included."""
+        return sum(os.path.getsize(path) for path in (self.path, f'{self.path}-wal') if os.path.exists(path))
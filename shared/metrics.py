@@ -0,0 +1,250 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import shared.constants
+
+logger = logging.getLogger(__name__)
+
+# Seconds, suited for HTTP and database calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: Optional[tuple] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str = ''):
+        self.name = name
+        self.help_text = help_text
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help_text}'] if self.help_text else []
+        lines.append(f'# TYPE {self.name} counter')
+        with self._lock:
+            lines += [f'{self.name}{_format_labels(key)} {value}' for key, value in self._values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str = '', buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # Per label set: [count per bucket (+Inf last), sum, count]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def quantile(self, q: float, **labels) -> float:
+        """Upper bound of the bucket holding the q quantile, good enough for a log line."""
+        state = self._values.get(_label_key(labels))
+        if not state or not state[2]:
+            return 0.0
+        target = q * state[2]
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), state[0]):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help_text}'] if self.help_text else []
+        lines.append(f'# TYPE {self.name} histogram')
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'{self.name}_bucket{_format_labels(key, ("le", le))} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+class _Timer:
+    """Context manager observing the duration of the block and counting its errors."""
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, labels: dict):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.registry.histogram(f'{self.name}_seconds').observe(time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None:
+            self.registry.counter(f'{self.name}_errors_total').inc(**self.labels)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class MetricsRegistry:
+    """
+    Counters and latency histograms of the hot paths, rendered in the Prometheus text format.
+
+    When disabled, timer() hands out a shared no-op context manager and inc() returns right away, so instrumented code
+    pays about one attribute lookup.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._metrics: dict[str, Counter | Histogram] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str = '') -> Counter:
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, Counter(name, help_text))
+        return metric
+
+    def histogram(self, name: str, help_text: str = '', buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, Histogram(name, help_text, buckets))
+        return metric
+
+    def timer(self, name: str, **labels):
+        """
+        Time the block into the `{name}_seconds` histogram, exceptions also increment `{name}_errors_total`.
+
+            with REGISTRY.timer('api_request', endpoint='forecast.json'):
+                ...
+        """
+        if not self.enabled:
+            return _NOOP_TIMER
+        return _Timer(self, name, labels)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        if self.enabled:
+            self.counter(name).inc(amount, **labels)
+
+    def render(self) -> str:
+        lines = []
+        for name in sorted(self._metrics):
+            lines += self._metrics[name].render()
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """One line per timed operation: count, errors and approximate p50/p99, meant for logs."""
+        parts = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            if not isinstance(metric, Histogram):
+                continue
+            base = name.removesuffix('_seconds')
+            errors = self._metrics.get(f'{base}_errors_total')
+            for key, (_, total, count) in list(metric._values.items()):
+                labels = dict(key)
+                error_count = errors.value(**labels) if errors else 0
+                parts.append(
+                    f'{base}{_format_labels(key)} count={count} errors={error_count:.0f} '
+                    f'avg={total / count * 1000:.1f}ms p50<={metric.quantile(0.5, **labels) * 1000:.0f}ms '
+                    f'p99<={metric.quantile(0.99, **labels) * 1000:.0f}ms'
+                )
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            if isinstance(metric, Counter) and not name.endswith('_errors_total'):
+                parts += [f'{name}{_format_labels(key)} {value:.0f}' for key, value in list(metric._values.items())]
+        return '\n'.join(parts)
+
+    def start_http_server(self, port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+        """Serve the metrics on http://host:port/metrics from a background thread, for Prometheus to scrape."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+    def start_log_summary(self, interval: float) -> threading.Thread:
+        """Log the summary every `interval` seconds from a background thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                summary = self.summary()
+                if summary:
+                    logger.info(f"Metrics summary:\n{summary}")
+
+        thread = threading.Thread(target=run, name='metrics-log', daemon=True)
+        thread.start()
+        return thread
+
+
+REGISTRY = MetricsRegistry(enabled=shared.constants.METRICS_ENABLED)
+
+
+def start_exporters() -> None:
+    """Start the scrape endpoint and/or the periodic log summary configured through the METRICS_* variables."""
+    if not REGISTRY.enabled:
+        return
+    if shared.constants.METRICS_PORT:
+        REGISTRY.start_http_server(shared.constants.METRICS_PORT)
+    if shared.constants.METRICS_LOG_INTERVAL:
+        REGISTRY.start_log_summary(shared.constants.METRICS_LOG_INTERVAL)
@@ -1,3 +1,5 @@
+from typing import NamedTuple
+
 from pydantic import BaseModel
 
 
@@ -12,30 +14,68 @@ class UserData(BaseModel):
     agreement: bool = False
     subscription: bool = False
     active: bool = True
+    # Fingerprint of the last forecast delivered, only read by the automatic reports
+    last_forecast: list | None = None
 
-    def get_query_string(self):
-        return '''
-        INSERT INTO users (chat_id, latitude, longitude, agreement, subscription, active)
-        VALUES ({}, {}, {}, {}, {}, {})
-        '''.format(
-            self.chat_id, self.latitude, self.longitude, self.agreement, self.subscription, self.active
-        )
+    def to_database(self) -> tuple:
+        """
+        Return the values of the user in the order of database.database.USER_COLUMNS, the reverse of from_database.
+        """
+        return self.chat_id, self.latitude, self.longitude, self.agreement, self.subscription, self.active
 
     @classmethod
     def from_database(cls, db_data):
         """
         Create a UserData instance from database data.
+
+        The row must have the columns of database.database.USER_COLUMNS, in that order, optionally followed by
+        last_forecast.
         """
         return cls(
-            chat_id=db_data[1],
-            latitude=db_data[2],
-            longitude=db_data[3],
-            agreement=db_data[4],
-            subscription=db_data[5],
-            active=db_data[6],
+            chat_id=db_data[0],
+            latitude=db_data[1],
+            longitude=db_data[2],
+            agreement=db_data[3],
+            subscription=db_data[4],
+            active=db_data[5],
+            last_forecast=db_data[6] if len(db_data) > 6 else None,
         )
 
 
+class UserRow(NamedTuple):
+    """
+    Unvalidated user read from the database, same attributes as UserData.
+
+    The database already enforces the column types, so bulk reads skip the pydantic validation of every row. Input
+    coming from Telegram must still go through UserData.
+    """
+    chat_id: str
+    latitude: float | None
+    longitude: float | None
+    agreement: bool
+    subscription: bool
+    active: bool
+
+    def to_database(self) -> tuple:
+        return tuple(self)
+
+
+class SubscriberRow(NamedTuple):
+    """
+    UserRow with the fingerprint of the last forecast delivered, read by the automatic reports.
+    """
+    chat_id: str
+    latitude: float | None
+    longitude: float | None
+    agreement: bool
+    subscription: bool
+    active: bool
+    last_forecast: list | None
+
+    def to_database(self) -> tuple:
+        return tuple(self)[:6]
+
+
 # chat_id = db_data['chat_id'],
 # latitude = db_data['latitude'],
 # longitude = db_data['longitude'],
@@ -85,12 +125,18 @@ class WeatherLocation(BaseModel):
     tz_id: str
 
 
-class WeatherReport(BaseModel):
+class CurrentReport(BaseModel):
     """
-    DataClass representation of the WeatherAPI response
+    DataClass representation of the WeatherAPI current.json response
     """
     location: WeatherLocation
     current: CurrentWeather
+
+
+class WeatherReport(CurrentReport):
+    """
+    DataClass representation of the WeatherAPI response
+    """
     forecast: WeatherForecast
 
 
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Iterable, Optional
+
+import shared.constants
+from database.async_database import AsyncDatabaseConnector
+from shared.metrics import REGISTRY
+from shared.utils import Moment
+
+if TYPE_CHECKING:
+    # weather_api.transformer imports shared.cache
+    from weather_api.transformer import WeatherTransformer
+
+logger = logging.getLogger(__name__)
+
+
+class ForecastPrewarmer:
+    """
+    Refreshes the forecasts of the subscriber locations in the transformer cache ahead of their use.
+
+    The distinct subscriber locations are read from the users table and reduced to one per cache cell. The cells whose
+    forecast is missing or expires within `refresh_ahead` seconds are fetched with bulk requests. Until the new report
+    arrives the cached one keeps being served (stale-while-revalidate), so the dispatch and the bot handlers read warm
+    reports instead of waiting on WeatherAPI.
+    """
+
+    def __init__(
+            self,
+            transformer: 'WeatherTransformer',
+            db_connector: AsyncDatabaseConnector,
+            refresh_ahead: Optional[float] = None,
+    ):
+        """
+        :param refresh_ahead: Seconds before expiry a cached forecast is refreshed (defaults to PREWARM_REFRESH_AHEAD)
+        """
+        self.transformer = transformer
+        self.db_connector = db_connector
+        self.refresh_ahead = refresh_ahead if refresh_ahead is not None else shared.constants.PREWARM_REFRESH_AHEAD
+
+    async def cells(self, **filters) -> dict[str, tuple[float, float]]:
+        """One location per cache cell of the users matching the filters."""
+        cache = self.transformer.cache
+        locations = await self.db_connector.read_locations(**filters)
+        return {cache.cell(latitude, longitude): (latitude, longitude) for latitude, longitude in locations}
+
+    def due(
+            self,
+            locations: Iterable[tuple[float, float]],
+            moment: Moment = Moment.FORECAST,
+    ) -> list[tuple[float, float]]:
+        """The locations whose cell has no report or one that won't be fresh for the moment much longer."""
+        cache = self.transformer.cache
+        ttl = cache.ttl(moment)
+        return [
+            location for location in locations
+            if (age := cache.age(*location)) is None or age > ttl - self.refresh_ahead
+        ]
+
+    async def prewarm(self, moment: Moment = Moment.FORECAST, **filters) -> int:
+        """
+        Refresh the cells of the users matching the filters that won't be fresh for the moment much longer.
+
+        :param moment: Moment the reports must stay fresh for, Moment.CURRENT has a much shorter TTL
+        :return: the number of cells refreshed
+        """
+        cells = await self.cells(**filters)
+        # The ages may be read from the forecast store, one thread for all the cells keeps it off the event loop
+        due = await asyncio.to_thread(self.due, cells.values(), moment)
+        if not due:
+            return 0
+
+        with REGISTRY.timer('forecast_prewarm'):
+            reports = await self.transformer.get_reports_bulk_async(due, refresh=True)
+        REGISTRY.inc('forecast_prewarm_cells_total', len(reports))
+        logger.info(f"Prewarmed {len(reports)} of the {len(due)} due cells ({len(cells)} subscriber cells)")
+        return len(reports)
+
+    async def run_forever(self, interval: float, moment: Moment = Moment.FORECAST, **filters) -> None:
+        """Prewarm every `interval` seconds until cancelled."""
+        while True:
+            try:
+                await self.prewarm(moment, **filters)
+            except Exception as e:
+                # The readers fetch on demand meanwhile, the next round retries
+                logger.error(f"Failed to prewarm the forecasts: {e}")
+            await asyncio.sleep(interval)
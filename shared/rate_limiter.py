@@ -0,0 +1,69 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class TokenBucket:
+    """
+    Async token bucket, allows `rate` acquisitions per second with bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _reserve(self, tokens: float) -> float:
+        """Take the tokens if available and return 0, otherwise return the seconds to wait for them."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """Wait until the tokens are available and take them."""
+        async with self._lock:
+            while (wait := self._reserve(tokens)) > 0:
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for the given seconds, eg: after the API asked us to slow down."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+
+class KeyedTokenBucket:
+    """
+    One TokenBucket per key (eg: per chat_id), only the `max_keys` most recently used buckets are kept.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, max_keys: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+
+    def bucket(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    async def acquire(self, key: Hashable, tokens: float = 1.0) -> None:
+        await self.bucket(key).acquire(tokens)
@@ -0,0 +1,115 @@
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+import shared.constants
+from shared.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(ConnectionError):
+    """The upstream failed too often lately, the request was not sent."""
+
+
+class RetryPolicy:
+    """
+    How many times a failed request is attempted and how long to wait in between.
+
+    The waits grow exponentially from `base_delay` up to `max_delay`, with full jitter so clients that failed together
+    don't retry together.
+    """
+
+    def __init__(
+            self,
+            max_attempts: Optional[int] = None,
+            base_delay: Optional[float] = None,
+            max_delay: Optional[float] = None,
+    ):
+        """
+        :param max_attempts: Attempts per request, 1 disables the retries (defaults to HTTP_MAX_ATTEMPTS)
+        :param base_delay: Seconds of the first wait (defaults to HTTP_RETRY_BASE_DELAY)
+        :param max_delay: Upper bound of a single wait (defaults to HTTP_RETRY_MAX_DELAY)
+        """
+        self.max_attempts = max_attempts or shared.constants.HTTP_MAX_ATTEMPTS
+        self.base_delay = base_delay if base_delay is not None else shared.constants.HTTP_RETRY_BASE_DELAY
+        self.max_delay = max_delay if max_delay is not None else shared.constants.HTTP_RETRY_MAX_DELAY
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait after the failed `attempt` (0 based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Fails the requests fast while the upstream is unhealthy, instead of every caller waiting for its timeouts.
+
+    After `failure_threshold` consecutive failures the circuit opens and before_call raises CircuitOpenError. Once
+    `reset_timeout` seconds passed a single probe request is let through (half open): its success closes the circuit,
+    its failure opens it again. Thread safe, the sync requests run in several threads.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            failure_threshold: Optional[int] = None,
+            reset_timeout: Optional[float] = None,
+    ):
+        """
+        :param name: Label of the metrics and logs, usually the API
+        :param failure_threshold: Consecutive failures opening the circuit (defaults to BREAKER_FAILURE_THRESHOLD)
+        :param reset_timeout: Seconds before probing an open circuit (defaults to BREAKER_RESET_TIMEOUT)
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold or shared.constants.BREAKER_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout if reset_timeout is not None else shared.constants.BREAKER_RESET_TIMEOUT
+
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        # When the probe of the half open circuit was let through, a probe that never reports (eg: cancelled) is
+        # replaced after reset_timeout
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"Circuit breaker of {self.name} is now {state}")
+            REGISTRY.inc('circuit_breaker_transitions_total', breaker=self.name, state=state)
+            self.state = state
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError when the request must not be sent."""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN and (
+                    self._probe_started is None or now - self._probe_started >= self.reset_timeout
+            ):
+                self._probe_started = now
+                return
+        REGISTRY.inc('circuit_breaker_rejections_total', breaker=self.name)
+        raise CircuitOpenError(f'{self.name} is failing, not sending the request for now')
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._probe_started = None
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probe_started = None
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
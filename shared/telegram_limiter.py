@@ -0,0 +1,363 @@
+import abc
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Coroutine, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import shared.constants
+from database.database import DatabaseConnector
+from shared.metrics import REGISTRY
+from shared.utils import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Lanes of the requests, passed as rate_limit_args. Requests without rate_limit_args are interactive
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# Bucket of the Bot API global limit of the bot token
+GLOBAL_KEY = 'telegram:global'
+# Seconds the process limits itself alone after the shared store failed, before trying it again
+STORE_RETRY_SECONDS = 5.0
+
+
+def _step(
+        tokens: float,
+        elapsed: float,
+        paused_for: float,
+        rate: float,
+        capacity: float,
+        reserve: float,
+) -> tuple[float, float]:
+    """
+    Refill the bucket and take a token when more than `reserve` are left.
+
+    :return: the tokens left and the seconds to wait before trying again, 0 when the token was taken
+    """
+    if paused_for > 0:
+        return 0.0, paused_for
+    tokens = min(capacity, tokens + elapsed * rate)
+    if tokens >= 1 + reserve:
+        return tokens - 1, 0.0
+    return tokens, (1 + reserve - tokens) / rate
+
+
+class BucketStore(abc.ABC):
+    """Token buckets shared by the processes sending with the bot token."""
+
+    # Whether take and pause do I/O, and must run in a thread
+    blocking = True
+
+    @abc.abstractmethod
+    def take(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        """
+        Take a token of the bucket when more than `reserve` tokens are left.
+
+        Must override function when inheriting from this class
+        :return: 0 when the token was taken, the seconds to wait before trying again otherwise
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def pause(self, key: str, seconds: float) -> None:
+        """
+        Empty the bucket and stop handing out tokens for the given seconds.
+
+        Must override function when inheriting from this class
+        """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBucketStore(BucketStore):
+    """Buckets of this process only, used when no shared backend is configured and while the shared one fails."""
+
+    blocking = False
+
+    def __init__(self):
+        # key -> [tokens, updated_at, paused_until]
+        self._buckets: dict[str, list[float]] = {}
+
+    def take(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.setdefault(key, [capacity, now, 0.0])
+        bucket[0], wait = _step(bucket[0], now - bucket[1], bucket[2] - now, rate, capacity, reserve)
+        bucket[1] = now
+        return wait
+
+    def pause(self, key: str, seconds: float) -> None:
+        now = time.monotonic()
+        bucket = self._buckets.setdefault(key, [0.0, now, 0.0])
+        bucket[0] = 0.0
+        bucket[2] = max(bucket[2], now + seconds)
+
+
+class PostgresBucketStore(BucketStore):
+    """
+    Buckets in the rate_limit_buckets table, shared by every process of every host using the database.
+
+    A take is a single statement holding the row lock of the bucket, timed with the database clock so the clocks of
+    the hosts don't have to agree.
+    """
+
+    TAKE_QUERY = '''
+        WITH bucket AS (
+            SELECT key, tokens,
+                EXTRACT(EPOCH FROM clock_timestamp() - updated_at)::double precision AS elapsed,
+                COALESCE(EXTRACT(EPOCH FROM paused_until - clock_timestamp())::double precision, 0) AS paused_for,
+                clock_timestamp() AS now
+            FROM rate_limit_buckets WHERE key = %(key)s
+            FOR UPDATE
+        ), refilled AS (
+            SELECT key, now, paused_for, LEAST(%(capacity)s, tokens + elapsed * %(rate)s) AS tokens FROM bucket
+        )
+        UPDATE rate_limit_buckets SET
+            tokens = CASE
+                WHEN refilled.paused_for > 0 THEN 0
+                WHEN refilled.tokens >= 1 + %(reserve)s THEN refilled.tokens - 1
+                ELSE refilled.tokens
+            END,
+            updated_at = refilled.now
+        FROM refilled WHERE rate_limit_buckets.key = refilled.key
+        RETURNING CASE
+            WHEN refilled.paused_for > 0 THEN refilled.paused_for
+            WHEN refilled.tokens >= 1 + %(reserve)s THEN 0
+            ELSE (1 + %(reserve)s - refilled.tokens) / %(rate)s
+        END
+    '''
+
+    def __init__(self, db_connector: DatabaseConnector):
+        self.db_connector = db_connector
+        # Buckets known to have a row, created on their first take
+        self._created: set[str] = set()
+
+    def take(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            if key not in self._created:
+                cursor.execute(
+                    'INSERT INTO rate_limit_buckets (key, tokens) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING',
+                    (key, capacity),
+                )
+                self._created.add(key)
+            cursor.execute(self.TAKE_QUERY, {'key': key, 'rate': rate, 'capacity': capacity, 'reserve': reserve})
+            row = cursor.fetchone()
+        if row is None:
+            # Deleted meanwhile, created again by the next take
+            self._created.discard(key)
+            return 0.0
+        return row[0]
+
+    def pause(self, key: str, seconds: float) -> None:
+        with self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                UPDATE rate_limit_buckets
+                SET tokens = 0, paused_until = GREATEST(paused_until, clock_timestamp() + make_interval(secs => %s))
+                WHERE key = %s
+            ''', (seconds, key))
+
+
+class SQLiteBucketStore(BucketStore):
+    """
+    Buckets in a SQLite file, shared by the processes of a single host without a database server.
+
+    Each take is an immediate transaction, the processes queue on the database lock for up to `busy_timeout` seconds.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        # sqlite3 connections can't be shared between threads, each thread opens its own
+        self._local = threading.local()
+        self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    paused_until REAL NOT NULL DEFAULT 0
+                )
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def _update(self, key: str, update: Callable[[float, float, float, float], tuple[float, float, float]]) -> float:
+        """Run `update(tokens, updated_at, paused_until, now)` -> (tokens, paused_until, result) in a transaction."""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute(
+                'SELECT tokens, updated_at, paused_until FROM rate_limit_buckets WHERE key = ?', (key,)
+            ).fetchone()
+            tokens, paused_until, result = update(*(row or (None, now, 0.0)), now)
+            conn.execute('''
+                INSERT INTO rate_limit_buckets (key, tokens, updated_at, paused_until) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = excluded.tokens, updated_at = excluded.updated_at, paused_until = excluded.paused_until
+            ''', (key, tokens, now, paused_until))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def take(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        def update(tokens, updated_at, paused_until, now):
+            tokens = capacity if tokens is None else tokens
+            tokens, wait = _step(tokens, now - updated_at, paused_until - now, rate, capacity, reserve)
+            return tokens, paused_until, wait
+
+        return self._update(key, update)
+
+    def pause(self, key: str, seconds: float) -> None:
+        self._update(key, lambda tokens, updated_at, paused_until, now: (0.0, max(paused_until, now + seconds), None))
+
+    def close(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class SharedTokenBucket:
+    """
+    The global token bucket of the bot token, kept in a BucketStore so every process draws from the same tokens.
+
+    Requests take a lane. Bulk requests (the automatic reports) only take a token while more than `interactive_reserve`
+    are left, so the replies of the bot find tokens even while a broadcast runs in another process. Within a process
+    the bulk requests also wait while interactive ones are queued. Only one request per lane polls the store at a
+    time, the others queue behind it.
+
+    When the store fails the process falls back to a bucket of its own, so the sends go on at the full rate of a
+    single process.
+    """
+
+    def __init__(
+            self,
+            store: BucketStore,
+            key: str = GLOBAL_KEY,
+            rate: Optional[float] = None,
+            capacity: Optional[float] = None,
+            interactive_reserve: Optional[float] = None,
+    ):
+        """
+        :param rate: Tokens per second (defaults to TELEGRAM_GLOBAL_RATE)
+        :param capacity: Burst size, defaults to a second of tokens
+        :param interactive_reserve: Tokens bulk requests leave (defaults to RATE_LIMIT_INTERACTIVE_RESERVE)
+        """
+        self.store = store
+        self.key = key
+        self.rate = rate or shared.constants.TELEGRAM_GLOBAL_RATE
+        self.capacity = capacity if capacity is not None else max(self.rate, 1.0)
+        reserve = (
+            interactive_reserve if interactive_reserve is not None
+            else shared.constants.RATE_LIMIT_INTERACTIVE_RESERVE
+        )
+        # Bulk requests could never take a token otherwise
+        self.interactive_reserve = min(reserve, self.capacity - 1)
+
+        self._fallback = MemoryBucketStore()
+        self._store_retry_at = 0.0
+        self._locks = {INTERACTIVE: asyncio.Lock(), BULK: asyncio.Lock()}
+        self._waiting = {INTERACTIVE: 0, BULK: 0}
+
+    async def _call(self, method: str, *args):
+        if time.monotonic() >= self._store_retry_at:
+            try:
+                if self.store.blocking:
+                    return await asyncio.to_thread(getattr(self.store, method), self.key, *args)
+                return getattr(self.store, method)(self.key, *args)
+            except Exception as e:
+                logger.error(f"Failed to use the shared rate limit bucket, limiting this process alone for now: {e}")
+                REGISTRY.inc('telegram_rate_limit_store_errors_total')
+                self._store_retry_at = time.monotonic() + STORE_RETRY_SECONDS
+        return getattr(self._fallback, method)(self.key, *args)
+
+    async def acquire(self, lane: str = INTERACTIVE) -> None:
+        """Wait until a token of the lane is available and take it."""
+        reserve = self.interactive_reserve if lane == BULK else 0.0
+        self._waiting[lane] += 1
+        try:
+            async with self._locks[lane]:
+                while True:
+                    if lane == BULK and self._waiting[INTERACTIVE]:
+                        # The replies waiting in this process go first
+                        wait = 1 / self.rate
+                    else:
+                        wait = await self._call('take', self.rate, self.capacity, reserve)
+                    if wait <= 0:
+                        return
+                    await asyncio.sleep(wait)
+        finally:
+            self._waiting[lane] -= 1
+
+    async def pause(self, seconds: float) -> None:
+        """Stop every process for the given seconds, eg: after a flood wait."""
+        self._fallback.pause(self.key, seconds)
+        await self._call('pause', seconds)
+
+    def close(self) -> None:
+        self.store.close()
+
+
+class TelegramRateLimiter(BaseRateLimiter[str]):
+    """
+    Rate limiter of the Bot API requests of an Application, drawing from a SharedTokenBucket.
+
+    Pass it to Application.builder().rate_limiter(...) in every process using the bot token. The bot replies go
+    through the interactive lane, the automatic reports pass rate_limit_args=BULK. A flood wait pauses the bucket of
+    every process and is raised to the caller, which decides whether to retry.
+    """
+
+    def __init__(self, bucket: SharedTokenBucket):
+        self.bucket = bucket
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self.bucket.close()
+
+    async def process_request(
+            self,
+            callback: Callable[..., Coroutine[Any, Any, Any]],
+            args: Any,
+            kwargs: dict[str, Any],
+            endpoint: str,
+            data: dict[str, Any],
+            rate_limit_args: Optional[str],
+    ) -> Any:
+        lane = rate_limit_args or INTERACTIVE
+        with REGISTRY.timer('telegram_rate_limit_wait', lane=lane):
+            await self.bucket.acquire(lane)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            wait = retry_after_seconds(e.retry_after)
+            logger.warning(f"Flood wait of {wait}s from Telegram on {endpoint}, pausing every sender")
+            await self.bucket.pause(wait)
+            raise
+
+
+def rate_limiter_from_env(db_connector: DatabaseConnector) -> TelegramRateLimiter:
+    """TelegramRateLimiter with the store configured through RATE_LIMIT_BACKEND ('postgres', 'sqlite' or empty)."""
+    if not shared.constants.RATE_LIMIT_BACKEND:
+        return TelegramRateLimiter(SharedTokenBucket(MemoryBucketStore()))
+    if shared.constants.RATE_LIMIT_BACKEND == 'sqlite':
+        return TelegramRateLimiter(SharedTokenBucket(SQLiteBucketStore(shared.constants.RATE_LIMIT_PATH)))
+    if shared.constants.RATE_LIMIT_BACKEND == 'postgres':
+        return TelegramRateLimiter(SharedTokenBucket(PostgresBucketStore(db_connector)))
+    raise ValueError(f'Error detail: Unknown RATE_LIMIT_BACKEND {shared.constants.RATE_LIMIT_BACKEND}')
@@ -0,0 +1,15 @@
+from telegram.request import HTTPXRequest
+
+from shared.metrics import REGISTRY
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest timing every Bot API call into the telegram_request metrics, labelled by Bot API method.
+
+    Pass it to Application.builder().request(...) so the bot replies and the automatic reports are both measured.
+    """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with REGISTRY.timer('telegram_request', method=url.rsplit('/', 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
@@ -1,4 +1,5 @@
 import abc
+import asyncio
 from typing import Type, TypeVar, Any
 
 from shared.connector import APIConnector
@@ -38,3 +39,18 @@ class BaseTransformer(abc.ABC):
         """
         raise NotImplementedError()
         # eg: self.connector.get_forecast(location)
+
+    async def transform_async(self, *args, **kwargs) -> Any:
+        """
+        Awaitable version of transform.
+
+        By default the sync transform is offloaded to a thread so it does not block the event loop, child classes with
+        an async connector should override it.
+        """
+        return await asyncio.to_thread(self.transform, *args, **kwargs)
+
+    async def get_data_async(self, *args, **kwargs):
+        """
+        Awaitable version of get_data, offloaded to a thread unless overridden by the child class.
+        """
+        return await asyncio.to_thread(self.get_data, *args, **kwargs)
@@ -1,3 +1,4 @@
+from datetime import timedelta
 from enum import Enum
 
 
@@ -5,3 +6,57 @@ class Moment(Enum):
     CURRENT = 'current'
     FORECAST = 'forecast'
     FULL = 'full'
+
+
+def retry_after_seconds(value: int | float | timedelta) -> float:
+    """RetryAfter.retry_after is an int in older python-telegram-bot versions and a timedelta in newer ones."""
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+_GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(latitude: float, longitude: float, precision: int = 6) -> str:
+    """
+    Encode a coordinate into a geohash of the given length.
+
+    Nearby coordinates share a prefix, a length of 5 is a cell of about 5km and 6 of about 1km.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def location_cell(latitude: float, longitude: float, mode: str = 'round', precision: int = 2) -> str:
+    """
+    Bucket a coordinate into a location cell, users in the same cell get the same weather data.
+
+    :param mode: 'round' to round the coordinates to `precision` decimals (2 decimals is about 1km),
+                 'geohash' to use a geohash prefix of `precision` characters
+    """
+    if mode == 'round':
+        # float() so 10 and 10.0 share a cell, + 0.0 turns the -0.0 of a coordinate rounded to 0 into 0.0
+        return f'{round(float(latitude), precision) + 0.0},{round(float(longitude), precision) + 0.0}'
+    elif mode == 'geohash':
+        return geohash(latitude, longitude, precision)
+    else:
+        raise ValueError(f'Unknown location cell mode: {mode}')
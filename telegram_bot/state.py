@@ -0,0 +1,262 @@
+import abc
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import select
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import psycopg2
+from psycopg2.extras import Json
+
+import shared.constants
+from database.database import DatabaseConnector
+from shared.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Postgres channel announcing the chats whose state changed, payload '<instance id>:<chat_id>'
+STATE_CHANNEL = 'conversation_state'
+
+
+class StateBackend(abc.ABC):
+    """Persistent storage of the conversation state of every chat, a json-serializable dict per chat."""
+
+    @abc.abstractmethod
+    def get(self, chat_id: str) -> Optional[dict]:
+        """
+        Return the stored state of the chat, None when there is none.
+
+        Must override function when inheriting from this class
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def set(self, chat_id: str, state: dict) -> None:
+        """
+        Store the whole state of the chat.
+
+        Must override function when inheriting from this class
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def delete(self, chat_id: str) -> None:
+        raise NotImplementedError()
+
+    def subscribe(self, instance_id: str, callback: Callable[[Optional[str]], None]) -> None:
+        """
+        Call `callback(chat_id)` whenever another instance changes the state of a chat, so it can be evicted from
+        the local caches, or `callback(None)` when every chat may have changed. Backends that can't tell don't
+        override it and rely on the cache TTL.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class PostgresStateBackend(StateBackend):
+    """
+    State in the conversation_state table, shared by every bot instance using the database.
+
+    Every write notifies the other instances on the conversation_state channel (LISTEN/NOTIFY), the notification is
+    sent when the write commits.
+    """
+
+    def __init__(self, db_connector: DatabaseConnector):
+        self.db_connector = db_connector
+        self.instance_id: Optional[str] = None
+        self._listener: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def get(self, chat_id: str) -> Optional[dict]:
+        with REGISTRY.timer('db_query', method='get_state'), self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('SELECT state FROM conversation_state WHERE chat_id = %s', (chat_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def set(self, chat_id: str, state: dict) -> None:
+        with REGISTRY.timer('db_query', method='set_state'), self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO conversation_state (chat_id, state) VALUES (%s, %s)
+                ON CONFLICT (chat_id) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+            ''', (chat_id, Json(state)))
+            self._notify(cursor, chat_id)
+
+    def delete(self, chat_id: str) -> None:
+        with REGISTRY.timer('db_query', method='delete_state'), self.db_connector.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('DELETE FROM conversation_state WHERE chat_id = %s', (chat_id,))
+            self._notify(cursor, chat_id)
+
+    def _notify(self, cursor, chat_id: str) -> None:
+        if self.instance_id is not None:
+            cursor.execute('SELECT pg_notify(%s, %s)', (STATE_CHANNEL, f'{self.instance_id}:{chat_id}'))
+
+    def subscribe(self, instance_id: str, callback: Callable[[Optional[str]], None]) -> None:
+        self.instance_id = instance_id
+        self._listener = threading.Thread(
+            target=self._listen, args=(callback,), name='conversation-state-listener', daemon=True
+        )
+        self._listener.start()
+
+    def _listen(self, callback: Callable[[Optional[str]], None]) -> None:
+        """Forward the notifications of the other instances, reconnecting when the connection drops."""
+        while not self._stopped.is_set():
+            try:
+                # Held for as long as the bot runs, so it doesn't take a connection of the pool
+                conn = psycopg2.connect(**self.db_connector.db_params)
+            except psycopg2.Error as e:
+                logger.warning(f"Failed to listen for conversation state changes: {e}")
+                self._stopped.wait(5)
+                continue
+            try:
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {STATE_CHANNEL}')
+                # Changes made while disconnected were missed
+                callback(None)
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        instance_id, _, chat_id = conn.notifies.pop(0).payload.partition(':')
+                        if instance_id != self.instance_id:
+                            callback(chat_id)
+            except psycopg2.Error as e:
+                logger.warning(f"Lost the conversation state listener connection: {e}")
+            finally:
+                conn.close()
+
+    def close(self) -> None:
+        self._stopped.set()
+
+
+class FileStateBackend(StateBackend):
+    """
+    State in one json file per chat, for local runs without Postgres.
+
+    Instances on the same host can share the directory, they don't notify each other so keep the cache TTL short.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = pathlib.Path(directory or shared.constants.STATE_FILE_DIR)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, chat_id: str) -> pathlib.Path:
+        return self.directory / f'{chat_id}.json'
+
+    def get(self, chat_id: str) -> Optional[dict]:
+        try:
+            return json.loads(self._path(chat_id).read_text())
+        except FileNotFoundError:
+            return None
+
+    def set(self, chat_id: str, state: dict) -> None:
+        # Write then rename, a reader never sees a half written file
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(state, file)
+        os.replace(temporary, self._path(chat_id))
+
+    def delete(self, chat_id: str) -> None:
+        self._path(chat_id).unlink(missing_ok=True)
+
+
+class ConversationState:
+    """
+    Per-chat conversation state (eg: the last button pressed), stored in a StateBackend behind a write-through LRU.
+
+    Writes go to the backend first, then to the cache, so the state survives restarts and any instance can serve the
+    next update of the chat. Reads are served from the cache while the entry is younger than `ttl` seconds. The
+    backend tells when another instance changed a chat (see StateBackend.subscribe) and the entry is evicted, the TTL
+    only bounds staleness when a notification is missed.
+    """
+
+    def __init__(self, backend: StateBackend, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        :param max_entries: Chats kept in memory (defaults to STATE_CACHE_MAX_ENTRIES)
+        :param ttl: Seconds a cached state is served without reading the backend (defaults to STATE_CACHE_TTL)
+        """
+        self.backend = backend
+        self.max_entries = max_entries or shared.constants.STATE_CACHE_MAX_ENTRIES
+        self.ttl = ttl if ttl is not None else shared.constants.STATE_CACHE_TTL
+        self.instance_id = uuid.uuid4().hex
+
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        # Notifications arrive on the listener thread
+        self._lock = threading.Lock()
+        self._subscribed = False
+
+    def _subscribe(self) -> None:
+        # On first use, so building the bot doesn't open a connection
+        if not self._subscribed:
+            self._subscribed = True
+            self.backend.subscribe(self.instance_id, self.invalidate)
+
+    def invalidate(self, chat_id: Optional[str] = None) -> None:
+        """Evict the chat from the cache, or every chat when None."""
+        with self._lock:
+            if chat_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(chat_id, None)
+
+    def _cache(self, chat_id: str, state: dict) -> None:
+        with self._lock:
+            self._entries[chat_id] = (time.monotonic(), state)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def get(self, chat_id) -> dict:
+        """Return the state of the chat, an empty dict when it has none."""
+        chat_id = str(chat_id)
+        self._subscribe()
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+                self._entries.move_to_end(chat_id)
+                REGISTRY.inc('conversation_state_lookups_total', result='hit')
+                return dict(entry[1])
+
+        REGISTRY.inc('conversation_state_lookups_total', result='miss')
+        try:
+            state = await asyncio.to_thread(self.backend.get, chat_id) or {}
+        except Exception as e:
+            # Handle the update as a new conversation rather than failing it
+            logger.error(f"Failed to read the conversation state of chat {chat_id}: {e}")
+            return {}
+        self._cache(chat_id, state)
+        return dict(state)
+
+    async def update(self, chat_id, **values) -> dict:
+        """Merge the values into the state of the chat and store it, returns the new state."""
+        state = {**await self.get(chat_id), **values}
+        chat_id = str(chat_id)
+        await asyncio.to_thread(self.backend.set, chat_id, state)
+        self._cache(chat_id, state)
+        return dict(state)
+
+    async def clear(self, chat_id) -> None:
+        chat_id = str(chat_id)
+        await asyncio.to_thread(self.backend.delete, chat_id)
+        self.invalidate(chat_id)
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+def state_from_env(db_connector: DatabaseConnector) -> ConversationState:
+    """ConversationState with the backend configured through STATE_BACKEND ('postgres' or 'file')."""
+    if shared.constants.STATE_BACKEND == 'file':
+        return ConversationState(FileStateBackend())
+    if shared.constants.STATE_BACKEND == 'postgres':
+        return ConversationState(PostgresStateBackend(db_connector))
+    raise ValueError(f'Error detail: Unknown STATE_BACKEND {shared.constants.STATE_BACKEND}')
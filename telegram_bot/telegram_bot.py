@@ -2,6 +2,7 @@
 # pylint: disable=unused-argument, import-error
 # This program is dedicated to the public domain under the CC0 license.
 
+import asyncio
 import logging
 import os
 
@@ -9,13 +10,22 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKe
 from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, CallbackContext
 from telegram.ext.filters import LOCATION
 
+import shared.constants
 from shared.models import UserData
+from shared.cache import ForecastCache
+from shared.prewarm import ForecastPrewarmer
+from shared.metrics import start_exporters
+from shared.telegram_limiter import rate_limiter_from_env
+from shared.telegram_request import InstrumentedRequest
 from weather_api.transformer import WeatherTransformer
 from weather_api.weather_api_connector import WeatherAPIConnector
 
 from shared.utils import Moment
 
+from database.async_database import AsyncDatabaseConnector
 from database.database import DatabaseConnector
+from telegram_bot.state import ConversationState, state_from_env
+from telegram_bot.webhook import run_webhook
 
 # Enable logging
 logging.basicConfig(
@@ -28,15 +38,43 @@ logger = logging.getLogger(__name__)
 
 
 class TelegramBot:
-    def __init__(self, application: Application, url: str):
+    def __init__(self, application: Application, url: str, state: ConversationState | None = None):
+        """
+        :param state: Where the conversation flow of every chat is kept, defaults to the STATE_BACKEND one
+        """
         self.connector = WeatherAPIConnector(url=url)
-        self.transformer = WeatherTransformer(connector=self.connector)
+        self.transformer = WeatherTransformer(connector=self.connector, cache=ForecastCache())
+        self.db_connector = AsyncDatabaseConnector.from_env()
+        self.state = state or state_from_env(self.db_connector.db_connector)
+        self.prewarmer = ForecastPrewarmer(self.transformer, self.db_connector)
+        self._prewarm_task: asyncio.Task | None = None
 
         self.application = application
         self.application.add_handler(CommandHandler('start', self.start))
         self.application.add_handler(CallbackQueryHandler(self.button))
         self.application.add_handler(MessageHandler(LOCATION, self.handle_location))
         self.application.add_handler(CommandHandler('help', self.help_command))
+        self.application.post_init = self.post_init
+        self.application.post_shutdown = self.shutdown
+
+    async def post_init(self, application: Application) -> None:
+        """
+        With PREWARM_INTERVAL set, keeps the reports of the subscriber locations warm, so their current weather is
+        answered from the cache.
+        """
+        if shared.constants.PREWARM_INTERVAL:
+            self._prewarm_task = asyncio.create_task(self.prewarmer.run_forever(
+                shared.constants.PREWARM_INTERVAL, Moment.CURRENT, agreement=True, subscription=True, active=True
+            ))
+
+    async def shutdown(self, application: Application) -> None:
+        """Releases the pooled WeatherAPI and database connections when the application stops."""
+        if self._prewarm_task is not None:
+            self._prewarm_task.cancel()
+        await self.connector.aclose()
+        self.state.close()
+        self.db_connector.close()
+        self.db_connector.pool.close()
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Sends a message with three inline buttons attached."""
@@ -64,9 +102,9 @@ class TelegramBot:
                 text="Please share your location, using the command button.",
                 reply_markup=reply_markup
             )
-            context.user_data['last_button'] = 'current'
+            await self.state.update(update.effective_chat.id, last_button='current')
         elif callback_data.data == 'automation':
-            context.user_data['last_button'] = 'automation'
+            await self.state.update(update.effective_chat.id, last_button='automation')
             await self.consent_confirmation_button(update, context)
         elif callback_data.data == 'confirm':
             reply_markup = self.create_location_sharing_button()
@@ -89,15 +127,16 @@ class TelegramBot:
     async def handle_location(self, update: Update, context: CallbackContext) -> None:
         user_location = update.message.location
         logger.warning(f"Location of the user is: {user_location}")
-        if not context.user_data or context.user_data['last_button'] == 'current':
+        state = await self.state.get(update.effective_chat.id)
+        if not state or state.get('last_button') == 'current':
             await update.message.reply_text(
                 text='Sending current weather conditions. If you want to subscribe for automated updates, send the command /start and select the button subscribe to automated updates.'
             )
-            weather_update = self.transformer.transform(user_location.latitude, user_location.longitude, Moment.CURRENT)
+            weather_update = await self.transformer.transform_async(user_location.latitude, user_location.longitude, Moment.CURRENT)
             await update.message.reply_text(
                 text=f"{weather_update}"
             )
-        elif context.user_data['last_button'] == 'automation':
+        elif state.get('last_button') == 'automation':
             user_data_to_save = UserData(
                 chat_id=update.effective_chat.id,
                 latitude=user_location.latitude,
@@ -106,7 +145,7 @@ class TelegramBot:
                 subscription=True,
                 active=True
             )
-            self.insert_user_data_into_db(user_data_to_save)
+            await self.insert_user_data_into_db(user_data_to_save)
             await update.message.reply_text(
                 text='You location will be saved in order to send you automated weather updates.'
             )
@@ -130,29 +169,31 @@ class TelegramBot:
         reply_markup = ReplyKeyboardMarkup(custom_keyboard, one_time_keyboard=True)
         return reply_markup
 
-    @staticmethod
-    def insert_user_data_into_db(user_data: UserData):
-        db_conn = DatabaseConnector(
-            db_name=os.environ.get('DB_NAME', None),
-            user=os.environ.get('DB_USER', None),
-            password=os.environ.get('DB_PASSWORD', None),
-            host=os.environ.get('DB_HOST', 'localhost'),
-            port=os.environ.get('DB_PORT', '5432'),
-        )
-        db_conn.insert_user(user_data)
-        db_conn._commit_and_close()
+    async def insert_user_data_into_db(self, user_data: UserData):
+        await self.db_connector.insert_user(user_data)
 
 
 def main() -> None:
     """Run the bot."""
     tel_token = os.environ.get("TEL_API_KEY", None)
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(tel_token).build()
+    application = (
+        Application.builder()
+        .token(tel_token)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(rate_limiter_from_env(DatabaseConnector.from_env()))
+        .build()
+    )
+    start_exporters()
 
     bot = TelegramBot(application, 'http://api.weatherapi.com/v1')
+    DatabaseConnector.from_env().ensure_schema()
 
     # Run the bot until the user presses Ctrl-C
-    bot.application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if shared.constants.WEBHOOK_URL:
+        asyncio.run(run_webhook(bot.application, shared.constants.WEBHOOK_URL))
+    else:
+        bot.application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,233 @@
+import asyncio
+import hmac
+import http
+import json
+import logging
+import signal
+from typing import Optional
+from urllib.parse import urlparse
+
+from telegram import Update
+from telegram.ext import Application
+
+import shared.constants
+from shared.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+# Telegram updates are a few KB, anything bigger is not from Telegram
+MAX_BODY_SIZE = 1024 * 1024
+# Seconds an idle keep-alive connection is kept open
+IDLE_TIMEOUT = 75
+
+
+class WebhookServer:
+    """
+    Minimal asyncio HTTP receiver of the Telegram webhook, feeding the updates to the Application handlers.
+
+    The receiver only checks the secret token, parses the Update and queues it, then answers 200 right away, so a slow
+    handler never delays Telegram. `workers` tasks run application.process_update. Updates of a chat always go to the
+    same worker queue, which keeps them in order (eg: a button press before the location that follows it). When the
+    queues are full the receiver answers 503 and Telegram delivers the update again later.
+
+    Several processes can listen on the same port (reuse_port) or run on several hosts behind a load balancer, the
+    webhook is registered once per bot with set_webhook.
+    """
+
+    def __init__(
+            self,
+            application: Application,
+            host: Optional[str] = None,
+            port: Optional[int] = None,
+            path: Optional[str] = None,
+            secret_token: Optional[str] = None,
+            workers: Optional[int] = None,
+            queue_size: Optional[int] = None,
+            reuse_port: Optional[bool] = None,
+    ):
+        """
+        :param host: Interface to listen on (defaults to WEBHOOK_LISTEN)
+        :param port: Port to listen on, 0 picks a free one (defaults to WEBHOOK_PORT)
+        :param path: Path Telegram posts the updates to (defaults to WEBHOOK_PATH, then /)
+        :param secret_token: Token Telegram sends in every request, requests without it are rejected (defaults to WEBHOOK_SECRET_TOKEN)
+        :param workers: Tasks processing the updates (defaults to WEBHOOK_WORKERS)
+        :param queue_size: Updates waiting per worker before answering 503 (defaults to WEBHOOK_QUEUE_SIZE)
+        :param reuse_port: Let other processes listen on the same port, the kernel spreads the connections (Linux)
+        """
+        self.application = application
+        self.host = host or shared.constants.WEBHOOK_LISTEN
+        self.port = port if port is not None else shared.constants.WEBHOOK_PORT
+        self.path = path or shared.constants.WEBHOOK_PATH or '/'
+        self.secret_token = secret_token or shared.constants.WEBHOOK_SECRET_TOKEN
+        self.workers = workers or shared.constants.WEBHOOK_WORKERS
+        self.queue_size = queue_size or shared.constants.WEBHOOK_QUEUE_SIZE
+        self.reuse_port = reuse_port if reuse_port is not None else shared.constants.WEBHOOK_REUSE_PORT
+
+        self._queues: list[asyncio.Queue] = []
+        self._tasks: list[asyncio.Task] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: set[asyncio.StreamWriter] = set()
+
+    @property
+    def url(self) -> str:
+        """Local url of the receiver, useful when listening on port 0."""
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}{self.path}'
+
+    async def start(self) -> 'WebhookServer':
+        self._queues = [asyncio.Queue(self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, reuse_port=self.reuse_port or None
+        )
+        logger.info(f"Receiving Telegram updates on {self.host}:{self.port}{self.path} with {self.workers} workers")
+        if not self.secret_token:
+            logger.warning("The webhook has no secret token, it accepts updates from anyone reaching the port")
+        return self
+
+    async def join(self) -> None:
+        """Wait until every queued update is processed."""
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+    async def stop(self) -> None:
+        """Stop receiving, then process the updates already acknowledged to Telegram before stopping the workers."""
+        if self._server is not None:
+            self._server.close()
+            # wait_closed also waits for the idle keep-alive connections
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+        await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def __aenter__(self) -> 'WebhookServer':
+        return await self.start()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            update = await queue.get()
+            try:
+                with REGISTRY.timer('webhook_update'):
+                    await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Failed to process update {update.update_id}: {e}")
+            finally:
+                queue.task_done()
+
+    def _queue_for(self, update: Update) -> asyncio.Queue:
+        chat = update.effective_chat or update.effective_user
+        key = chat.id if chat is not None else update.update_id
+        return self._queues[key % len(self._queues)]
+
+    def handle(self, method: str, path: str, headers: dict[str, str], body: bytes) -> int:
+        """Check and queue a single request, returns the HTTP status to answer."""
+        if method == 'GET' and path == '/healthz':
+            return 200
+        if path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if self.secret_token and not hmac.compare_digest(
+                headers.get(SECRET_TOKEN_HEADER, '').encode(), self.secret_token.encode()
+        ):
+            REGISTRY.inc('webhook_updates_total', status='unauthorized')
+            return 403
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Received an invalid update: {e}")
+            REGISTRY.inc('webhook_updates_total', status='invalid')
+            return 400
+        try:
+            self._queue_for(update).put_nowait(update)
+        except asyncio.QueueFull:
+            REGISTRY.inc('webhook_updates_total', status='rejected')
+            return 503
+        REGISTRY.inc('webhook_updates_total', status='queued')
+        return 200
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve the HTTP/1.1 requests of a connection, Telegram keeps them alive between updates."""
+        self._connections.add(writer)
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split(maxsplit=2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY_SIZE:
+                    status, keep_alive = 413, False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status = self.handle(method, urlparse(target).path, headers, body)
+                    keep_alive = version.strip() == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                writer.write(
+                    f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+                    f'Content-Length: 0\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1')
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # Idle, dropped or malformed connection, nothing to answer
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+
+async def run_webhook(application: Application, webhook_url: str, **server_options) -> None:
+    """
+    Register the webhook and serve it until SIGINT/SIGTERM, the webhook counterpart of application.run_polling.
+
+    Refuses to start without a secret token: anyone reaching the port could post forged updates otherwise, and
+    subscribe or overwrite any chat_id.
+
+    :param webhook_url: Public url Telegram posts the updates to, its path is the one served unless `path` is given
+    :param server_options: Overrides of the WebhookServer settings
+    """
+    if not (server_options.get('secret_token') or shared.constants.WEBHOOK_SECRET_TOKEN):
+        raise ValueError('Error detail: WEBHOOK_SECRET_TOKEN must be set to receive the updates through a webhook')
+    server_options.setdefault('path', shared.constants.WEBHOOK_PATH or urlparse(webhook_url).path or '/')
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            # Windows, Ctrl-C still stops asyncio.run
+            pass
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        async with WebhookServer(application, **server_options) as server:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=server.secret_token,
+                max_connections=shared.constants.WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            await stop.wait()
+            logger.info("Stopping the webhook receiver")
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
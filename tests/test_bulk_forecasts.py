@@ -0,0 +1,131 @@
+import asyncio
+import http
+import json
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('httpx')
+
+from shared.connector import APIError  # noqa: E402
+from weather_api.weather_api_connector import WeatherAPIConnector  # noqa: E402
+
+FORECAST = json.loads((Path(__file__).parent / 'fixtures' / 'sample_weather_api_response.json').read_text())
+
+
+def forecast(location: str) -> dict:
+    return {**FORECAST, 'location': {**FORECAST['location'], 'name': location}}
+
+
+def bulk_response(locations: list[str], errors: tuple[str, ...] = ()) -> dict:
+    """A bulk forecast.json response, in reverse order to check the results are mapped by custom_id."""
+    items = []
+    for index, location in enumerate(locations):
+        if location in errors:
+            query = {'custom_id': str(index), 'q': location, 'error': {'code': 1006, 'message': 'No location found'}}
+        else:
+            query = {'custom_id': str(index), 'q': location, **forecast(location)}
+        items.append({'query': query})
+    return {'bulk': items[::-1]}
+
+
+class StubWeatherAPI(WeatherAPIConnector):
+    """WeatherAPIConnector answered locally: bulk POSTs fail with `bulk_error` when set, single GETs always work."""
+
+    def __init__(self, bulk_error: Exception | None = None, errors: tuple[str, ...] = (), **kwargs):
+        super().__init__('http://weatherapi.test/v1', **kwargs)
+        self.bulk_error = bulk_error
+        self.errors = errors
+        self.bulk_requests = []
+        self.single_requests = []
+
+    def perform_request(self, method, endpoint, body=None, params=None, raw=False):
+        assert method == http.HTTPMethod.POST and endpoint == 'forecast.json'
+        locations = [location['q'] for location in body['locations']]
+        self.bulk_requests.append(locations)
+        if self.bulk_error is not None:
+            raise self.bulk_error
+        return bulk_response(locations, self.errors)
+
+    async def perform_request_async(self, method, endpoint, body=None, params=None, raw=False):
+        return self.perform_request(method, endpoint, body, params, raw)
+
+    def get_forecast(self, location, raw=False):
+        self.single_requests.append(location)
+        return forecast(location)
+
+    async def get_forecast_async(self, location, raw=False):
+        return self.get_forecast(location, raw)
+
+
+LOCATIONS = ['10.0,20.0', '11.0,21.0', '12.0,22.0']
+
+
+def test_split_bulk_maps_the_results_by_custom_id():
+    forecasts = WeatherAPIConnector._split_bulk(bulk_response(LOCATIONS), LOCATIONS)
+    assert list(forecasts) == LOCATIONS[::-1]
+    for location, forecast in forecasts.items():
+        assert forecast['location']['name'] == location
+        assert 'custom_id' not in forecast and 'q' not in forecast
+
+
+def test_split_bulk_leaves_out_the_error_items():
+    forecasts = WeatherAPIConnector._split_bulk(bulk_response(LOCATIONS, errors=(LOCATIONS[1],)), LOCATIONS)
+    assert sorted(forecasts) == [LOCATIONS[0], LOCATIONS[2]]
+
+
+def test_bulk_requests_are_chunked():
+    connector = StubWeatherAPI(bulk_size=2)
+    assert sorted(connector.get_forecasts_bulk(LOCATIONS)) == LOCATIONS
+    assert connector.bulk_requests == [LOCATIONS[:2], LOCATIONS[2:]]
+    assert connector.single_requests == []
+
+
+@pytest.mark.parametrize('error', [
+    APIError('Bad request', http.HTTPStatus.BAD_REQUEST),
+    ConnectionError('WeatherAPI is unreachable'),
+    ValueError('Undecodable body'),
+])
+def test_other_bulk_failures_fall_back_for_the_chunk_only(error):
+    connector = StubWeatherAPI(bulk_error=error, bulk_size=2)
+    assert sorted(connector.get_forecasts_bulk(LOCATIONS)) == LOCATIONS
+    assert connector.single_requests == LOCATIONS
+    # Every chunk tried the bulk request first
+    assert len(connector.bulk_requests) == 2
+    assert connector.bulk_available
+
+
+@pytest.mark.parametrize('status', [http.HTTPStatus.UNAUTHORIZED, http.HTTPStatus.FORBIDDEN])
+def test_bulk_is_turned_off_when_the_key_has_no_access(status):
+    connector = StubWeatherAPI(bulk_error=APIError('Access denied', status), bulk_size=2)
+    assert sorted(connector.get_forecasts_bulk(LOCATIONS)) == LOCATIONS
+    assert not connector.bulk_available
+    assert len(connector.bulk_requests) == 1
+
+    connector.get_forecasts_bulk(LOCATIONS)
+    assert len(connector.bulk_requests) == 1
+
+
+def test_async_bulk_falls_back_to_single_requests():
+    connector = StubWeatherAPI(bulk_error=APIError('Access denied', http.HTTPStatus.FORBIDDEN), bulk_size=2)
+    forecasts = asyncio.run(connector.get_forecasts_bulk_async(LOCATIONS))
+    assert sorted(forecasts) == LOCATIONS
+    assert sorted(connector.single_requests) == LOCATIONS
+    assert not connector.bulk_available
+
+
+def test_invalid_item_does_not_cost_the_batch():
+    pytest.importorskip('pydantic')
+    from weather_api.transformer import WeatherTransformer
+
+    class PartialWeatherAPI(StubWeatherAPI):
+        def perform_request(self, method, endpoint, body=None, params=None, raw=False):
+            response = super().perform_request(method, endpoint, body, params, raw)
+            # The item of the second location lost its forecast
+            del response['bulk'][1]['query']['forecast']
+            return response
+
+    locations = [(10.0, 20.0), (11.0, 21.0), (12.0, 22.0)]
+    reports = WeatherTransformer(PartialWeatherAPI()).get_reports_bulk(locations)
+    assert sorted(reports) == [(10.0, 20.0), (12.0, 22.0)]
@@ -0,0 +1,192 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('pydantic')
+
+import shared.cache  # noqa: E402
+from shared.cache import ForecastCache  # noqa: E402
+from shared.forecast_store import ForecastStore  # noqa: E402
+from shared.models import WeatherReport  # noqa: E402
+from shared.utils import Moment, location_cell  # noqa: E402
+
+FORECAST = json.loads((Path(__file__).parent / 'fixtures' / 'sample_weather_api_response.json').read_text())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+class CountingStore(ForecastStore):
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.reads = 0
+
+    def get(self, cell: str, kind: str):
+        self.reads += 1
+        return super().get(cell, kind)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(shared.cache, 'time', clock)
+    return clock
+
+
+def cache(**options) -> ForecastCache:
+    options = {
+        'max_entries': 100, 'current_ttl': 60, 'forecast_ttl': 3600, 'stale_ttl': 600,
+        'cell_mode': 'round', 'cell_precision': 2, 'store': None, **options,
+    }
+    return ForecastCache(**options)
+
+
+def report(name: str = 'London') -> WeatherReport:
+    return WeatherReport.model_validate({**FORECAST, 'location': {**FORECAST['location'], 'name': name}})
+
+
+def test_forecast_entry_ttl_depends_on_the_moment(clock):
+    forecasts = cache()
+    forecasts.put(10.0, 20.0, 'forecast', Moment.FORECAST)
+
+    clock.now += 60
+    assert forecasts.get(10.0, 20.0, Moment.CURRENT) == 'forecast'
+    assert forecasts.get(10.0, 20.0, Moment.FULL) == 'forecast'
+    clock.now += 1
+    assert forecasts.get(10.0, 20.0, Moment.CURRENT) is None
+    assert forecasts.get(10.0, 20.0, Moment.FULL) is None
+    assert forecasts.get(10.0, 20.0, Moment.FORECAST) == 'forecast'
+
+    clock.now += 3600 - 61
+    assert forecasts.get(10.0, 20.0, Moment.FORECAST) == 'forecast'
+    clock.now += 1
+    assert forecasts.get(10.0, 20.0, Moment.FORECAST) is None
+
+
+def test_current_entries_never_serve_forecast_lookups(clock):
+    forecasts = cache()
+    forecasts.put(10.0, 20.0, 'current', Moment.CURRENT)
+    assert forecasts.get(10.0, 20.0, Moment.CURRENT) == 'current'
+    assert forecasts.get(10.0, 20.0, Moment.FORECAST) is None
+    assert forecasts.get(10.0, 20.0, Moment.FULL) is None
+
+
+def test_current_lookup_serves_the_freshest_report(clock):
+    forecasts = cache()
+    forecasts.put(10.0, 20.0, 'forecast', Moment.FORECAST)
+    clock.now += 10
+    forecasts.put(10.0, 20.0, 'current', Moment.CURRENT)
+    assert forecasts.get(10.0, 20.0, Moment.CURRENT) == 'current'
+
+
+def test_nearby_coordinates_share_a_cell(clock):
+    forecasts = cache()
+    forecasts.put(10.001, 20.004, 'forecast', Moment.FORECAST)
+    assert forecasts.get(9.998, 19.996, Moment.FORECAST) == 'forecast'
+    assert forecasts.get(10.01, 20.0, Moment.FORECAST) is None
+
+
+def test_int_and_float_coordinates_share_a_cell(clock):
+    forecasts = cache()
+    assert forecasts.cell(10, 20) == forecasts.cell(10.0, 20.0)
+    assert location_cell(-0.001, 0.0) == location_cell(0, 0)
+    forecasts.put(10, 20, 'forecast', Moment.FORECAST)
+    assert forecasts.get(10.0, 20.0, Moment.FORECAST) == 'forecast'
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    forecasts = cache(max_entries=2)
+    forecasts.put(1.0, 1.0, 'first', Moment.FORECAST)
+    forecasts.put(2.0, 2.0, 'second', Moment.FORECAST)
+    assert forecasts.get(1.0, 1.0, Moment.FORECAST) == 'first'
+
+    forecasts.put(3.0, 3.0, 'third', Moment.FORECAST)
+    assert len(forecasts) == 2
+    assert forecasts.evictions == 1
+    assert forecasts.get(2.0, 2.0, Moment.FORECAST) is None
+    assert forecasts.get(1.0, 1.0, Moment.FORECAST) == 'first'
+    assert forecasts.get(3.0, 3.0, Moment.FORECAST) == 'third'
+
+
+def test_stale_reports_are_served_up_to_stale_ttl_past_the_ttl(clock):
+    forecasts = cache()
+    forecasts.put(10.0, 20.0, 'forecast', Moment.FORECAST)
+
+    clock.now += 3600 + 1
+    assert forecasts.get(10.0, 20.0, Moment.FORECAST) is None
+    assert forecasts.get_stale(10.0, 20.0, Moment.FORECAST) == 'forecast'
+    clock.now += 600
+    assert forecasts.get_stale(10.0, 20.0, Moment.FORECAST) is None
+    # The window follows the TTL of the moment
+    assert forecasts.get_stale(10.0, 20.0, Moment.CURRENT) is None
+
+
+def test_hit_rate(clock):
+    forecasts = cache()
+    forecasts.put(10.0, 20.0, 'forecast', Moment.FORECAST)
+    forecasts.get(10.0, 20.0, Moment.FORECAST)
+    forecasts.get(30.0, 40.0, Moment.FORECAST)
+    assert forecasts.stats()['hits'] == 1 and forecasts.stats()['misses'] == 1
+    assert forecasts.hit_rate == 0.5
+
+
+def test_store_serves_another_cache(clock, tmp_path):
+    store = ForecastStore(str(tmp_path / 'forecasts.db'))
+    cache(store=store).put(10.0, 20.0, report(), Moment.FORECAST)
+
+    restarted = cache(store=store)
+    assert restarted.get(10.0, 20.0, Moment.FORECAST) == report()
+    assert restarted.age(10.0, 20.0) == 0
+    # Expired in the store as well
+    clock.now += 3601
+    assert cache(store=store).get(10.0, 20.0, Moment.FORECAST) is None
+
+
+def test_store_is_only_read_on_a_memory_miss(clock, tmp_path):
+    store = CountingStore(str(tmp_path / 'forecasts.db'))
+    forecasts = cache(store=store)
+    forecasts.put(10.0, 20.0, report(), Moment.FORECAST)
+    forecasts.get(10.0, 20.0, Moment.FORECAST)
+    assert store.reads == 0
+
+    clock.now += 3601
+    forecasts.get(10.0, 20.0, Moment.FORECAST)
+    assert store.reads == 1
+
+
+def test_store_copy_only_replaces_an_older_entry(clock, tmp_path):
+    store = ForecastStore(str(tmp_path / 'forecasts.db'))
+    forecasts, other = cache(store=store), cache(store=store)
+    forecasts.put(10.0, 20.0, report('Old'), Moment.FORECAST)
+
+    # Another process fetched the cell since
+    clock.now += 3601
+    other.put(10.0, 20.0, report('New'), Moment.FORECAST)
+    assert forecasts.get(10.0, 20.0, Moment.FORECAST).location.name == 'New'
+
+    # The memory entry is newer than the store copy (eg: the store write was lost)
+    clock.now += 10
+    forecasts._remember((forecasts.cell(10.0, 20.0), 'forecast'), clock.now, report('Newest'))
+    assert forecasts.get(10.0, 20.0, Moment.FORECAST, max_age=0).location.name == 'Newest'
+
+
+def test_async_variants_share_the_store(clock, tmp_path):
+    store = ForecastStore(str(tmp_path / 'forecasts.db'))
+
+    async def scenario():
+        await cache(store=store).put_async(10.0, 20.0, report(), Moment.FORECAST)
+        restarted = cache(store=store)
+        clock.now += 3601
+        return (
+            await restarted.get_async(10.0, 20.0, Moment.FORECAST),
+            await restarted.get_stale_async(10.0, 20.0, Moment.FORECAST),
+        )
+
+    assert asyncio.run(scenario()) == (None, report())
@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('telegram')
+pytest.importorskip('pydantic')
+
+from auto_weather_updates.dispatcher import ReportDispatcher  # noqa: E402
+
+
+def forecast_report(condition: str = 'Sunny') -> SimpleNamespace:
+    """Just what ForecastFingerprint.from_report reads of a WeatherReport."""
+    day = SimpleNamespace(
+        day=SimpleNamespace(condition=SimpleNamespace(text=condition), maxtemp_c=20.0, mintemp_c=10.0),
+        astro=SimpleNamespace(sunrise='06:58 AM', sunset='08:12 PM'),
+    )
+    return SimpleNamespace(forecast=SimpleNamespace(forecastday=[day, day]))
+
+
+class FakeTransformer:
+    """Fails the first `failures` fetches, like WeatherAPI being down with no stale report to serve."""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.fetches = 0
+
+    async def get_data_async(self, latitude, longitude, moment=None):
+        self.fetches += 1
+        if self.fetches <= self.failures:
+            raise ConnectionError('WeatherAPI is unreachable')
+        return forecast_report()
+
+    @staticmethod
+    def render(report, moment=None) -> str:
+        return f'Tomorrow: {report.forecast.forecastday[1].day.condition.text}'
+
+
+class FakeBot:
+    rate_limiter = None
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+
+
+def users(count: int, latitude: float = 10.0, longitude: float = 20.0) -> list[SimpleNamespace]:
+    return [SimpleNamespace(chat_id=chat_id, latitude=latitude, longitude=longitude) for chat_id in range(count)]
+
+
+def dispatch(transformer: FakeTransformer, users: list, bot: FakeBot):
+    dispatcher = ReportDispatcher(
+        bot, transformer, max_fetches=1, max_sends=1, global_rate=1000, chat_rate=1000, changes_only=False
+    )
+    return asyncio.run(dispatcher.run(users))
+
+
+def test_users_of_a_cell_share_a_fetch():
+    bot, transformer = FakeBot(), FakeTransformer()
+    report = dispatch(transformer, users(5), bot)
+    assert transformer.fetches == report.fetches == 1
+    assert sorted(bot.sent) == list(range(5))
+
+
+def test_failed_fetch_is_retried_by_the_next_user_of_the_cell():
+    bot, transformer = FakeBot(), FakeTransformer(failures=1)
+    report = dispatch(transformer, users(5), bot)
+    assert report.failed == 1
+    assert report.sent == 4
+    assert sorted(bot.sent) == [1, 2, 3, 4]
+    # The failed fetch is not cached, the success is
+    assert transformer.fetches == report.fetches == 2
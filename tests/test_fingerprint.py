@@ -0,0 +1,71 @@
+import pytest
+
+pytest.importorskip('pydantic')
+
+from auto_weather_updates.fingerprint import ChangeDetector, ForecastFingerprint, _minutes  # noqa: E402
+
+
+def fingerprint(**changes) -> ForecastFingerprint:
+    return ForecastFingerprint('Sunny', 20.0, 10.0, '06:58 AM', '08:12 PM')._replace(**changes)
+
+
+@pytest.mark.parametrize('value, minutes', [
+    ('06:58 AM', 6 * 60 + 58),
+    ('12:05 AM', 5),
+    ('12:30 PM', 12 * 60 + 30),
+    ('08:12 PM', 20 * 60 + 12),
+    ('No sunrise', None),
+    ('', None),
+])
+def test_minutes_parses_the_12_hour_clock(value, minutes):
+    assert _minutes(value) == minutes
+
+
+def test_first_forecast_is_always_a_change():
+    assert ChangeDetector(2, 15).changed(None, fingerprint())
+
+
+def test_same_forecast_is_not_a_change():
+    assert not ChangeDetector(2, 15).changed(fingerprint(), fingerprint())
+
+
+def test_condition_change():
+    assert ChangeDetector(2, 15).changed(fingerprint(), fingerprint(condition='Light rain'))
+
+
+@pytest.mark.parametrize('field', ['maxtemp_c', 'mintemp_c'])
+def test_temperature_threshold(field):
+    detector = ChangeDetector(temp_threshold=2, sun_threshold=15)
+    previous = fingerprint()
+    assert not detector.changed(previous, previous._replace(**{field: getattr(previous, field) + 1.9}))
+    assert detector.changed(previous, previous._replace(**{field: getattr(previous, field) + 2}))
+    assert detector.changed(previous, previous._replace(**{field: getattr(previous, field) - 2}))
+
+
+@pytest.mark.parametrize('field, moved, changed', [
+    ('sunrise', '07:12 AM', False),
+    ('sunrise', '07:13 AM', True),
+    ('sunset', '07:57 PM', True),
+    ('sunset', '07:58 PM', False),
+])
+def test_sun_threshold(field, moved, changed):
+    detector = ChangeDetector(temp_threshold=2, sun_threshold=15)
+    assert detector.changed(fingerprint(), fingerprint(**{field: moved})) == changed
+
+
+def test_sun_delta_wraps_around_midnight():
+    detector = ChangeDetector(temp_threshold=2, sun_threshold=15)
+    assert not detector.changed(fingerprint(sunset='11:55 PM'), fingerprint(sunset='12:05 AM'))
+
+
+def test_sun_without_a_time_compares_the_text():
+    detector = ChangeDetector(temp_threshold=2, sun_threshold=15)
+    assert not detector.changed(fingerprint(sunrise='No sunrise'), fingerprint(sunrise='No sunrise'))
+    assert detector.changed(fingerprint(sunrise='No sunrise'), fingerprint(sunrise='06:58 AM'))
+
+
+def test_database_round_trip():
+    assert ForecastFingerprint.from_database(fingerprint().to_database()) == fingerprint()
+    assert ForecastFingerprint.from_database(None) is None
+    # Written by a version with other fields
+    assert ForecastFingerprint.from_database(['Sunny', 20.0]) is None
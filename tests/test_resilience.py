@@ -0,0 +1,99 @@
+import pytest
+
+import shared.resilience
+from shared.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(shared.resilience, 'time', clock)
+    return clock
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_breaker_success_resets_the_failures(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_breaker_half_open_probe_closes_on_success(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock.now += 1
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    # A single probe at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+
+
+def test_breaker_half_open_probe_reopens_on_failure(clock):
+    breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=30)
+    for _ in range(5):
+        breaker.record_failure()
+
+    clock.now += 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # The reset timeout starts over from the failed probe
+    clock.now += 30
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+
+
+def test_breaker_replaces_a_probe_that_never_reports(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    breaker.before_call()
+
+    clock.now += 30
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+
+
+@pytest.mark.parametrize('attempt, bound', [(0, 0.5), (1, 1.0), (2, 2.0), (3, 4.0), (10, 5.0)])
+def test_retry_delay_is_jittered_within_the_exponential_bound(attempt, bound):
+    policy = RetryPolicy(max_attempts=5, base_delay=0.5, max_delay=5.0)
+    delays = [policy.delay(attempt) for _ in range(500)]
+    assert all(0 <= delay <= bound for delay in delays)
+    # Full jitter spreads the waits over the whole range
+    assert min(delays) < bound * 0.25 and max(delays) > bound * 0.75
@@ -0,0 +1,133 @@
+import asyncio
+import datetime
+
+import pytest
+
+pytest.importorskip('telegram')
+pytest.importorskip('pydantic')
+pytest.importorskip('psycopg2')
+pytest.importorskip('httpx')
+
+from auto_weather_updates.scheduler import ReportScheduler, scheduled_run_id  # noqa: E402
+
+UTC = datetime.timezone.utc
+
+
+def utc(*args) -> datetime.datetime:
+    return datetime.datetime(*args, tzinfo=UTC)
+
+
+class FakeAutomaticReports:
+    def __init__(self):
+        self.prewarmed = []
+        self.runs = []
+        self.prewarm_done = asyncio.Event()
+
+    async def prewarm(self, db_connector, **filters) -> int:
+        self.prewarmed.append(filters['tz_id'])
+        await self.prewarm_done.wait()
+        return 0
+
+    async def send_subscriber_reports(self, db_connector, run_id: str, **filters):
+        self.runs.append(run_id)
+
+
+def scheduler(delivery_time: str = '08:00', catch_up: float = 3600, prewarm_lead: float = 900) -> ReportScheduler:
+    return ReportScheduler(
+        FakeAutomaticReports(), None, delivery_time=datetime.time.fromisoformat(delivery_time),
+        refresh_interval=900, catch_up=catch_up, prewarm_lead=prewarm_lead,
+    )
+
+
+def scheduled(reports: ReportScheduler) -> list[tuple[datetime.datetime, str, datetime.date]]:
+    return sorted(reports._heap)
+
+
+@pytest.mark.parametrize('tz_id, local_date, delivery', [
+    # Central European Time, then summer time from March 31 2024
+    ('Europe/Berlin', datetime.date(2024, 3, 30), utc(2024, 3, 30, 7)),
+    ('Europe/Berlin', datetime.date(2024, 3, 31), utc(2024, 3, 31, 6)),
+    # Back to standard time on November 3 2024
+    ('America/New_York', datetime.date(2024, 11, 2), utc(2024, 11, 2, 12)),
+    ('America/New_York', datetime.date(2024, 11, 3), utc(2024, 11, 3, 13)),
+    ('Asia/Kolkata', datetime.date(2024, 6, 1), utc(2024, 6, 1, 2, 30)),
+])
+def test_delivery_follows_the_local_time_across_dst(tz_id, local_date, delivery):
+    assert scheduler().delivery_at(tz_id, local_date) == delivery
+
+
+def test_delivery_in_the_skipped_dst_hour_is_still_sent_that_day():
+    # 02:30 does not exist in Berlin on March 31 2024, it is read with the offset before the change
+    delivery = scheduler('02:30').delivery_at('Europe/Berlin', datetime.date(2024, 3, 31))
+    assert delivery == utc(2024, 3, 31, 1, 30)
+
+
+def test_delivery_in_the_repeated_dst_hour_is_sent_once():
+    # 01:30 happens twice in New York on November 3 2024, the first one is used
+    delivery = scheduler('01:30').delivery_at('America/New_York', datetime.date(2024, 11, 3))
+    assert delivery == utc(2024, 11, 3, 5, 30)
+
+
+def test_schedules_today_when_the_delivery_is_ahead():
+    reports = scheduler()
+    reports.schedule('Europe/Berlin', utc(2024, 6, 1, 5))
+    assert scheduled(reports) == [(utc(2024, 6, 1, 6), 'Europe/Berlin', datetime.date(2024, 6, 1))]
+
+
+@pytest.mark.parametrize('now, local_date', [
+    # 20 minutes late, within the catch-up window: sent right away
+    (utc(2024, 6, 1, 6, 20), datetime.date(2024, 6, 1)),
+    (utc(2024, 6, 1, 7), datetime.date(2024, 6, 1)),
+    # Past the window: the next day
+    (utc(2024, 6, 1, 7, 0, 1), datetime.date(2024, 6, 2)),
+])
+def test_missed_delivery_is_caught_up_within_the_window(now, local_date):
+    reports = scheduler(catch_up=3600)
+    reports.schedule('Europe/Berlin', now)
+    assert scheduled(reports)[0][2] == local_date
+
+
+def test_local_date_is_the_one_of_the_timezone():
+    # 11:30 UTC on June 1 is already 23:30 in Auckland, the 08:00 delivery of June 1 is long gone
+    reports = scheduler()
+    reports.schedule('Pacific/Auckland', utc(2024, 6, 1, 11, 30))
+    assert scheduled(reports) == [(utc(2024, 6, 1, 20), 'Pacific/Auckland', datetime.date(2024, 6, 2))]
+
+
+def test_delivery_before_midnight_is_caught_up_after_midnight():
+    # The 23:30 delivery of June 1 in Berlin (21:30 UTC) missed by 40 minutes, it's June 2 locally
+    reports = scheduler('23:30', catch_up=3600)
+    reports.schedule('Europe/Berlin', utc(2024, 6, 1, 22, 10))
+    assert scheduled(reports) == [(utc(2024, 6, 1, 21, 30), 'Europe/Berlin', datetime.date(2024, 6, 1))]
+
+
+def test_delivery_after_midnight_is_scheduled_the_same_night():
+    reports = scheduler('00:15')
+    reports.schedule('Europe/Berlin', utc(2024, 6, 1, 21, 50))
+    assert scheduled(reports) == [(utc(2024, 6, 1, 22, 15), 'Europe/Berlin', datetime.date(2024, 6, 2))]
+
+
+def test_prewarm_starts_the_lead_before_each_delivery():
+    reports = scheduler(prewarm_lead=900)
+    reports.schedule('Europe/Berlin', utc(2024, 6, 1, 5))
+    reports.schedule('Europe/London', utc(2024, 6, 1, 5))
+
+    async def scenario():
+        # 16 minutes before Berlin's delivery: nothing due yet
+        assert reports.start_prewarms(utc(2024, 6, 1, 5, 44)) == utc(2024, 6, 1, 5, 45)
+        assert reports._prewarming == {}
+
+        next_prewarm = reports.start_prewarms(utc(2024, 6, 1, 5, 45))
+        # London delivers at 07:00 UTC
+        assert next_prewarm == utc(2024, 6, 1, 6, 45)
+        # A prewarm already running is not started again
+        reports.start_prewarms(utc(2024, 6, 1, 5, 50))
+        await asyncio.sleep(0)
+        assert reports.automatic_reports.prewarmed == ['Europe/Berlin']
+
+        reports.automatic_reports.prewarm_done.set()
+        await reports.deliver('Europe/Berlin', datetime.date(2024, 6, 1))
+        assert reports.automatic_reports.runs == [scheduled_run_id('Europe/Berlin', datetime.date(2024, 6, 1))]
+        assert reports._prewarming == {}
+
+    asyncio.run(scenario())
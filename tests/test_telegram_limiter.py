@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('telegram')
+pytest.importorskip('psycopg2')
+
+import shared.telegram_limiter  # noqa: E402
+from shared.telegram_limiter import (  # noqa: E402
+    BULK, INTERACTIVE, BucketStore, MemoryBucketStore, SharedTokenBucket, _step,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(shared.telegram_limiter, 'time', clock)
+    monkeypatch.setattr(asyncio, 'sleep', clock.sleep)
+    return clock
+
+
+class BrokenStore(BucketStore):
+    blocking = False
+
+    def take(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        raise ConnectionError('database is down')
+
+    def pause(self, key: str, seconds: float) -> None:
+        raise ConnectionError('database is down')
+
+
+def test_step_takes_a_token():
+    assert _step(tokens=3, elapsed=0, paused_for=0, rate=10, capacity=5, reserve=0) == (2, 0)
+
+
+def test_step_refills_up_to_the_capacity():
+    assert _step(tokens=0, elapsed=60, paused_for=0, rate=10, capacity=5, reserve=0) == (4, 0)
+    assert _step(tokens=1, elapsed=0.25, paused_for=0, rate=10, capacity=5, reserve=0) == (2.5, 0)
+
+
+def test_step_waits_for_the_missing_token():
+    tokens, wait = _step(tokens=0.5, elapsed=0, paused_for=0, rate=10, capacity=5, reserve=0)
+    assert tokens == 0.5
+    assert wait == pytest.approx(0.05)
+
+
+def test_step_leaves_the_reserve():
+    tokens, wait = _step(tokens=2.5, elapsed=0, paused_for=0, rate=10, capacity=5, reserve=2)
+    assert tokens == 2.5
+    assert wait == pytest.approx(0.05)
+    assert _step(tokens=3, elapsed=0, paused_for=0, rate=10, capacity=5, reserve=2) == (2, 0)
+
+
+def test_step_waits_out_a_pause():
+    assert _step(tokens=5, elapsed=10, paused_for=3, rate=10, capacity=5, reserve=0) == (0, 3)
+
+
+def test_memory_store_refills_over_time(clock):
+    store = MemoryBucketStore()
+    for _ in range(2):
+        assert store.take('key', rate=1, capacity=2) == 0
+    assert store.take('key', rate=1, capacity=2) == pytest.approx(1)
+    clock.now += 1
+    assert store.take('key', rate=1, capacity=2) == 0
+
+
+def test_memory_store_pause_empties_the_bucket(clock):
+    store = MemoryBucketStore()
+    store.take('key', rate=10, capacity=10)
+    store.pause('key', 5)
+    assert store.take('key', rate=10, capacity=10) == pytest.approx(5)
+    clock.now += 4
+    assert store.take('key', rate=10, capacity=10) == pytest.approx(1)
+    clock.now += 1
+    assert store.take('key', rate=10, capacity=10) == 0
+
+
+def test_bulk_lane_leaves_the_interactive_reserve(clock):
+    bucket = SharedTokenBucket(MemoryBucketStore(), rate=1, capacity=3, interactive_reserve=2)
+
+    async def scenario():
+        await bucket.acquire(BULK)
+        assert clock.sleeps == []
+        # 2 tokens left, all reserved for the replies
+        await bucket.acquire(INTERACTIVE)
+        await bucket.acquire(INTERACTIVE)
+        assert clock.sleeps == []
+        await bucket.acquire(BULK)
+
+    asyncio.run(scenario())
+    # The bulk request waited for the bucket to refill above the reserve
+    assert sum(clock.sleeps) == pytest.approx(3)
+
+
+def test_reserve_is_capped_below_the_capacity():
+    bucket = SharedTokenBucket(MemoryBucketStore(), rate=1, capacity=3, interactive_reserve=10)
+    assert bucket.interactive_reserve == 2
+
+
+def test_pause_stops_the_requests(clock):
+    bucket = SharedTokenBucket(MemoryBucketStore(), rate=100, capacity=100, interactive_reserve=0)
+
+    async def scenario():
+        await bucket.pause(4)
+        await bucket.acquire(INTERACTIVE)
+
+    asyncio.run(scenario())
+    assert sum(clock.sleeps) >= 4
+
+
+def test_store_failure_falls_back_to_the_process_bucket(clock):
+    bucket = SharedTokenBucket(BrokenStore(), rate=1, capacity=1, interactive_reserve=0)
+
+    async def scenario():
+        await bucket.acquire(INTERACTIVE)
+        await bucket.acquire(INTERACTIVE)
+
+    asyncio.run(scenario())
+    # Still rate limited, by the fallback bucket of the process
+    assert sum(clock.sleeps) == pytest.approx(1)
+    assert bucket._store_retry_at > clock.now - shared.telegram_limiter.STORE_RETRY_SECONDS
@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip('telegram')
+
+import shared.constants  # noqa: E402
+from telegram_bot.webhook import SECRET_TOKEN_HEADER, WebhookServer, run_webhook  # noqa: E402
+
+SECRET = 'secret'
+UPDATE = json.dumps({'update_id': 1}).encode()
+
+
+class FakeApplication:
+    bot = None
+
+    def __init__(self):
+        self.updates = []
+        self.initialized = False
+
+    async def initialize(self) -> None:
+        self.initialized = True
+
+    async def process_update(self, update) -> None:
+        self.updates.append(update)
+
+
+def server(**options) -> WebhookServer:
+    return WebhookServer(
+        FakeApplication(), host='127.0.0.1', port=0, path='/webhook', secret_token=SECRET, workers=1, **options
+    )
+
+
+async def post(url: str, body: bytes, headers: dict[str, str]) -> int:
+    """Status of a POST to the receiver, over a raw connection like Telegram's."""
+    host, port = url.split('//')[1].split('/')[0].split(':')
+    reader, writer = await asyncio.open_connection(host, int(port))
+    request_headers = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    writer.write(
+        f'POST /webhook HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n'
+        f'{request_headers}\r\n'.encode() + body
+    )
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+@pytest.mark.parametrize('headers', [{}, {SECRET_TOKEN_HEADER: 'wrong'}, {SECRET_TOKEN_HEADER: ''}])
+def test_rejects_an_unauthenticated_post(headers):
+    assert server().handle('POST', '/webhook', headers, UPDATE) == 403
+
+
+@pytest.mark.parametrize('body', [b'', b'not json', b'{"update_id": '])
+def test_rejects_a_malformed_post(body):
+    assert server().handle('POST', '/webhook', {SECRET_TOKEN_HEADER: SECRET}, body) == 400
+
+
+def test_rejects_other_paths_and_methods():
+    receiver = server()
+    assert receiver.handle('POST', '/other', {SECRET_TOKEN_HEADER: SECRET}, UPDATE) == 404
+    assert receiver.handle('GET', '/webhook', {SECRET_TOKEN_HEADER: SECRET}, b'') == 405
+    assert receiver.handle('GET', '/healthz', {}, b'') == 200
+
+
+def test_queues_an_authenticated_update_and_answers_503_when_full():
+    receiver = server(queue_size=1)
+    receiver._queues = [asyncio.Queue(1)]
+    assert receiver.handle('POST', '/webhook', {SECRET_TOKEN_HEADER: SECRET}, UPDATE) == 200
+    assert receiver.handle('POST', '/webhook', {SECRET_TOKEN_HEADER: SECRET}, UPDATE) == 503
+
+
+def test_only_authenticated_updates_reach_the_handlers():
+    async def scenario():
+        async with server() as receiver:
+            statuses = [
+                await post(receiver.url, UPDATE, {}),
+                await post(receiver.url, b'not json', {SECRET_TOKEN_HEADER: SECRET}),
+                await post(receiver.url, UPDATE, {SECRET_TOKEN_HEADER: SECRET}),
+            ]
+            await receiver.join()
+            return statuses, receiver.application.updates
+
+    statuses, updates = asyncio.run(scenario())
+    assert statuses == [403, 400, 200]
+    assert [update.update_id for update in updates] == [1]
+
+
+def test_post_without_the_token_is_forbidden():
+    async def scenario():
+        async with server() as receiver:
+            status = await post(receiver.url, UPDATE, {})
+            await receiver.join()
+            return status, receiver.application.updates
+
+    assert asyncio.run(scenario()) == (403, [])
+
+
+def test_run_webhook_refuses_to_start_without_a_secret_token(monkeypatch):
+    monkeypatch.setattr(shared.constants, 'WEBHOOK_SECRET_TOKEN', None)
+    application = FakeApplication()
+    with pytest.raises(ValueError, match='WEBHOOK_SECRET_TOKEN'):
+        asyncio.run(run_webhook(application, 'https://bot.example.com/webhook', port=0))
+    assert not application.initialized
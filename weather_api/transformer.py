@@ -1,45 +1,216 @@
+import asyncio
+import logging
 from typing import Type, TypeVar, Optional
 
-from shared.models import WeatherReport
+from shared.cache import ForecastCache
+from shared.connector import APIConnector
+from shared.metrics import REGISTRY
+from shared.models import CurrentReport, WeatherReport
 from shared.transformer import BaseTransformer
 from shared.utils import Moment
 # This should be a dataclass per transformer to define how the transformed data should look like.
 TransformerModel = TypeVar('TransformerModel')
 
+logger = logging.getLogger(__name__)
+
 
 class WeatherTransformer(BaseTransformer):
 
+    def __init__(self, connector: Type["APIConnector"], cache: ForecastCache | None = None):
+        """
+        :param connector: The WeatherAPI connector used to fetch the data
+        :param cache: Optional cache to reuse reports of nearby locations instead of calling the API
+        """
+        super().__init__(connector)
+        self.cache = cache
+
     def transform(self, latitude: float, longitude: float, moment: Moment | None = None) -> str:
         """
         base function to transform the data received by the connector class.
 
         :return: transformed data into desired form -> child object of the class TransformerModel
         """
-        report: WeatherReport = self.get_data(latitude, longitude, moment)
+        with REGISTRY.timer('weather_transform', moment=getattr(moment, 'value', moment)):
+            report = self.get_data(latitude, longitude, moment)
+            return self.render(report, moment)
 
-        # Processing and format to the data to a readable form
-        tomorrow_forecast = report.forecast.forecastday[1]
+    async def transform_async(self, latitude: float, longitude: float, moment: Moment | None = None) -> str:
+        """
+        Awaitable version of transform, the API request does not block the event loop.
+
+        :return: transformed data into desired form -> child object of the class TransformerModel
+        """
+        with REGISTRY.timer('weather_transform', moment=getattr(moment, 'value', moment)):
+            report = await self.get_data_async(latitude, longitude, moment)
+            return self.render(report, moment)
+
+    @staticmethod
+    def render(report: CurrentReport | WeatherReport, moment: Moment | None = None) -> str:
+        """
+        Processing and format to the data to a readable form
+
+        :param report: CurrentReport is enough for Moment.CURRENT, the other moments need a WeatherReport
+        :return: the message to send to the user
+        """
         today_weather = report.current
         location = report.location.name
         if moment == Moment.CURRENT:
             return f'{today_weather.condition.text} at the moment in {location}\nWith a temperature of {today_weather.temp_c}°c\nAnd it feels like {today_weather.feelslike_c}°c'
-        elif moment == Moment.FORECAST:
+
+        tomorrow_forecast = report.forecast.forecastday[1]
+        if moment == Moment.FORECAST:
             return f'{tomorrow_forecast.day.condition.text} for tomorrow in {location}\nWith a Max temperature of {tomorrow_forecast.day.maxtemp_c}°c and Min of {tomorrow_forecast.day.mintemp_c}°c\nSunrise at {tomorrow_forecast.astro.sunrise} and Sunset at {tomorrow_forecast.astro.sunset}'
         elif moment == Moment.FULL:
             return f'{today_weather.condition.text} at the moment in {location}\nWith a temperature of {today_weather.temp_c}°c\nAnd it feels like {today_weather.feelslike_c}°c\n\n{tomorrow_forecast.day.condition.text} for tomorrow in {location}\nWith a Max temperature of {tomorrow_forecast.day.maxtemp_c}°c and Min of {tomorrow_forecast.day.mintemp_c}°c\nSunrise at {tomorrow_forecast.astro.sunrise} and Sunset at {tomorrow_forecast.astro.sunset}'
         else:
             raise ValueError('Error detail: Input moment for report')
 
-    def get_data(self, latitude: float, longitude: float, moment: str | None = None) -> WeatherReport:
+    @staticmethod
+    def parse(raw: bytes, moment: Moment | None = None) -> CurrentReport | WeatherReport:
+        """
+        Validate the raw API response straight into the model needed for the moment.
+
+        pydantic parses the bytes with its own JSON parser and skips the fields the models don't declare, instead of
+        building the whole response as python objects with response.json() first.
+        """
+        if moment == Moment.CURRENT:
+            return CurrentReport.model_validate_json(raw)
+        return WeatherReport.model_validate_json(raw)
+
+    def _stale_or_raise(self, latitude: float, longitude: float, moment: Moment | None, error: ConnectionError):
+        """The expired cached report when WeatherAPI can't be reached, the error when there is none."""
+        report = self.cache.get_stale(latitude, longitude, moment) if self.cache is not None else None
+        if report is None:
+            raise error
+        logger.warning(f"Serving a stale report for {latitude},{longitude}: {error}")
+        return report
+
+    async def _stale_or_raise_async(
+            self,
+            latitude: float,
+            longitude: float,
+            moment: Moment | None,
+            error: ConnectionError,
+    ):
+        report = await self.cache.get_stale_async(latitude, longitude, moment) if self.cache is not None else None
+        if report is None:
+            raise error
+        logger.warning(f"Serving a stale report for {latitude},{longitude}: {error}")
+        return report
+
+    def get_data(self, latitude: float, longitude: float, moment: Moment | None = None) -> CurrentReport | WeatherReport:
         """
         Function to get the needed data form the API in order to receive the response.
 
-        Must be implemented by child classes.
-        :return: dict
+        Moment.CURRENT only fetches the current conditions, the other moments fetch the forecast. When WeatherAPI can't
+        be reached (ConnectionError, including an open circuit) a recently expired cached report is served instead.
+        :return: CurrentReport or WeatherReport
         """
-        data = self.connector.get_forecast(f'{latitude},{longitude}')
+        if self.cache is not None:
+            report = self.cache.get(latitude, longitude, moment)
+            if report is not None:
+                return report
+
+        location = f'{latitude},{longitude}'
+        try:
+            if moment == Moment.CURRENT:
+                raw = self.connector.get_current(location, raw=True)
+            else:
+                raw = self.connector.get_forecast(location, raw=True)
+        except ConnectionError as e:
+            return self._stale_or_raise(latitude, longitude, moment, e)
 
         # Convert the data to a Pydantic model
-        report = WeatherReport(**data)
+        report = self.parse(raw, moment)
 
+        if self.cache is not None:
+            self.cache.put(latitude, longitude, report, moment)
         return report
+
+    async def get_data_async(self, latitude: float, longitude: float, moment: Moment | None = None) -> CurrentReport | WeatherReport:
+        """
+        Awaitable version of get_data, uses the async connection pool of the connector and reads or writes the
+        forecast store of the cache from a thread.
+
+        :return: CurrentReport or WeatherReport
+        """
+        if self.cache is not None:
+            report = await self.cache.get_async(latitude, longitude, moment)
+            if report is not None:
+                return report
+
+        location = f'{latitude},{longitude}'
+        try:
+            if moment == Moment.CURRENT:
+                raw = await self.connector.get_current_async(location, raw=True)
+            else:
+                raw = await self.connector.get_forecast_async(location, raw=True)
+        except ConnectionError as e:
+            return await self._stale_or_raise_async(latitude, longitude, moment, e)
+        report = self.parse(raw, moment)
+
+        if self.cache is not None:
+            await self.cache.put_async(latitude, longitude, report, moment)
+        return report
+
+    def _cached_reports(self, locations: list[tuple[float, float]], refresh: bool) -> tuple[dict, list[tuple[float, float]]]:
+        """Split the locations into the reports served by the cache and the locations still to fetch."""
+        reports, missing = {}, []
+        for latitude, longitude in dict.fromkeys(locations):
+            use_cache = self.cache is not None and not refresh
+            report = self.cache.get(latitude, longitude, Moment.FORECAST) if use_cache else None
+            if report is not None:
+                reports[(latitude, longitude)] = report
+            else:
+                missing.append((latitude, longitude))
+        return reports, missing
+
+    def _store_reports(self, missing: list[tuple[float, float]], forecasts: dict[str, dict]) -> dict:
+        reports = {}
+        for latitude, longitude in missing:
+            forecast = forecasts.get(f'{latitude},{longitude}')
+            if forecast is None:
+                continue
+            try:
+                report = WeatherReport.model_validate(forecast)
+            except ValueError as e:
+                # pydantic's ValidationError, one partial item of a bulk response must not cost the whole batch
+                logger.warning(f"Invalid forecast for location {latitude},{longitude}: {e}")
+                continue
+            reports[(latitude, longitude)] = report
+            if self.cache is not None:
+                self.cache.put(latitude, longitude, report, Moment.FORECAST)
+        return reports
+
+    def get_reports_bulk(
+            self,
+            locations: list[tuple[float, float]],
+            refresh: bool = False,
+    ) -> dict[tuple[float, float], WeatherReport]:
+        """
+        Forecast reports of many locations, the ones missing from the cache are fetched with bulk requests.
+
+        :param locations: (latitude, longitude) pairs
+        :param refresh: Fetch every location, replacing the cached reports
+        :return: dict of (latitude, longitude) -> WeatherReport, locations the API has no forecast for are left out
+        """
+        reports, missing = self._cached_reports(locations, refresh)
+        if missing:
+            forecasts = self.connector.get_forecasts_bulk(f'{latitude},{longitude}' for latitude, longitude in missing)
+            reports.update(self._store_reports(missing, forecasts))
+        return reports
+
+    async def get_reports_bulk_async(
+            self,
+            locations: list[tuple[float, float]],
+            refresh: bool = False,
+    ) -> dict[tuple[float, float], WeatherReport]:
+        """Awaitable version of get_reports_bulk, the cache is read and written from a thread."""
+        # One thread per pass over the locations, not per location, the reads and writes may go to the forecast store
+        reports, missing = await asyncio.to_thread(self._cached_reports, locations, refresh)
+        if missing:
+            forecasts = await self.connector.get_forecasts_bulk_async(
+                f'{latitude},{longitude}' for latitude, longitude in missing
+            )
+            reports.update(await asyncio.to_thread(self._store_reports, missing, forecasts))
+        return reports
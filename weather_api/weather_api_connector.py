@@ -1,11 +1,33 @@
+import asyncio
 import http
+import logging
 import os
-from shared.connector import APIConnector
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+import shared.constants
+from shared.connector import APIConnector, APIError
+from shared.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Statuses of a key whose plan has no bulk requests (eg: 403 with error code 2009), every bulk request would fail
+BULK_UNAVAILABLE_STATUSES = (http.HTTPStatus.UNAUTHORIZED, http.HTTPStatus.FORBIDDEN)
 
 
 class WeatherAPIConnector(APIConnector):
     CREDENTIALS: dict = None
 
+    def __init__(self, url: str, bulk_size: Optional[int] = None, **kwargs):
+        """
+        :param bulk_size: Locations per bulk request, WeatherAPI accepts up to 50 (defaults to WEATHER_BULK_SIZE)
+        :param kwargs: APIConnector settings (timeouts, connection limits)
+        """
+        super().__init__(url, **kwargs)
+        self.bulk_size = bulk_size or shared.constants.WEATHER_BULK_SIZE
+        # Cleared when the API key turns out not to have access to bulk requests, single requests are used from then on
+        self.bulk_available = True
+
     def _get_auth_data(self):
         """
         Function used to get the authentication data
@@ -15,7 +37,121 @@ class WeatherAPIConnector(APIConnector):
         """
         return os.environ.get("API_KEY", None)
 
-    def get_forecast(self, location: str) -> dict:
+    def _forecast_params(self, location: str) -> dict:
         wea_token = self._get_auth_data()
-        params = {'key':  wea_token, 'q': location, 'days': 2}
-        return self.perform_request(http.HTTPMethod.GET, 'forecast.json', params=params)
+        return {'key':  wea_token, 'q': location, 'days': 2}
+
+    def _current_params(self, location: str) -> dict:
+        return {'key': self._get_auth_data(), 'q': location}
+
+    def get_forecast(self, location: str, raw: bool = False) -> dict | bytes:
+        return self.perform_request(http.HTTPMethod.GET, 'forecast.json', params=self._forecast_params(location), raw=raw)
+
+    async def get_forecast_async(self, location: str, raw: bool = False) -> dict | bytes:
+        return await self.perform_request_async(http.HTTPMethod.GET, 'forecast.json', params=self._forecast_params(location), raw=raw)
+
+    def get_current(self, location: str, raw: bool = False) -> dict | bytes:
+        """Current conditions only, a much smaller response than get_forecast."""
+        return self.perform_request(http.HTTPMethod.GET, 'current.json', params=self._current_params(location), raw=raw)
+
+    async def get_current_async(self, location: str, raw: bool = False) -> dict | bytes:
+        return await self.perform_request_async(http.HTTPMethod.GET, 'current.json', params=self._current_params(location), raw=raw)
+
+    @staticmethod
+    def _bulk_body(locations: list[str]) -> dict:
+        # custom_id is echoed back in the response, the index maps each result to its location
+        return {'locations': [{'q': location, 'custom_id': str(index)} for index, location in enumerate(locations)]}
+
+    @staticmethod
+    def _split_bulk(response: dict, locations: list[str]) -> dict[str, dict]:
+        """Map the results of a bulk response to their location, in the shape of a single forecast.json response."""
+        forecasts = {}
+        for item in response.get('bulk', []):
+            query = item.get('query', {})
+            if 'error' in query:
+                logger.warning(f"No forecast for location {query.get('q')}: {query['error']}")
+                continue
+            location = locations[int(query['custom_id'])]
+            forecasts[location] = {key: value for key, value in query.items() if key not in ('custom_id', 'q')}
+        return forecasts
+
+    def _bulk_failed(self, e: Exception, count: int) -> None:
+        # Only the plan of the API key rules out the next bulk requests, any other failure (eg: a 400 on one bad
+        # location, an undecodable body) only falls back for this chunk
+        if isinstance(e, APIError) and e.status_code in BULK_UNAVAILABLE_STATUSES:
+            logger.warning(f"The API key has no access to bulk requests, using single requests from now on: {e}")
+            self.bulk_available = False
+        logger.warning(f"Bulk forecast request failed, falling back to {count} single requests: {e}")
+        REGISTRY.inc('weather_bulk_fallbacks_total')
+
+    def get_forecasts_bulk(self, locations: Iterable[str]) -> dict[str, dict]:
+        """
+        Forecasts of many locations with one POST per `bulk_size` locations.
+
+        When bulk requests fail the chunk is fetched with concurrent single requests instead. Locations the API has no
+        forecast for are left out of the result.
+
+        :param locations: 'latitude,longitude' strings (or any q WeatherAPI accepts)
+        :return: dict of location -> forecast.json response
+        """
+        locations = list(dict.fromkeys(locations))
+        forecasts = {}
+        for start in range(0, len(locations), self.bulk_size):
+            chunk = locations[start:start + self.bulk_size]
+            if self.bulk_available:
+                try:
+                    response = self.perform_request(
+                        http.HTTPMethod.POST, 'forecast.json', body=self._bulk_body(chunk),
+                        params=self._forecast_params('bulk'),
+                    )
+                    forecasts.update(self._split_bulk(response, chunk))
+                    continue
+                except Exception as e:
+                    self._bulk_failed(e, len(chunk))
+            forecasts.update(self._get_forecasts_single(chunk))
+        return forecasts
+
+    def _get_forecasts_single(self, locations: list[str]) -> dict[str, dict]:
+        def fetch(location: str) -> Optional[dict]:
+            try:
+                return self.get_forecast(location)
+            except Exception as e:
+                logger.warning(f"Failed to get the forecast of location {location}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(self.max_connections, len(locations))) as executor:
+            results = executor.map(fetch, locations)
+            return {location: forecast for location, forecast in zip(locations, results) if forecast is not None}
+
+    async def get_forecasts_bulk_async(self, locations: Iterable[str]) -> dict[str, dict]:
+        """Awaitable version of get_forecasts_bulk, the chunks are requested concurrently."""
+        locations = list(dict.fromkeys(locations))
+        semaphore = asyncio.Semaphore(self.max_connections)
+
+        async def fetch_chunk(chunk: list[str]) -> dict[str, dict]:
+            if self.bulk_available:
+                try:
+                    async with semaphore:
+                        response = await self.perform_request_async(
+                            http.HTTPMethod.POST, 'forecast.json', body=self._bulk_body(chunk),
+                            params=self._forecast_params('bulk'),
+                        )
+                    return self._split_bulk(response, chunk)
+                except Exception as e:
+                    self._bulk_failed(e, len(chunk))
+            results = await asyncio.gather(*(fetch_single(location) for location in chunk))
+            return {location: forecast for location, forecast in zip(chunk, results) if forecast is not None}
+
+        async def fetch_single(location: str) -> Optional[dict]:
+            async with semaphore:
+                try:
+                    return await self.get_forecast_async(location)
+                except Exception as e:
+                    logger.warning(f"Failed to get the forecast of location {location}: {e}")
+                    return None
+
+        chunks = [locations[start:start + self.bulk_size] for start in range(0, len(locations), self.bulk_size)]
+        forecasts = {}
+        for result in await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks)):
+            forecasts.update(result)
+        return forecasts